@@ -2,6 +2,8 @@ from pathlib import Path
 from dotenv import load_dotenv
 from datetime import timedelta
 import os
+import sys
+import tempfile
 
 
 load_dotenv()
@@ -23,6 +25,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework',
     'channels',
     'rest_framework_simplejwt',
@@ -132,8 +135,33 @@ EMAIL_USE_SSL = False
 SERVER_EMAIL = EMAIL_HOST_USER
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
 
+# Кэш (ответы списков каталога и пр.): redis в проде, локальная память в тестах
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('CACHE_REDIS_URL', 'redis://redis:6379/2'),
+    }
+}
+if 'test' in sys.argv:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
 CELERY_BROKER_URL = 'redis://redis:6379/1'
 CELERY_RESULT_BACKEND = 'redis://redis:6379/1'
+CELERY_TASK_ALWAYS_EAGER = 'test' in sys.argv  # в тестах задачи выполняются сразу, без брокера
+CELERY_BEAT_SCHEDULE = {
+    'collect-orphan-media': {  # файлы media без ссылок из БД (api/media_gc.py)
+        'task': 'api.tasks.collect_orphan_media',
+        'schedule': timedelta(days=1),
+    },
+    'trim-resized-images': {  # лимит дискового кэша уменьшенных картинок (api/resize.py)
+        'task': 'api.tasks.trim_resized_images',
+        'schedule': timedelta(minutes=5),
+    },
+}
 
 # Internationalization
 # https://docs.djangoproject.com/en/4.2/topics/i18n/
@@ -159,6 +187,18 @@ STATICFILES_DIRS = [
 MEDIA_URL = '/media/'
 MEDIA_ROOT = '/media'
 
+# media с адресацией по содержимому: одинаковые загрузки - один файл (api/storage.py)
+STORAGES = {
+    'default': {'BACKEND': 'api.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+# город по координатам ищется в локальном справочнике (api/geocoder.py); Nominatim - только если включен
+GEOCODER_NOMINATIM_FALLBACK = os.getenv('GEOCODER_NOMINATIM_FALLBACK') == '1'
+# лимит дискового кэша уменьшенных по запросу картинок (api/resize.py)
+RESIZE_CACHE_MAX_BYTES = int(os.getenv('RESIZE_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+# lock-файлы уменьшения картинок; не в MEDIA_ROOT, дерево resized/ nginx раздает публично
+RESIZE_LOCKS_DIR = os.getenv('RESIZE_LOCKS_DIR', os.path.join(tempfile.gettempdir(), 'resize-locks'))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -4,6 +4,7 @@ from django.conf import settings
 from django.conf.urls.static import static
 
 from api import urls as api_urls
+from api.views import ResizedImageView
 from chat import urls as chat_urls
 
 
@@ -11,4 +12,5 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include(api_urls)),
     path('chat/', include(chat_urls)),
+    path('media/resized/<int:width>/<path:path>', ResizedImageView.as_view(), name='resized-image'),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,7 +1,7 @@
 from django.contrib import admin
 
 from .models import (Faq, News, Hotel, Photo, Restaurant,
-                     Transport, TripFolder, Favorite,
+                     Transport, TripFolder, Favorite, FavoriteItem,
                      Features, Excursion, ApplicationOnExcursion, Inclusive,
                      Conditions, Review, ApplicationUnblock, Facilities,
                      RentalServices, TypeRoom, Service, Kitchen, WorkingHours, Info)
@@ -35,6 +35,12 @@ class FavoriteAdmin(admin.ModelAdmin):
     list_display = ('id', 'user',)
 
 
+class FavoriteItemAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'folder', 'item_type', 'item_id', 'created_at')
+    list_filter = ('item_type',)
+    raw_id_fields = ('user', 'folder')
+
+
 class ApplicationOnExcursionAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'excursion', 'status')
 
@@ -46,6 +52,7 @@ admin.site.register(Restaurant, RestaurantAdmin)
 admin.site.register(Transport, TransportAdmin)
 admin.site.register(TripFolder, TripFolderAdmin)
 admin.site.register(Favorite, FavoriteAdmin)
+admin.site.register(FavoriteItem, FavoriteItemAdmin)
 admin.site.register(Features)
 admin.site.register(Excursion)
 admin.site.register(ApplicationOnExcursion, ApplicationOnExcursionAdmin)
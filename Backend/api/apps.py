@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+
+def create_extensions(sender, using, **kwargs):
+    """
+    Расширения postgres для индексов приложения (pg_trgm - триграммы для поиска по местоположению).
+    Миграции в репозитории не хранятся, поэтому расширения создаются перед migrate, а не операцией миграции
+    """
+    connection = connections[using]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
 
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'api'
+
+    def ready(self):
+        pre_migrate.connect(create_extensions, sender=self)
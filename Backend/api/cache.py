@@ -0,0 +1,72 @@
+"""
+Кэш ответов списков каталога и счетчиков фасетов.
+Ключ - модель, версия модели и нормализованные параметры запроса (фильтры, сортировка, страница).
+Версия модели увеличивается сигналами при любом изменении объектов этого типа
+(см. models.py), поэтому старые записи просто перестают читаться и доживают по таймауту
+"""
+import hashlib
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+
+LIST_TIMEOUT = 60 * 60  # страховка, основная инвалидация - по версии
+
+
+def version_key(model, namespace='catalog'):
+    return f'{namespace}:version:{model._meta.model_name}'
+
+
+def get_version(model, namespace='catalog'):
+    key = version_key(model, namespace)
+    version = cache.get(key)
+    if version is None:
+        # не начинаем с единицы, чтобы после вытеснения ключа не подхватить старые записи
+        cache.add(key, time.time_ns(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump_version(model, namespace='catalog'):
+    """Новая версия; None, если ключ был вытеснен и версия начата заново"""
+    key = version_key(model, namespace)
+    try:
+        return cache.incr(key)
+    except ValueError:  # ключ вытеснен
+        cache.set(key, time.time_ns(), None)
+        return None
+
+
+def invalidate(model):
+    """
+    Сбрасывает закэшированные списки модели сразу и еще раз после коммита,
+    чтобы запрос, успевший прочитать старые данные до коммита, не оставил их под новой версией
+    """
+    bump_version(model)
+    transaction.on_commit(lambda: bump_version(model))
+
+
+def normalize_params(query_params, names):
+    """
+    Параметры в каноническом виде: только известные фильтрам, значения списков отсортированы.
+    Сами значения не трогаем - фильтры по-разному обрабатывают пустые строки и пробелы
+    """
+    params = []
+    for name in sorted(set(names)):
+        values = sorted(query_params.getlist(name))
+        if values:
+            params.append((name, values))
+    return params
+
+
+def list_key(view, kind='list'):
+    """Ключ кэша для запроса к списку каталога (или к другой выдаче, зависящей от тех же фильтров)"""
+    names = list(view.cache_params)
+    for backend in view.filter_backends:
+        names += getattr(backend, 'cache_params', ())
+    names += getattr(getattr(view, 'pagination_class', None), 'cache_params', ())
+    request = view.request
+    signature = repr((request.get_host(), normalize_params(request.query_params, names)))
+    model = view.queryset.model
+    digest = hashlib.md5(signature.encode()).hexdigest()
+    return f'catalog:{kind}:{model._meta.model_name}:{get_version(model)}:{digest}'
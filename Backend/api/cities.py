@@ -0,0 +1,76 @@
+"""
+Наполнение справочника городов (models.City) и привязка к нему объектов каталога.
+
+Города и их русские названия берутся из того же CSV, что и у локального геокодера (geocoder.py),
+поэтому любой location, который проставил геокодер, находится в справочнике.
+Привязка и пересчет счетчиков идут запросами по группам одинаковых location, без обхода объектов
+"""
+import csv
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+
+from . import cache as catalog_cache
+from .geocoder import DATA_PATH
+from .models import CATALOG_MODELS, CITY_COUNT_FIELDS, City, normalize_city_name
+
+
+def load_cities(path=DATA_PATH):
+    """Создает города из CSV и дополняет алиасы существующих. Возвращает число новых городов"""
+    with open(path, encoding='utf-8') as file:
+        rows = list(csv.DictReader(file))
+    existing = {city.name: city for city in City.objects.filter(name__in=[row['name'] for row in rows])}
+    created = 0
+    for row in rows:
+        city = existing.get(row['name'])
+        aliases = [row['name'], row['name_ru']]
+        if city is None:
+            City.objects.create(name=row['name'], aliases=aliases,
+                                latitude=float(row['latitude']), longitude=float(row['longitude']))
+            created += 1
+        elif not {normalize_city_name(alias) for alias in aliases} <= set(city.aliases):
+            city.aliases += aliases
+            city.save(update_fields=['aliases'])
+    return created
+
+
+def map_locations(model, create_missing=False):
+    """
+    Проставляет city объектам model по location: каждая различная строка ищется в справочнике один раз.
+    Пустые строки и 'None' становятся NULL. Возвращает {строка: число объектов} для ненайденных
+    """
+    objects = model.objects.all()
+    objects.filter(location__in=('', 'None')).update(location=None)
+    objects.filter(location__isnull=True, city__isnull=False).update(city=None)
+    unmapped = {}
+    rows = objects.filter(location__isnull=False).order_by().values_list('location').annotate(count=Count('id'))
+    for location, count in rows:
+        city_id = City.objects.resolve(location)
+        if city_id is None and create_missing:
+            city_id = City.objects.create(name=' '.join(location.split())).id
+        if city_id is None:
+            unmapped[location] = count
+        objects.filter(location=location).exclude(city_id=city_id).update(city_id=city_id)
+    catalog_cache.invalidate(model)
+    return unmapped
+
+
+def recount():
+    """Полный пересчет счетчиков городов по опубликованным объектам"""
+    with transaction.atomic():
+        City.objects.update(**{field: 0 for field in CITY_COUNT_FIELDS.values()})
+        for model in CATALOG_MODELS:
+            field = CITY_COUNT_FIELDS[model]
+            rows = (model.objects.filter(status=True, city__isnull=False).order_by()
+                    .values_list('city_id').annotate(count=Count('id')))
+            for city_id, count in rows:
+                City.objects.filter(pk=city_id).update(**{field: count})
+
+
+def with_objects():
+    """Города, в которых есть хотя бы один опубликованный объект"""
+    condition = Q()
+    for field in CITY_COUNT_FIELDS.values():
+        condition |= Q(**{f'{field}__gt': 0})
+    return City.objects.filter(condition).annotate(
+        total=sum((F(field) for field in CITY_COUNT_FIELDS.values()), start=0))
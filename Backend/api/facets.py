@@ -0,0 +1,63 @@
+"""
+Счетчики фасетов для экрана фильтров каталога: сколько объектов с каждым значением m2m-поля
+(кухня, удобства и т.д.), в каждом ценовом диапазоне и с каждым минимальным рейтингом при текущих фильтрах.
+Цены и рейтинги считаются одним агрегатным запросом, все m2m-поля - одним UNION ALL по through-таблицам
+"""
+from django.db.models import CharField, Count, F, Q, Value
+
+
+def count_buckets(queryset, price_edges, rating_thresholds):
+    """Всего объектов, объектов в ценовых диапазонах [edges[i], edges[i+1]) и с рейтингом не ниже порога"""
+    bounds = list(zip(price_edges, price_edges[1:] + (None,)))
+    aggregates = {'total': Count('id')}
+    for i, (low, high) in enumerate(bounds):
+        condition = Q(cost__gte=low) if high is None else Q(cost__gte=low, cost__lt=high)
+        aggregates[f'price_{i}'] = Count('id', filter=condition)
+    for i, threshold in enumerate(rating_thresholds):
+        aggregates[f'rating_{i}'] = Count('id', filter=Q(rate__gte=threshold))
+    counts = queryset.aggregate(**aggregates)
+
+    # границы в терминах фильтров min_cost / max_cost (max_cost включительно, цены целые)
+    price = [{'min_cost': low, 'max_cost': None if high is None else high - 1, 'count': counts[f'price_{i}']}
+             for i, (low, high) in enumerate(bounds)]
+    rating = [{'min_rate': threshold, 'count': counts[f'rating_{i}']}
+              for i, threshold in enumerate(rating_thresholds)]
+    return counts['total'], price, rating
+
+
+def count_values(model, ids, facet_fields):
+    """{поле: [{'id', 'name', 'count'}]} для m2m-полей модели среди объектов ids (подзапрос)"""
+    if not facet_fields:
+        return {}
+    parts = []
+    for name in facet_fields:
+        field = model._meta.get_field(name)
+        through = field.remote_field.through
+        source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+        parts.append(through.objects
+                     .filter(**{f'{source}__in': ids})
+                     .values(facet=Value(name, output_field=CharField()), value_id=F(f'{target}_id'),
+                             value_name=F(f'{target}__name'))
+                     .annotate(count=Count('id'))
+                     .order_by())
+    rows = parts[0].union(*parts[1:], all=True)
+
+    facets = {name: [] for name in facet_fields}
+    for row in rows:
+        facets[row['facet']].append({'id': row['value_id'], 'name': row['value_name'], 'count': row['count']})
+    for values in facets.values():
+        values.sort(key=lambda value: (-value['count'], value['name']))
+    return facets
+
+
+def count_facets(queryset, facet_fields, price_edges, rating_thresholds):
+    """Все фасеты для отфильтрованного queryset двумя запросами"""
+    model = queryset.model
+    ids = queryset.order_by().values('id')
+    total, price, rating = count_buckets(model.objects.filter(id__in=ids), price_edges, rating_thresholds)
+    return {
+        'total': total,
+        'price': price,
+        'rating': rating,
+        **count_values(model, ids, facet_fields),
+    }
@@ -0,0 +1,81 @@
+"""
+Кэш id объектов в избранном пользователя для is_favorite: {тип объекта: frozenset id}.
+
+Набор строится одним запросом к FavoriteItem по индексу (user, item_type, item_id) и хранится
+в общем кэше (Redis) и в LRU внутри процесса. В общем кэше лежит и версия избранного
+пользователя: запись LRU действительна, пока версия не изменилась, поэтому на запрос
+приходится одно чтение версии, а проверка объекта - поиск в frozenset.
+Версию увеличивают операции с избранным (favorites.py) и удаление папки (models.py)
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache
+from django.db import transaction
+
+TIMEOUT = 60 * 60 * 24
+LRU_SIZE = 1024  # пользователей на процесс
+
+_lru = OrderedDict()  # id пользователя -> (версия, {имя модели: frozenset id})
+_lru_lock = threading.Lock()
+
+
+def version_key(user_id):
+    return f'favorites:version:{user_id}'
+
+
+def get_version(user_id):
+    key = version_key(user_id)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, time.time_ns(), None)  # как в cache.get_version: не с единицы
+        version = cache.get(key)
+    return version
+
+
+def bump_version(user_id):
+    try:
+        cache.incr(version_key(user_id))
+    except ValueError:  # ключ вытеснен
+        cache.set(version_key(user_id), time.time_ns(), None)
+
+
+def invalidate(user_id):
+    """Сразу и после коммита - чтобы набор, собранный до коммита, не остался под новой версией"""
+    bump_version(user_id)
+    transaction.on_commit(lambda: bump_version(user_id))
+
+
+def build(user_id):
+    """{тип объекта: [id]} избранного пользователя одним запросом"""
+    from .models import FavoriteItem
+    ids = {}
+    for item_type, item_id in FavoriteItem.objects.filter(user_id=user_id).values_list('item_type', 'item_id'):
+        ids.setdefault(item_type, []).append(item_id)
+    return ids
+
+
+def get_ids(user, model):
+    """frozenset id объектов model в избранном пользователя"""
+    if not user.is_authenticated:
+        return frozenset()
+    version = get_version(user.pk)
+    with _lru_lock:
+        entry = _lru.get(user.pk)
+        if entry is not None and entry[0] == version:
+            _lru.move_to_end(user.pk)
+            return entry[1].get(model._meta.model_name, frozenset())
+
+    key = f'favorites:{user.pk}:{version}'
+    ids = cache.get(key)
+    if ids is None:
+        ids = build(user.pk)
+        cache.set(key, ids, TIMEOUT)
+    data = {model_name: frozenset(values) for model_name, values in ids.items()}
+    with _lru_lock:
+        _lru[user.pk] = (version, data)
+        _lru.move_to_end(user.pk)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+    return data.get(model._meta.model_name, frozenset())
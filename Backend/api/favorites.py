@@ -0,0 +1,198 @@
+"""
+Избранное пользователя: объекты в папках поездки (models.FavoriteItem, строка на объект).
+
+Пакетное изменение - список операций "добавить / убрать объект в папках" - применяется
+в одной транзакции: папки пользователя блокируются на время изменений, строки вставляются
+и удаляются пачками, а countFavorites папок меняется на разницу одним UPDATE с F(),
+без чтения и сохранения модели. Массовые операции не вызывают сигналов, поэтому кэш
+избранного (favorite_cache.py) сбрасывается здесь же
+"""
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, OuterRef, Subquery, Value, When, Window
+from django.db.models.functions import Coalesce, RowNumber
+
+from . import favorite_cache
+from .models import TAG_ID_FIELDS, Excursion, Favorite, FavoriteItem, Hotel, Restaurant, Transport, TripFolder
+
+# тип объекта -> поле в ответах старых эндпоинтов (и m2m-поле Favorite из старой схемы)
+ITEM_FIELDS = {'hotel': 'hotels', 'restaurant': 'restaurants', 'transport': 'transport', 'excursion': 'excursions'}
+ITEM_MODELS = {'hotel': Hotel, 'restaurant': Restaurant, 'transport': Transport, 'excursion': Excursion}
+MAX_OPERATIONS = 500
+CARDS_PAGE_SIZE = 20  # объектов папки в краткой выдаче избранного
+MAX_CARDS_PAGE_SIZE = 100
+
+
+class FavoriteError(Exception):
+    """Некорректная операция, status - код ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def update_counts(deltas):
+    """Меняет countFavorites папок на разницу {id папки: изменение} одним UPDATE"""
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if deltas:
+        change = Case(*(When(pk=pk, then=Value(delta)) for pk, delta in deltas.items()), default=Value(0))
+        TripFolder.objects.filter(pk__in=deltas).update(countFavorites=F('countFavorites') + change)
+
+
+def ensure_favorites(user, folder_ids):
+    """Записи Favorite для папок: по ним старые эндпоинты отдают и находят избранное"""
+    existing = set(Favorite.objects.filter(user=user, folder_id__in=folder_ids).values_list('folder_id', flat=True))
+    Favorite.objects.bulk_create([Favorite(user=user, folder_id=folder_id)
+                                  for folder_id in folder_ids if folder_id not in existing])
+
+
+def check_items(operations):
+    """FavoriteError, если какого-то объекта из операций нет"""
+    for item_type, model in ITEM_MODELS.items():
+        item_ids = {operation['id'] for operation in operations if operation['type'] == item_type}
+        if not item_ids:
+            continue
+        missing = item_ids - set(model.objects.filter(id__in=item_ids).values_list('id', flat=True))
+        if missing:
+            raise FavoriteError(f'{item_type} {min(missing)} не найден', 404)
+
+
+def apply(user, operations):
+    """
+    operations - [{'action': 'add' | 'remove', 'type': ключ ITEM_FIELDS, 'id': id объекта, 'folders': [id папок]}].
+    Возвращает {id папки: число объектов в ней} для затронутых папок
+    """
+    folder_ids = sorted({folder_id for operation in operations for folder_id in operation['folders']})
+    with transaction.atomic():
+        # папки блокируются в порядке id: запросы к тем же папкам идут по очереди и не взаимоблокируются
+        locked = list(TripFolder.objects.select_for_update().filter(user=user, id__in=folder_ids)
+                      .order_by('id').values_list('id', flat=True))
+        if len(locked) != len(folder_ids):
+            raise FavoriteError('папка не найдена', 404)
+        check_items(operations)
+        ensure_favorites(user, folder_ids)
+
+        # итог для (папка, тип, объект) определяет последняя операция с ним
+        wanted = {}
+        for operation in operations:
+            for folder_id in operation['folders']:
+                wanted[folder_id, operation['type'], operation['id']] = operation.get('action', 'add') == 'add'
+        item_ids = {item_id for _, _, item_id in wanted}
+        existing = {(folder_id, item_type, item_id): pk for pk, folder_id, item_type, item_id in
+                    FavoriteItem.objects.filter(user=user, folder_id__in=folder_ids, item_id__in=item_ids)
+                    .values_list('id', 'folder_id', 'item_type', 'item_id')}
+
+        inserts, deletes = [], []
+        deltas = dict.fromkeys(folder_ids, 0)
+        for key, present in wanted.items():
+            folder_id, item_type, item_id = key
+            if present and key not in existing:
+                inserts.append(FavoriteItem(user=user, folder_id=folder_id, item_type=item_type, item_id=item_id))
+                deltas[folder_id] += 1
+            elif not present and key in existing:
+                deletes.append(existing[key])
+        FavoriteItem.objects.bulk_create(inserts)
+        # строку могла уже удалить remove_items (она папки не блокирует) - вычитаем только реально удаленные
+        if deletes:
+            for folder_id, _ in delete_returning(FavoriteItem.objects.filter(id__in=deletes)):
+                deltas[folder_id] -= 1
+        update_counts(deltas)
+        favorite_cache.invalidate(user.pk)
+        return dict(TripFolder.objects.filter(id__in=folder_ids).values_list('id', 'countFavorites'))
+
+
+def delete_returning(items):
+    """Удаляет строки FavoriteItem из queryset одним DELETE ... RETURNING, возвращает [(папка, пользователь)] удаленных"""
+    query, params = items.values('id').query.sql_with_params()
+    table = connection.ops.quote_name(FavoriteItem._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {table} WHERE id IN ({query}) RETURNING folder_id, user_id', params)
+        return cursor.fetchall()
+
+
+def remove_items(items):
+    """
+    Удаляет строки FavoriteItem из queryset и уменьшает счетчики ровно тех папок,
+    из которых строки действительно удалены. Возвращает число удаленных
+    """
+    with transaction.atomic():
+        rows = delete_returning(items)
+        update_counts({folder_id: -count for folder_id, count in Counter(folder_id for folder_id, _ in rows).items()})
+    for user_id in {user_id for _, user_id in rows}:
+        favorite_cache.invalidate(user_id)
+    return len(rows)
+
+
+def folder_item_ids(favorite):
+    """{тип: [id объектов]} папки записи Favorite; считается один раз на объект"""
+    if not hasattr(favorite, '_folder_item_ids'):
+        attach_item_ids([favorite])
+    return favorite._folder_item_ids
+
+
+def attach_item_ids(favorites):
+    """folder_item_ids для списка записей Favorite одним запросом"""
+    by_folder = {}
+    folder_ids = {favorite.folder_id for favorite in favorites if favorite.folder_id}
+    rows = (FavoriteItem.objects.filter(folder_id__in=folder_ids).order_by('created_at', 'id')
+            .values_list('folder_id', 'item_type', 'item_id'))
+    for folder_id, item_type, item_id in rows:
+        by_folder.setdefault(folder_id, {}).setdefault(item_type, []).append(item_id)
+    for favorite in favorites:
+        ids = by_folder.get(favorite.folder_id, {})
+        favorite._folder_item_ids = {item_type: ids.get(item_type, []) for item_type in ITEM_FIELDS}
+
+
+def attach_items(favorites, querysets=None):
+    """
+    folder_items = {тип: [объекты]} для списка записей Favorite: один запрос к FavoriteItem и по одному
+    на тип объектов. querysets - {тип: queryset} со связями, которые нужны сериализатору (их prefetch'и
+    тоже идут пачкой на весь список); по умолчанию объекты без связей
+    """
+    attach_item_ids(favorites)
+    querysets = querysets or {}
+    objects = {}
+    for item_type, model in ITEM_MODELS.items():
+        ids = {pk for favorite in favorites for pk in favorite._folder_item_ids[item_type]}
+        objects[item_type] = querysets.get(item_type, model.objects.all()).in_bulk(ids) if ids else {}
+    for favorite in favorites:
+        favorite.folder_items = {
+            item_type: [objects[item_type][pk] for pk in ids if pk in objects[item_type]]
+            for item_type, ids in favorite._folder_item_ids.items()
+        }
+
+
+def attach_cards(favorites, offset=0, limit=CARDS_PAGE_SIZE):
+    """
+    folder_cards = [(тип, объект)] - страница объектов папки для кратких карточек.
+    Страницы всех папок выбираются одним запросом (номер строки в папке - оконная функция),
+    объекты - одним запросом на тип, без описаний и служебных колонок
+    """
+    folder_ids = {favorite.folder_id for favorite in favorites if favorite.folder_id}
+    position = Window(RowNumber(), partition_by=F('folder_id'), order_by=(F('created_at').asc(), F('id').asc()))
+    rows = (FavoriteItem.objects.filter(folder_id__in=folder_ids).annotate(position=position)
+            .filter(position__gt=offset, position__lte=offset + limit)
+            .order_by('folder_id', 'position').values_list('folder_id', 'item_type', 'item_id'))
+    by_folder = {}
+    for folder_id, item_type, item_id in rows:
+        by_folder.setdefault(folder_id, []).append((item_type, item_id))
+
+    objects = {}
+    for item_type, model in ITEM_MODELS.items():
+        ids = {item_id for items in by_folder.values() for kind, item_id in items if kind == item_type}
+        if ids:
+            queryset = model.objects.defer('description', 'search_vector', *TAG_ID_FIELDS.get(model, {}).values())
+            objects[item_type] = queryset.in_bulk(ids)
+    for favorite in favorites:
+        favorite.folder_cards = [(item_type, objects[item_type][item_id])
+                                 for item_type, item_id in by_folder.get(favorite.folder_id, [])
+                                 if item_id in objects.get(item_type, {})]
+
+
+def recount_folders():
+    """Пересчет countFavorites по FavoriteItem у папок с расхождением. Возвращает число исправленных"""
+    counts = (FavoriteItem.objects.filter(folder_id=OuterRef('pk')).order_by().values('folder_id')
+              .annotate(count=Count('id')).values('count'))
+    actual = Coalesce(Subquery(counts), Value(0))
+    return TripFolder.objects.alias(actual=actual).exclude(countFavorites=F('actual')).update(countFavorites=actual)
@@ -1,12 +1,78 @@
+import math
+
 import django_filters
-from django.db.models import F, Func
+from django.db.models import F, Value
 from django.db import models
-from django.db.models.functions import ACos, Sin, Cos, Radians
+from django.db.models.functions import ACos, Sin, Cos, Radians, Greatest, Least
 from rest_framework import filters
 
 from .models import (
     Transport, ApplicationOnExcursion, Excursion, Inclusive, Conditions,
-    Favorite, Kitchen, Features, Restaurant, Review, Hotel)
+    Favorite, Kitchen, Features, Restaurant, Review, Hotel, City, TAG_ID_FIELDS)
+from .geo import EARTH_RADIUS_KM, request_point, within
+from .search import filter_by_search, filter_by_trigram, is_fuzzy
+
+
+
+def distance_expression(lat, lng):
+    """Расстояние по большому кругу в км от точки (lat, lng) до объекта, считается в БД"""
+    lat, lng = math.radians(lat), math.radians(lng)
+    cosine = (
+        Sin(Radians('latitude')) * math.sin(lat) +
+        Cos(Radians('latitude')) * math.cos(lat) * Cos(Radians('longitude') - lng)
+    )
+    # из-за округления косинус может чуть выйти за [-1, 1], а ACOS от этого падает
+    return ACos(Greatest(Least(cosine, Value(1.0)), Value(-1.0))) * EARTH_RADIUS_KM
+
+
+def filter_by_distance(request, queryset):
+    """
+    Гео-поиск по lat, lng и необязательному radius_km. С радиусом объекты сначала отсекаются
+    прямоугольником по индексу (latitude, longitude), и точное расстояние считается только для попавших.
+    Страницу по расстоянию KeysetPagination выбирает окнами с радиусом по индексу в памяти (geo.nearest_windows).
+    Остальные фильтры queryset сохраняются, в выдачу добавляется аннотация distance
+    """
+    point = request_point(request.query_params)
+    if point is None:
+        return queryset
+    lat, lng, radius_km = point
+
+    # объекты без координат в гео-поиск не попадают (LEAST/GREATEST в postgres пропускают NULL)
+    queryset = queryset.filter(latitude__isnull=False, longitude__isnull=False)
+    queryset = queryset.annotate(distance=distance_expression(lat, lng))
+    if radius_km:
+        queryset = within(queryset, lat, lng, radius_km)
+    return queryset.order_by('distance')
+
+
+def filter_by_location(request, queryset):
+    """
+    Фильтр по городу: city - id из /cities/, location - название или алиас на любом языке.
+    Название ищется в справочнике один раз, дальше - равенство по индексированному city_id.
+    Нечеткий поиск и строки, которых нет в справочнике (часть названия), ищутся по тексту location
+    """
+    city = request.query_params.get('city')
+    location = request.query_params.get('location')
+    if city:
+        queryset = queryset.filter(city_id=city) if city.isdigit() else queryset.none()
+    if location:
+        city_id = None if is_fuzzy(request) else City.objects.resolve(location)
+        if city_id is not None:
+            queryset = queryset.filter(city_id=city_id)
+        else:
+            queryset = filter_by_trigram(queryset, 'location', location, is_fuzzy(request))
+    return queryset
+
+
+def filter_by_tags(queryset, field_name, values):
+    """
+    Объекты, у которых есть все выбранные значения m2m-поля: одно условие @> по GIN-индексу
+    колонки с копией id (models.TAG_ID_FIELDS) вместо JOIN на каждое значение
+    """
+    if not all(value.isdigit() for value in values):
+        return queryset.none()
+    ids_field = TAG_ID_FIELDS[queryset.model][field_name]
+    return queryset.filter(**{f'{ids_field}__contains': sorted({int(value) for value in values})})
 
 
 class TransportFilter(django_filters.FilterSet):
@@ -39,21 +105,25 @@ class FavoriteFilter(django_filters.FilterSet):
 
 
 class TransportFilterBackend(filters.BaseFilterBackend):
+    cache_params = ('name', 'description', 'location', 'city', 'promotion', 'lat', 'lng', 'radius_km', 'search', 'fuzzy')  # параметры фильтра для ключа кэша списков
+
     def filter_queryset(self, request, queryset, view):
         """фильтр для транспорта"""
         name = request.query_params.get('name')
         description = request.query_params.get('description')
-        location = request.query_params.get('location')
         promotion = request.query_params.get('promotion')
 
         if name:
-            queryset = queryset.filter(name__icontains=name)
+            queryset = filter_by_trigram(queryset, 'name', name, is_fuzzy(request))
         if description:
             queryset = queryset.filter(description__icontains=description)
-        if location:
-            queryset = queryset.filter(location__icontains=location)
+        queryset = filter_by_location(request, queryset)
         if promotion:
             queryset = queryset.filter(promotion=promotion)
+        if request.query_params.get('lat') and request.query_params.get('lng'):
+            queryset = filter_by_distance(request, queryset)
+        if request.query_params.get('search'):
+            queryset = filter_by_search(request, queryset)
 
         return queryset
 
@@ -108,10 +178,10 @@ class ReviewFilter(django_filters.FilterSet):
 
 
 class RestaurantFilter(filters.BaseFilterBackend):
+    cache_params = ('location', 'city', 'promotion', 'features', 'kitchen', 'min_cost', 'max_cost', 'lat', 'lng', 'radius_km', 'min_rate', 'search', 'fuzzy')
 
     def filter_queryset(self, request, queryset, view):
         """фильтр для ресторанов"""
-        location = request.query_params.get('location')
         promotion = request.query_params.get('promotion')
         features = request.query_params.getlist('features')
         kitchen = request.query_params.getlist('kitchen')
@@ -123,43 +193,32 @@ class RestaurantFilter(filters.BaseFilterBackend):
 
         if min_rate:
             queryset = queryset.filter(rate__gte=min_rate)
-        if location:
-            queryset = queryset.filter(location__icontains=location)
+        queryset = filter_by_location(request, queryset)
         if promotion:
             queryset = queryset.filter(promotion=promotion)
         if features:
-            for i in features:
-                queryset = queryset.filter(features__id__in=i)
+            queryset = filter_by_tags(queryset, 'features', features)
         if kitchen:
-            for i in kitchen:
-                queryset = queryset.filter(kitchen__id__in=i)
+            queryset = filter_by_tags(queryset, 'kitchen', kitchen)
         if min_cost:
             queryset = queryset.filter(cost__gte=min_cost)
         if max_cost:
             queryset = queryset.filter(cost__lte=max_cost)
         # вычисление расстояния  и сортировка по дистанции до объекта
         if lat and lng:
-            queryset = Hotel.objects.annotate(distance=Func(
-                ACos(
-                    (
-                        Sin(Func('latitude', function='RADIANS')) *
-                        Sin(Func(lat, function='RADIANS'))
-                    ) + 
-                    (
-                        Cos(Func('latitude', function='RADIANS')) *
-                        Cos(Func(lat, function='RADIANS')) *
-                        Cos(Func('longitude', function='RADIANS') - Func(lng, function='RADIANS'))
-                    )
-                ) * 6371, function='DEGREES')).order_by('distance')
+            queryset = filter_by_distance(request, queryset)
+        if request.query_params.get('search'):
+            queryset = filter_by_search(request, queryset)
 
         return queryset
 
 
 class ExcursionFilter(filters.BaseFilterBackend):
+    cache_params = ('inclusives', 'conditions', 'location', 'city', 'promotion', 'min_cost', 'max_cost', 'lat', 'lng', 'radius_km', 'min_rate', 'search', 'fuzzy')
+
     def filter_queryset(self, request, queryset, view):
         inclusives = request.query_params.getlist('inclusives')
         conditions = request.query_params.getlist('conditions')
-        location = request.query_params.get('location')
         promotion = request.query_params.get('promotion')
         min_cost = request.query_params.get('min_cost')
         max_cost = request.query_params.get('max_cost')
@@ -170,13 +229,10 @@ class ExcursionFilter(filters.BaseFilterBackend):
         if min_rate:
             queryset = queryset.filter(rate__gte=min_rate)
         if inclusives:
-            for i in inclusives:
-                queryset = queryset.filter(inclusives__id__in=i)
+            queryset = filter_by_tags(queryset, 'inclusives', inclusives)
         if conditions:
-            for i in conditions:
-                queryset = queryset.filter(conditions__id__in=i)
-        if location:
-            queryset = queryset.filter(location__icontains=location)
+            queryset = filter_by_tags(queryset, 'conditions', conditions)
+        queryset = filter_by_location(request, queryset)
         if promotion:
             queryset = queryset.filter(promotion=promotion)
         if min_cost:
@@ -184,29 +240,21 @@ class ExcursionFilter(filters.BaseFilterBackend):
         if max_cost:
             queryset = queryset.filter(cost__lte=max_cost)
         if lat and lng:
-            queryset = Hotel.objects.annotate(distance=Func(
-                ACos(
-                    (
-                        Sin(Func('latitude', function='RADIANS')) *
-                        Sin(Func(lat, function='RADIANS'))
-                    ) + 
-                    (
-                        Cos(Func('latitude', function='RADIANS')) *
-                        Cos(Func(lat, function='RADIANS')) *
-                        Cos(Func('longitude', function='RADIANS') - Func(lng, function='RADIANS'))
-                    )
-                ) * 6371, function='DEGREES')).order_by('distance')
+            queryset = filter_by_distance(request, queryset)
+        if request.query_params.get('search'):
+            queryset = filter_by_search(request, queryset)
 
         return queryset
 
 
 class HotelFilter(filters.BaseFilterBackend):
+    cache_params = ('promotion', 'min_rate', 'min_cost', 'max_cost', 'location', 'city', 'type_rooms', 'facilities', 'services', 'lat', 'lng', 'radius_km', 'search', 'fuzzy')
+
     def filter_queryset(self, request, queryset, view):
         promotion = request.query_params.get('promotion')
         min_rate = request.query_params.get('min_rate')
         min_cost = request.query_params.get('min_cost')
         max_cost = request.query_params.get('max_cost')
-        location = request.query_params.get('location')
         type_rooms = request.query_params.getlist('type_rooms')
         facilities = request.query_params.getlist('facilities')
         services = request.query_params.getlist('services')
@@ -221,30 +269,17 @@ class HotelFilter(filters.BaseFilterBackend):
             queryset = queryset.filter(cost__gte=min_cost)
         if max_cost:
             queryset = queryset.filter(cost__lte=max_cost)
-        if location:
-            queryset = queryset.filter(location__icontains=location)
+        queryset = filter_by_location(request, queryset)
         if type_rooms:
-            for i in type_rooms:
-                queryset = queryset.filter(type_room__id__in=i)
+            queryset = filter_by_tags(queryset, 'type_room', type_rooms)
         if facilities:
-            for i in facilities:
-                queryset = queryset.filter(facilities__id__in=i)
+            queryset = filter_by_tags(queryset, 'facilities', facilities)
         if services:
-            for i in services:
-                queryset = queryset.filter(services__id__in=i)
+            queryset = filter_by_tags(queryset, 'services', services)
         if lat and lng:
-            queryset = Hotel.objects.annotate(distance=Func(
-                ACos(
-                    (
-                        Sin(Func('latitude', function='RADIANS')) *
-                        Sin(Func(lat, function='RADIANS'))
-                    ) + 
-                    (
-                        Cos(Func('latitude', function='RADIANS')) *
-                        Cos(Func(lat, function='RADIANS')) *
-                        Cos(Func('longitude', function='RADIANS') - Func(lng, function='RADIANS'))
-                    )
-                ) * 6371, function='DEGREES')).order_by('distance')
+            queryset = filter_by_distance(request, queryset)
+        if request.query_params.get('search'):
+            queryset = filter_by_search(request, queryset)
  
         return queryset
 
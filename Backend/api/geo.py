@@ -0,0 +1,187 @@
+"""
+Гео-утилиты и индекс координат объектов каталога в памяти процесса.
+
+Индекс держит одобренные объекты одного типа в numpy-массивах, отсортированных по широте:
+для запроса по радиусу полоса широт находится бинарным поиском, долгота отсекается маской,
+и haversine считается векторно только для кандидатов. Изменения объектов применяются к индексу
+точечно из сигналов (см. models.py), а версия в общем кэше говорит остальным процессам, что их копия устарела
+"""
+import math
+import threading
+
+import numpy as np
+from django.db import transaction
+
+from . import cache as catalog_cache
+
+VERSION_NAMESPACE = 'geo'  # своя версия: меняется только от изменений самих объектов, а не отзывов и фото
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.045  # километров в градусе широты
+MIN_WINDOW_KM = 1.0  # окна выдачи по расстоянию (nearest_windows): начальный радиус не меньше
+WINDOW_GROWTH = 4
+
+
+def bounding_box(lat, lng, radius_km):
+    """Прямоугольник широт/долгот, в который гарантированно попадает круг радиуса radius_km"""
+    lat_delta = radius_km / KM_PER_DEGREE
+    lng_delta = radius_km / (KM_PER_DEGREE * max(math.cos(math.radians(lat)), 0.01))
+    return (lat - lat_delta, lat + lat_delta), (lng - lng_delta, lng + lng_delta)
+
+
+def haversine(lat, lng, lats, lngs):
+    """Расстояние в км от точки до массива точек (все в градусах)"""
+    lat, lng = np.radians(lat), np.radians(lng)
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lngs - lng) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+class SpatialIndex:
+    """Координаты одобренных объектов одной модели каталога"""
+
+    def __init__(self, model):
+        self.model = model
+        self.lock = threading.Lock()
+        self.points = None  # id -> (широта, долгота); None - еще не загружен
+        self.version = None
+        self.arrays = None  # (ids, lats, lngs) по возрастанию широты; None - надо пересобрать после изменений
+
+    def load(self, version):
+        rows = (self.model.objects
+                .filter(status=True, latitude__isnull=False, longitude__isnull=False)
+                .values_list('id', 'latitude', 'longitude'))
+        self.points = {pk: (lat, lng) for pk, lat, lng in rows}
+        self.arrays = None
+        self.version = version
+
+    def get_arrays(self):
+        """Актуальные массивы; при смене версии в кэше индекс перечитывается из БД"""
+        version = catalog_cache.get_version(self.model, VERSION_NAMESPACE)
+        with self.lock:
+            if self.points is None or version != self.version:
+                self.load(version)
+            if self.arrays is None:
+                ids = np.fromiter(self.points.keys(), dtype=np.int64, count=len(self.points))
+                coords = np.array(list(self.points.values()), dtype=np.float64).reshape(-1, 2)
+                order = np.argsort(coords[:, 0], kind='stable')
+                self.arrays = ids[order], coords[order, 0], coords[order, 1]
+            return self.arrays
+
+    def apply(self, pk, point, version):
+        """
+        Точечное изменение из сигнала этого процесса. Если между нашей версией и новой
+        не было чужих изменений, индекс остается актуальным без перечитывания
+        """
+        with self.lock:
+            if self.points is None:
+                return
+            if point is None:
+                self.points.pop(pk, None)
+            else:
+                self.points[pk] = point
+            self.arrays = None
+            if version is not None and self.version is not None and version == self.version + 1:
+                self.version = version
+
+    def candidates(self, lat, lng, radius_km):
+        ids, lats, lngs = self.get_arrays()
+        lat_range, lng_range = bounding_box(lat, lng, radius_km)
+        start, stop = np.searchsorted(lats, lat_range[0], 'left'), np.searchsorted(lats, lat_range[1], 'right')
+        ids, lats, lngs = ids[start:stop], lats[start:stop], lngs[start:stop]
+        mask = (lngs >= lng_range[0]) & (lngs <= lng_range[1])
+        ids, lats, lngs = ids[mask], lats[mask], lngs[mask]
+        return ids, haversine(lat, lng, lats, lngs)
+
+    def covering_radius(self, lat, lng, count, from_km=0.0):
+        """Радиус, в котором не ближе from_km лежат count объектов индекса; None, если их меньше"""
+        ids, lats, lngs = self.get_arrays()
+        distances = haversine(lat, lng, lats, lngs)
+        distances = distances[distances >= from_km]
+        if len(distances) < count:
+            return None
+        return float(np.partition(distances, count - 1)[count - 1])
+
+    def radius(self, lat, lng, radius_km, limit=None):
+        """[(id, км)] объектов в радиусе, по возрастанию расстояния"""
+        ids, distances = self.candidates(lat, lng, radius_km)
+        inside = distances <= radius_km
+        ids, distances = ids[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')[:limit]
+        return list(zip(ids[order].tolist(), distances[order].tolist()))
+
+    def nearest(self, lat, lng, k, max_km=None):
+        """k ближайших [(id, км)]; радиус поиска расширяется, пока не наберется k объектов"""
+        ids, _, _ = self.get_arrays()
+        if k <= 0 or not len(ids):
+            return []
+        max_km = max_km or math.pi * EARTH_RADIUS_KM
+        radius_km = min(5.0, max_km)
+        while True:
+            found = self.radius(lat, lng, radius_km, limit=k)
+            if len(found) >= k or radius_km >= max_km:
+                return found
+            radius_km = min(radius_km * 4, max_km)
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(model):
+    with _indexes_lock:
+        if model not in _indexes:
+            _indexes[model] = SpatialIndex(model)
+        return _indexes[model]
+
+
+def on_catalog_change(model, instance, deleted=False):
+    """Вызывается из сигналов моделей каталога; применяется после коммита транзакции"""
+    visible = not deleted and instance.status and instance.latitude is not None and instance.longitude is not None
+    point = (instance.latitude, instance.longitude) if visible else None
+    pk = instance.pk
+
+    def apply():
+        version = catalog_cache.bump_version(model, VERSION_NAMESPACE)
+        if model in _indexes:
+            _indexes[model].apply(pk, point, version)
+
+    transaction.on_commit(apply)
+
+
+def request_point(query_params):
+    """(lat, lng, radius_km или None) из параметров гео-поиска; None, если точка не задана"""
+    try:
+        lat = float(query_params['lat'])
+        lng = float(query_params['lng'])
+        radius_km = float(query_params.get('radius_km') or 0) or None
+    except (KeyError, ValueError):
+        return None
+    return lat, lng, radius_km
+
+
+def within(queryset, lat, lng, radius_km):
+    """
+    Объекты не дальше radius_km: прямоугольник по индексу (latitude, longitude), затем точное
+    расстояние (аннотация distance). Если прямоугольник переходит через 180-й меридиан, долгота не отсекается
+    """
+    lat_range, lng_range = bounding_box(lat, lng, radius_km)
+    queryset = queryset.filter(latitude__range=lat_range, distance__lte=radius_km)
+    if lng_range[0] >= -180 and lng_range[1] <= 180:
+        queryset = queryset.filter(longitude__range=lng_range)
+    return queryset
+
+
+def nearest_windows(queryset, lat, lng, count, from_km=0.0, radius_km=None):
+    """
+    Запросы для страницы из count ближайших объектов не ближе from_km (курсор): сначала в радиусе,
+    где столько объектов по индексу в памяти, затем в радиусе в WINDOW_GROWTH раз больше, последним -
+    без ограничения (кроме radius_km). Окно, вернувшее count строк, дает точную страницу: в него
+    попадают все объекты ближе его радиуса, а индекс только подсказывает радиус
+    """
+    radius = get_index(queryset.model).covering_radius(lat, lng, count, from_km)
+    limit = min(radius_km or math.inf, math.pi * EARTH_RADIUS_KM)
+    while radius is not None and radius < limit:
+        yield within(queryset, lat, lng, max(radius, MIN_WINDOW_KM))
+        radius = max(radius, MIN_WINDOW_KM) * WINDOW_GROWTH
+    yield queryset
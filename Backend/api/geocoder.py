@@ -0,0 +1,113 @@
+"""
+Определение города по координатам без сетевых запросов.
+
+Центры городов и курортов Таиланда лежат в data/thai_cities.csv, поиск ближайшего идет по тому же
+индексу с полосой широт, что и поиск объектов (geo.SpatialIndex), и занимает микросекунды.
+Если ближе MAX_DISTANCE_KM города нет, а в настройках включен GEOCODER_NOMINATIM_FALLBACK,
+город после создания объекта ищет celery-задача через Nominatim; ее ответы кэшируются
+по координатам, округленным до COORDINATE_PRECISION знаков (~1 км)
+"""
+import csv
+import math
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from geopy.exc import GeopyError
+from geopy.geocoders import Nominatim
+
+from .geo import SpatialIndex
+
+DATA_PATH = os.path.join(os.path.dirname(__file__), 'data', 'thai_cities.csv')
+MAX_DISTANCE_KM = 50
+COORDINATE_PRECISION = 2
+NOMINATIM_TIMEOUT = 5  # сек, запрос идет в celery, а не в запросе пользователя
+CACHE_TIMEOUT = 60 * 60 * 24 * 90
+
+
+class CityIndex(SpatialIndex):
+    """Центры городов из CSV: поиск как у индекса объектов, но данные статичны и не зависят от БД"""
+
+    def __init__(self, path=DATA_PATH):
+        super().__init__(model=None)
+        with open(path, encoding='utf-8') as file:
+            self.cities = list(csv.DictReader(file))
+        coords = np.array([(float(city['latitude']), float(city['longitude'])) for city in self.cities], dtype=np.float64)
+        order = np.argsort(coords[:, 0], kind='stable')
+        self.arrays = order.astype(np.int64), coords[order, 0], coords[order, 1]
+
+    def get_arrays(self):
+        return self.arrays
+
+    def city(self, lat, lng, max_km=MAX_DISTANCE_KM):
+        """Строка CSV ближайшего города не дальше max_km или None"""
+        found = self.nearest(lat, lng, 1, max_km)
+        return self.cities[found[0][0]] if found else None
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CityIndex()
+        return _index
+
+
+def parse_point(latitude, longitude):
+    """(широта, долгота) из значений запроса или None, если они не заданы или некорректны"""
+    try:
+        lat, lng = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+    if not (math.isfinite(lat) and math.isfinite(lng) and -90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return lat, lng
+
+
+def get_city(latitude, longitude):
+    """Название города по координатам из локального справочника; None, если координат нет или город далеко"""
+    point = parse_point(latitude, longitude)
+    if point is None:
+        return None
+    city = get_index().city(*point)
+    return city['name'] if city else None
+
+
+def cache_key(lat, lng):
+    return f'geocode:{lat:.{COORDINATE_PRECISION}f}:{lng:.{COORDINATE_PRECISION}f}'
+
+
+def nominatim_city(lat, lng):
+    """Город через Nominatim с кэшем по округленным координатам. None при ошибке или если города нет"""
+    key = cache_key(lat, lng)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached or None  # '' - Nominatim города не нашел, повторно не спрашиваем
+    try:
+        location = Nominatim(user_agent='tailand_app', timeout=NOMINATIM_TIMEOUT).reverse(
+            (round(lat, COORDINATE_PRECISION), round(lng, COORDINATE_PRECISION)), language='en')
+    except GeopyError:
+        return None  # ошибку сети не кэшируем
+    address = location.raw.get('address', {}) if location else {}
+    city = address.get('city') or address.get('town') or address.get('village') or ''
+    cache.set(key, city, CACHE_TIMEOUT)
+    return city or None
+
+
+def resolve_later(instance):
+    """Если локально город не нашелся, после коммита ставит в очередь поиск через Nominatim (если он включен)"""
+    if instance.location or not settings.GEOCODER_NOMINATIM_FALLBACK:
+        return
+    if parse_point(instance.latitude, instance.longitude) is None:
+        return
+    from .tasks import resolve_location
+    meta = instance._meta
+    pk = instance.pk
+    transaction.on_commit(lambda: resolve_location.delay(meta.app_label, meta.model_name, pk))
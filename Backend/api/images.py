@@ -0,0 +1,136 @@
+"""
+Уменьшенные варианты загруженных картинок (фото объектов, обложки, новости, аватары).
+Генерируются в celery (tasks.generate_image_variants) после сохранения модели, файлы сохраняются
+в default_storage (одинаковые копии - один файл, см. storage.py), а их пути и размеры - в JSON-поле модели:
+{'source': имя оригинала, 'original': {'width', 'height', 'size', 'blurhash'},
+ 'thumb': {'width', 'height', 'webp', 'jpeg'}, 'card': {...}, 'full': {...}}
+Размеры оригинала и blurhash нужны клиентам, чтобы разметить галерею и показать заглушку до загрузки картинки
+"""
+import io
+import math
+import os
+
+import numpy as np
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# вариант -> максимальная сторона в пикселях; меньшие оригиналы не увеличиваются
+VARIANTS = {
+    'thumb': 320,   # карточка в списке
+    'card': 800,    # экран объекта
+    'full': 1600,   # просмотр фото на весь экран
+}
+FORMATS = {'webp': ('WEBP', {'quality': 80, 'method': 4}), 'jpeg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True})}
+VARIANTS_DIR = 'variants'
+BLURHASH_COMPONENTS = (4, 3)   # по горизонтали и вертикали
+BLURHASH_SIZE = 32             # blurhash считается по уменьшенной до 32 px копии
+BASE83 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+
+
+def variant_name(source, variant, extension):
+    stem = os.path.splitext(os.path.basename(source))[0]
+    return f'{VARIANTS_DIR}/{stem}_{variant}.{extension}'
+
+
+def base83(value, length):
+    return ''.join(BASE83[value // 83 ** (length - 1 - i) % 83] for i in range(length))
+
+
+def srgb_to_linear(values):
+    values = values / 255
+    return np.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(value):
+    value = min(max(value, 0.0), 1.0)
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def blurhash(image, components=BLURHASH_COMPONENTS):
+    """Строка blurhash (https://blurha.sh): косинусное разложение цвета в несколько компонент"""
+    image = image.convert('RGB')  # копия; оттенки серого и прочие режимы - в три канала
+    image.thumbnail((BLURHASH_SIZE, BLURHASH_SIZE))
+    pixels = srgb_to_linear(np.asarray(image, dtype=np.float64))  # (высота, ширина, 3)
+    height, width = pixels.shape[:2]
+    components_x, components_y = components
+
+    basis_x = np.cos(np.pi * np.outer(np.arange(components_x), np.arange(width)) / width)
+    basis_y = np.cos(np.pi * np.outer(np.arange(components_y), np.arange(height)) / height)
+    # factors[j, i] = сумма по пикселям basis_y[j, y] * basis_x[i, x] * цвет[y, x]
+    factors = np.einsum('jy,ix,yxc->jic', basis_y, basis_x, pixels) / (width * height)
+    factors[1:] *= 2
+    factors[0, 1:] *= 2
+    factors = factors.reshape(-1, 3)
+    dc, ac = factors[0], factors[1:]
+
+    result = base83(components_x - 1 + (components_y - 1) * 9, 1)
+    if len(ac):
+        quantised_max = max(0, min(82, math.floor(np.abs(ac).max() * 166 - 0.5)))
+        maximum = (quantised_max + 1) / 166
+    else:
+        quantised_max, maximum = 0, 1
+    result += base83(quantised_max, 1)
+    result += base83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    quantised = np.clip(np.floor(np.sign(ac) * np.sqrt(np.abs(ac / maximum)) * 9 + 9.5), 0, 18).astype(int)
+    for r, g, b in quantised:
+        result += base83(r * 19 * 19 + g * 19 + b, 2)
+    return result
+
+
+def generate_variants(field_file):
+    """Создает файлы всех вариантов картинки и возвращает описание для JSON-поля"""
+    field_file.open('rb')
+    try:
+        image = ImageOps.exif_transpose(Image.open(field_file))
+        image.load()
+    finally:
+        field_file.close()
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    variants = {
+        'source': field_file.name,
+        'original': {'width': image.width, 'height': image.height, 'size': field_file.size, 'blurhash': blurhash(image)},
+    }
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail((size, size), Image.LANCZOS)
+        variants[variant] = {'width': resized.width, 'height': resized.height}
+        for extension, (image_format, options) in FORMATS.items():
+            buffer = io.BytesIO()
+            resized.save(buffer, image_format, **options)
+            name = variant_name(field_file.name, variant, extension)
+            variants[variant][extension] = default_storage.save(name, ContentFile(buffer.getvalue()))
+    return variants
+
+
+def variant_files(variants):
+    """Имена файлов всех вариантов из описания"""
+    return {info[extension] for variant, info in (variants or {}).items() if variant in VARIANTS
+            for extension in FORMATS if extension in info}
+
+
+def image_meta(variants):
+    """Размеры, вес в байтах и blurhash оригинала; None, пока не посчитаны"""
+    return (variants or {}).get('original')
+
+
+def variant_urls(variants, names, request=None):
+    """
+    Варианты names с url вместо путей; None, если варианты еще не готовы
+    (тогда клиент берет оригинал из поля картинки)
+    """
+    if not variants or not all(name in variants for name in names):
+        return None
+    result = {}
+    for name in names:
+        info = variants[name]
+        urls = {extension: default_storage.url(info[extension]) for extension in FORMATS}
+        if request is not None:
+            urls = {extension: request.build_absolute_uri(url) for extension, url in urls.items()}
+        result[name] = {'width': info['width'], 'height': info['height'], **urls}
+    return result
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from api.uploads import SESSION_TTL, delete_session, expired_sessions
+
+
+class Command(BaseCommand):
+    """Удаление загрузок частями, которые не докачали или не прикрепили к объекту за SESSION_TTL, вместе с файлами"""
+    help = 'Очистка брошенных загрузок фото'
+
+    def handle(self, *args, **options):
+        deleted = 0
+        for session in expired_sessions().iterator():
+            delete_session(session)
+            deleted += 1
+        self.stdout.write(f'удалено загрузок старше {SESSION_TTL}: {deleted}')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.media_gc import GRACE_PERIOD, collect
+
+
+class Command(BaseCommand):
+    """Удаление файлов media, на которые не ссылается ни одна модель (см. api/media_gc.py). По расписанию то же делает celery beat"""
+    help = 'Сборка неиспользуемых файлов media'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только отчет, без удаления')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--min-age', type=int, default=GRACE_PERIOD, help='не трогать файлы моложе, сек')
+
+    def handle(self, *args, **options):
+        report = collect(dry_run=options['dry_run'], batch_size=options['batch_size'], min_age=options['min_age'])
+        for name in report['examples']:
+            self.stdout.write(f'  {name}')
+        self.stdout.write(f"просмотрено файлов: {report['scanned']}, неиспользуемых: {report['orphans']} "
+                          f"({report['orphan_bytes'] / 1024 ** 2:.1f} MB), удалено: {report['deleted']}")
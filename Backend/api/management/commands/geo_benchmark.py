@@ -0,0 +1,70 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.filters import distance_expression
+from api.geo import bounding_box, SpatialIndex
+from api.models import Hotel
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк гео-поиска: точное расстояние по всем строкам, прямоугольный префильтр
+    по индексу (latitude, longitude) и индекс в памяти (geo.py) с догрузкой объектов по id.
+    Синтетические отели создаются внутри транзакции и откатываются в конце
+    """
+    help = 'Сравнение вариантов гео-поиска на синтетических точках'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--points', type=int, default=100000)
+        parser.add_argument('--radius', type=float, default=10, help='радиус поиска, км')
+        parser.add_argument('--queries', type=int, default=50)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        # примерно территория Таиланда
+        lat_range, lng_range = (5.6, 20.5), (97.3, 105.6)
+        with transaction.atomic():
+            Hotel.objects.bulk_create(
+                (Hotel(name=f'bench {i}', description='', status=True,
+                       latitude=rng.uniform(*lat_range), longitude=rng.uniform(*lng_range))
+                 for i in range(options['points'])),
+                batch_size=5000,
+            )
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Hotel._meta.db_table}')
+
+            points = [(rng.uniform(*lat_range), rng.uniform(*lng_range)) for _ in range(options['queries'])]
+            radius = options['radius']
+
+            def full_scan(lat, lng):
+                return list(Hotel.objects.annotate(distance=distance_expression(lat, lng))
+                            .filter(distance__lte=radius).order_by('distance').values_list('id', flat=True)[:20])
+
+            def prefiltered(lat, lng):
+                lat_box, lng_box = bounding_box(lat, lng, radius)
+                return list(Hotel.objects.filter(latitude__range=lat_box, longitude__range=lng_box)
+                            .annotate(distance=distance_expression(lat, lng))
+                            .filter(distance__lte=radius).order_by('distance').values_list('id', flat=True)[:20])
+
+            index = SpatialIndex(Hotel)
+            index.get_arrays()  # загрузка индекса не входит в замер
+
+            def in_memory(lat, lng):
+                found = index.radius(lat, lng, radius, limit=20)
+                hotels = Hotel.objects.in_bulk([pk for pk, _ in found])
+                return [hotels[pk].id for pk, _ in found if pk in hotels]
+
+            def in_memory_ids(lat, lng):
+                return index.radius(lat, lng, radius, limit=20)
+
+            for name, search in (('full scan', full_scan), ('bounding box', prefiltered),
+                                 ('index + db', in_memory), ('index only', in_memory_ids)):
+                started = time.perf_counter()
+                found = sum(len(search(lat, lng)) for lat, lng in points)
+                elapsed = (time.perf_counter() - started) * 1000 / len(points)
+                self.stdout.write(f'{name:>14}: {elapsed:8.2f} ms/query, found {found}')
+
+            transaction.set_rollback(True)
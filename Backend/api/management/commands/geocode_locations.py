@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api import cache as catalog_cache
+from api.cities import recount
+from api.geocoder import get_city, resolve_later
+from api.models import CATALOG_MODELS, City
+
+
+class Command(BaseCommand):
+    """
+    Заполнение location объектов каталога по координатам из локального справочника (api/geocoder.py).
+    Обрабатываются объекты без города, в том числе со строкой "None", которую раньше сохраняли
+    при таймауте Nominatim. Объекты, которые справочник не знает, при включенном
+    GEOCODER_NOMINATIM_FALLBACK отправляются в celery
+    """
+    help = 'Определение городов объектов каталога по координатам'
+
+    def handle(self, *args, **options):
+        for model in CATALOG_MODELS:
+            objects = model.objects.filter(Q(location__isnull=True) | Q(location__in=('', 'None')))
+            objects.filter(location__in=('', 'None')).update(location=None, city=None)
+            resolved = unresolved = 0
+            for instance in objects.filter(latitude__isnull=False, longitude__isnull=False).only('latitude', 'longitude', 'location'):
+                city = get_city(instance.latitude, instance.longitude)
+                if city:
+                    model.objects.filter(pk=instance.pk).update(location=city, city_id=City.objects.resolve(city))
+                    resolved += 1
+                else:
+                    resolve_later(instance)
+                    unresolved += 1
+            catalog_cache.invalidate(model)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: найдено {resolved}, не найдено {unresolved}')
+        recount()  # update() не вызывает сигналов, счетчики городов пересчитываются целиком
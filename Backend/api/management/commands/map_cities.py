@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from api.cities import load_cities, map_locations, recount
+from api.models import CATALOG_MODELS
+
+
+class Command(BaseCommand):
+    """
+    Заполнение справочника городов и привязка к нему объектов каталога по location
+    (вместо data-миграции, миграции в репозитории не хранятся). Повторный запуск безопасен:
+    обновляются только объекты с другим городом, счетчики пересчитываются целиком
+    """
+    help = 'Справочник городов из CSV, привязка объектов по location и пересчет счетчиков'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create-missing', action='store_true',
+                            help='создать города для строк location, которых нет в справочнике')
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'новых городов из CSV: {load_cities()}')
+        for model in CATALOG_MODELS:
+            unmapped = map_locations(model, options['create_missing'])
+            self.stdout.write(f'{model._meta.verbose_name_plural}: не найдено строк {len(unmapped)}')
+            for location, count in sorted(unmapped.items(), key=lambda item: -item[1])[:20]:
+                self.stdout.write(f'  {location!r}: {count}')
+        recount()
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from api import favorite_cache
+from api.favorites import ITEM_FIELDS, recount_folders
+from api.models import Favorite, FavoriteItem
+
+
+class Command(BaseCommand):
+    """
+    Перенос избранного из m2m-таблиц Favorite в FavoriteItem (вместо data-миграции, миграции
+    в репозитории не хранятся). Повторный запуск безопасен: уже перенесенные строки пропускает
+    уникальный индекс, счетчики папок пересчитываются по FavoriteItem
+    """
+    help = 'Перенос избранного из m2m-полей Favorite в таблицу FavoriteItem и пересчет countFavorites'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        users = set()
+        for item_type, field_name in ITEM_FIELDS.items():
+            through = Favorite._meta.get_field(field_name).remote_field.through
+            rows = (through.objects.filter(favorite__folder__isnull=False).order_by('id')
+                    .values_list('favorite__user_id', 'favorite__folder_id', f'{item_type}_id'))
+            batch, total = [], 0
+            for user_id, folder_id, item_id in rows.iterator(chunk_size=batch_size):
+                batch.append(FavoriteItem(user_id=user_id, folder_id=folder_id, item_type=item_type, item_id=item_id))
+                users.add(user_id)
+                if len(batch) >= batch_size:
+                    total += len(FavoriteItem.objects.bulk_create(batch, ignore_conflicts=True))
+                    batch = []
+            total += len(FavoriteItem.objects.bulk_create(batch, ignore_conflicts=True))
+            self.stdout.write(f'{field_name}: обработано строк {total}')
+
+        skipped = Favorite.objects.filter(folder__isnull=True).count()
+        if skipped:
+            self.stdout.write(f'записей Favorite без папки (не перенесены): {skipped}')
+        self.stdout.write(f'исправлено счетчиков папок: {recount_folders()}')
+        for user_id in users:
+            favorite_cache.bump_version(user_id)
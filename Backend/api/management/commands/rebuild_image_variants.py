@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api.models import IMAGE_VARIANT_FIELDS
+from api.tasks import generate_image_variants
+
+
+class Command(BaseCommand):
+    """
+    Постановка в очередь генерации вариантов, размеров и blurhash для картинок, у которых их еще нет
+    (загруженных до появления этих полей). Сами картинки обрабатывает celery
+    """
+    help = 'Генерация вариантов и метаданных для уже загруженных картинок'
+
+    def handle(self, *args, **options):
+        for model, (field_name, variants_field) in IMAGE_VARIANT_FIELDS.items():
+            meta = model._meta
+            ids = (model.objects.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                   .exclude(**{f'{variants_field}__has_key': 'original'}).values_list('pk', flat=True))
+            scheduled = 0
+            for pk in ids.iterator():
+                generate_image_variants.delay(meta.app_label, meta.model_name, pk, field_name, variants_field)
+                scheduled += 1
+            self.stdout.write(f'{meta.verbose_name_plural}: {scheduled}')
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from api.models import REVIEW_TARGETS, Review, rating_average
+
+
+class Command(BaseCommand):
+    """
+    Пересчет review_count, rating_sum и rate по отзывам: заполнение после добавления колонок
+    и исправление расхождений. Обновляются только объекты, у которых агрегаты не совпадают с отзывами
+    """
+    help = 'Пересчет агрегатов отзывов у отелей, ресторанов и экскурсий'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='только показать число расхождений')
+
+    def handle(self, *args, **options):
+        for model, field in REVIEW_TARGETS.items():
+            reviews = Review.objects.filter(**{field: OuterRef('pk')}).order_by().values(field)
+            count = Coalesce(Subquery(reviews.annotate(count=Count('id')).values('count')), Value(0))
+            total = Coalesce(Subquery(reviews.annotate(total=Sum('rating')).values('total')), Value(0))
+
+            drifted = (model.objects.alias(actual_count=count, actual_total=total)
+                       .filter(~Q(review_count=F('actual_count')) | ~Q(rating_sum=F('actual_total'))))
+            ids = list(drifted.values_list('id', flat=True))
+            if ids and not options['dry_run']:
+                model.objects.filter(id__in=ids).update(
+                    review_count=count, rating_sum=total, rate=rating_average(count, total))
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {len(ids)} с расхождениями')
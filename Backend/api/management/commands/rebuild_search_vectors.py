@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api.models import CATALOG_MODELS
+from api.search import search_vector
+
+
+class Command(BaseCommand):
+    """
+    Заполнение search_vector у существующих объектов каталога (после добавления колонки
+    или смены конфигураций поиска). Обновление идет диапазонами id, чтобы не держать долгие блокировки
+    """
+    help = 'Пересчет полнотекстовых векторов объектов каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model in CATALOG_MODELS:
+            last_id = model.objects.aggregate(last=Max('id'))['last'] or 0
+            updated = 0
+            for start in range(0, last_id + 1, batch_size):
+                updated += (model.objects.filter(id__gte=start, id__lt=start + batch_size)
+                            .update(search_vector=search_vector()))
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {updated}')
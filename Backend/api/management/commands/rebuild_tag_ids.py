@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from api import cache as catalog_cache
+from api.models import TAG_ID_FIELDS, sync_tag_ids
+
+
+class Command(BaseCommand):
+    """
+    Заполнение колонок с id значений m2m-полей (models.TAG_ID_FIELDS) у существующих объектов:
+    после добавления колонок или для исправления расхождений. Обновление идет диапазонами id
+    """
+    help = 'Пересчет массивов id удобств, кухонь и прочих m2m-значений у объектов каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        for model, fields in TAG_ID_FIELDS.items():
+            last_id = model.objects.aggregate(last=Max('id'))['last'] or 0
+            for start in range(0, last_id + 1, batch_size):
+                pks = model.objects.filter(id__gte=start, id__lt=start + batch_size).values('id')
+                for name in fields:
+                    sync_tag_ids(model, name, pks)
+            catalog_cache.invalidate(model)
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {", ".join(fields.values())}')
@@ -0,0 +1,64 @@
+import random
+import time
+
+from django.contrib.postgres.search import SearchRank
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import F, Q
+
+from api.models import Hotel
+from api.search import search_query, search_vector
+
+WORDS = ('пляж', 'море', 'отель', 'бассейн', 'семейный', 'тихий', 'центр', 'вид', 'спа', 'завтрак',
+         'beach', 'resort', 'pool', 'villa', 'family', 'quiet', 'ocean', 'view', 'garden', 'breakfast')
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк полнотекстового поиска: icontains по названию и описанию (последовательное чтение)
+    против search_vector с GIN-индексом и сортировкой по релевантности.
+    Синтетические отели создаются внутри транзакции и откатываются в конце
+    """
+    help = 'Сравнение icontains и полнотекстового поиска на синтетических объектах'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=300000)
+        parser.add_argument('--queries', type=int, default=30)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+
+        def text(count):
+            return ' '.join(rng.choice(WORDS) for _ in range(count)) + f' {rng.randrange(10 ** 6):06d}'
+
+        with transaction.atomic():
+            Hotel.objects.bulk_create(
+                (Hotel(name=text(3), description=text(30), status=True) for _ in range(options['rows'])),
+                batch_size=5000,
+            )
+            Hotel.objects.update(search_vector=search_vector())
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Hotel._meta.db_table}')
+
+            # слово + начало числа: последнее слово ищется по префиксу, как при наборе
+            terms = [f'{rng.choice(WORDS)} {rng.randrange(10 ** 6):06d}'[:-2] for _ in range(options['queries'])]
+
+            def icontains(term):
+                queryset = Hotel.objects.all()
+                for word in term.split():
+                    queryset = queryset.filter(Q(name__icontains=word) | Q(description__icontains=word))
+                return list(queryset.order_by('-rate', '-id').values_list('id', flat=True)[:20])
+
+            def full_text(term):
+                query = search_query(term)
+                return list(Hotel.objects.filter(search_vector=query)
+                            .annotate(rank=SearchRank(F('search_vector'), query))
+                            .order_by('-rank', '-id').values_list('id', flat=True)[:20])
+
+            for name, search in (('icontains', icontains), ('full text', full_text)):
+                started = time.perf_counter()
+                found = sum(len(search(term)) for term in terms)
+                elapsed = (time.perf_counter() - started) * 1000 / len(terms)
+                self.stdout.write(f'{name:>10}: {elapsed:8.2f} ms/query, found {found}')
+
+            transaction.set_rollback(True)
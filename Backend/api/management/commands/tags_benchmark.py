@@ -0,0 +1,72 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.filters import filter_by_tags
+from api.models import Facilities, Hotel, sync_tag_ids
+
+
+class Command(BaseCommand):
+    """
+    Бенчмарк фильтра "есть все выбранные удобства": цепочка JOIN по through-таблице на каждое
+    значение (как было в HotelFilter) против одного условия @> по GIN-индексу facilities_ids.
+    Синтетические отели и связи создаются внутри транзакции и откатываются в конце
+    """
+    help = 'Сравнение фильтра по m2m через JOIN и через массив id'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--values', type=int, default=40, help='число разных удобств')
+        parser.add_argument('--per-row', type=int, default=8, help='максимум удобств у отеля')
+        parser.add_argument('--queries', type=int, default=30)
+
+    def handle(self, *args, **options):
+        rng = random.Random(42)
+        with transaction.atomic():
+            facilities = Facilities.objects.bulk_create(Facilities(name=f'bench {i}') for i in range(options['values']))
+            facility_ids = [facility.id for facility in facilities]
+            hotels = Hotel.objects.bulk_create(
+                (Hotel(name=f'bench {i}', description='', status=True, rate=rng.uniform(0, 5))
+                 for i in range(options['rows'])),
+                batch_size=5000,
+            )
+            through = Hotel.facilities.through
+            # популярные удобства встречаются чаще: выборка с весами ~ 1/ранг
+            weights = [1 / (rank + 1) for rank in range(len(facility_ids))]
+            through.objects.bulk_create(
+                (through(hotel_id=hotel.id, facilities_id=facility_id)
+                 for hotel in hotels
+                 for facility_id in set(rng.choices(facility_ids, weights, k=rng.randint(0, options['per_row'])))),
+                batch_size=10000,
+            )
+            sync_tag_ids(Hotel, 'facilities', Hotel.objects.values('id'))
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Hotel._meta.db_table}')
+                cursor.execute(f'ANALYZE {through._meta.db_table}')
+
+            selections = [[str(facility_id) for facility_id in rng.sample(facility_ids[:10], rng.randint(1, 5))]
+                          for _ in range(options['queries'])]
+
+            def joins(selected):
+                queryset = Hotel.objects.filter(status=True)
+                for i in selected:
+                    queryset = queryset.filter(facilities__id__in=[i])
+                return list(queryset.order_by('-rate', '-id').values_list('id', flat=True)[:20])
+
+            def contains(selected):
+                queryset = filter_by_tags(Hotel.objects.filter(status=True), 'facilities', selected)
+                return list(queryset.order_by('-rate', '-id').values_list('id', flat=True)[:20])
+
+            results = {}
+            for name, search in (('joins', joins), ('contains', contains)):
+                started = time.perf_counter()
+                results[name] = [search(selected) for selected in selections]
+                elapsed = (time.perf_counter() - started) * 1000 / len(selections)
+                found = sum(map(len, results[name]))
+                self.stdout.write(f'{name:>10}: {elapsed:8.2f} ms/query, found {found}')
+            if results['joins'] != results['contains']:
+                self.stderr.write('результаты различаются')
+
+            transaction.set_rollback(True)
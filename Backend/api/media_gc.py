@@ -0,0 +1,99 @@
+"""
+Сборщик неиспользуемых файлов media. Файл считается используемым, если на него ссылается
+любое FileField/ImageField любой модели или JSON-описание уменьшенных копий (images.py).
+Каталоги со своим жизненным циклом (копии по запросу resize.py, недокачанные загрузки uploads.py)
+не просматриваются. Свежие файлы (моложе GRACE_PERIOD) не удаляются: ссылка на только что
+сохраненный файл может быть еще не закоммичена
+"""
+import os
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import models
+
+from .images import variant_files
+from .models import IMAGE_VARIANT_FIELDS
+from .resize import RESIZE_DIR
+from .uploads import UPLOAD_DIR
+
+GRACE_PERIOD = 24 * 60 * 60  # сек
+SKIP_DIRS = (RESIZE_DIR, UPLOAD_DIR)
+
+
+def file_fields():
+    """(модель, имя поля) для всех файловых полей проекта"""
+    return [(model, model_field.name) for model in apps.get_models() for model_field in model._meta.concrete_fields
+            if isinstance(model_field, models.FileField)]
+
+
+def referenced_names():
+    """Имена всех файлов, на которые есть ссылки в БД"""
+    names = set()
+    for model, field_name in file_fields():
+        names.update(model._default_manager.exclude(**{field_name: ''}).exclude(**{f'{field_name}__isnull': True})
+                     .values_list(field_name, flat=True).distinct().iterator())
+    for model, (_, variants_field) in IMAGE_VARIANT_FIELDS.items():
+        for variants in model._default_manager.exclude(**{variants_field: {}}).values_list(variants_field, flat=True).iterator():
+            names.update(variant_files(variants))
+    return names
+
+
+def still_referenced(batch):
+    """Какие из имен batch успели получить ссылку после снимка referenced_names (файлы из JSON не проверяются)"""
+    found = set()
+    for model, field_name in file_fields():
+        found.update(model._default_manager.filter(**{f'{field_name}__in': batch}).values_list(field_name, flat=True))
+    return found
+
+
+def media_files(root, min_age):
+    """(имя относительно root, размер) файлов старше min_age секунд"""
+    deadline = time.time() - min_age
+    for directory, subdirectories, files in os.walk(root):
+        if directory == root:
+            subdirectories[:] = [name for name in subdirectories if name not in SKIP_DIRS]
+        for name in files:
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < deadline:
+                yield os.path.relpath(path, root).replace(os.sep, '/'), stat.st_size
+
+
+def collect(dry_run=False, batch_size=500, min_age=GRACE_PERIOD, report_limit=20):
+    """
+    Находит неиспользуемые файлы и удаляет их пачками по batch_size (в dry_run - только отчет).
+    Перед удалением пачки ссылки на ее файлы проверяются еще раз
+    """
+    report = {'scanned': 0, 'orphans': 0, 'orphan_bytes': 0, 'deleted': 0, 'examples': []}
+    referenced = referenced_names()
+    batch = []
+
+    def flush():
+        fresh = set() if dry_run else still_referenced([name for name, _ in batch])
+        for name, size in batch:
+            if name in fresh:
+                continue
+            report['orphans'] += 1
+            report['orphan_bytes'] += size
+            if len(report['examples']) < report_limit:
+                report['examples'].append(name)
+            if not dry_run:
+                default_storage.delete(name)
+                report['deleted'] += 1
+        batch.clear()
+
+    for name, size in media_files(settings.MEDIA_ROOT, min_age):
+        report['scanned'] += 1
+        if name in referenced:
+            continue
+        batch.append((name, size))
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    return report
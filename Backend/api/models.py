@@ -1,10 +1,22 @@
-from django.db import models
-from django.db.models.signals import pre_save, post_save, pre_delete
+from django.db import models, transaction
+from django.db.models import Count, F, FloatField, Func, OuterRef, Value
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.core.validators import RegexValidator
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex, OpClass
+from django.db.models.functions import Cast, Coalesce, NullIf, Upper
+from django.contrib.postgres.expressions import ArraySubquery
+from django.contrib.postgres.search import SearchVectorField
 
 import datetime
+import uuid
 from .validators import TimeFormatValidator
+from . import cache as catalog_cache
+from . import favorite_cache
+from . import geo
+from . import search
+from .tasks import generate_image_variants
 
 from users.models import User
 from chat.models import Room
@@ -26,6 +38,7 @@ class News(models.Model):
     content = models.TextField()
     date_created = models.DateField(null=True, blank=True)
     image = models.ImageField(null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)  # уменьшенные копии, см. images.py
 
     def __str__(self):
         return self.title
@@ -92,6 +105,19 @@ class RentalServices(models.Model):
 
 class Photo(models.Model):
     photo = models.ImageField()
+    variants = models.JSONField(default=dict, blank=True, editable=False)  # уменьшенные копии, см. images.py
+
+
+class UploadSession(models.Model):
+    """Загрузка фото частями с докачкой (uploads.py). После последней части файл лежит в file"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()  # размер всего файла в байтах
+    checksum = models.CharField(max_length=64, blank=True)  # sha256 всего файла (hex), если клиент его передал
+    offset = models.PositiveBigIntegerField(default=0)  # сколько байт уже получено
+    file = models.ImageField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
 
 
 class WorkingHours(models.Model):
@@ -115,6 +141,50 @@ class WorkingHours(models.Model):
         #     return Restaurant.objects.filter(workingDays=self).name
 
 
+def normalize_city_name(name):
+    """Ключ для сравнения названий городов: нижний регистр, без лишних пробелов"""
+    return ' '.join(str(name).split()).lower()
+
+
+class CityManager(models.Manager):
+
+    def resolve(self, name):
+        """id города по названию или алиасу на любом языке (один запрос по GIN-индексу aliases) или None"""
+        key = normalize_city_name(name or '')
+        if not key or key == 'none':  # 'None' раньше сохраняли вместо пустого города
+            return None
+        return self.filter(aliases__contains=[key]).values_list('id', flat=True).first()
+
+
+class City(models.Model):
+    """
+    Справочник городов. Объекты каталога ссылаются на город через city, текст location
+    остается в ответах API. Счетчики - число опубликованных объектов каждого типа,
+    меняются на разницу при сохранении и удалении объектов (update_city_counts)
+    """
+    name = models.CharField(max_length=50, unique=True)
+    aliases = ArrayField(models.CharField(max_length=50), default=list, blank=True)  # названия на разных языках, в нормализованном виде, включая name
+    latitude = models.FloatField(null=True, blank=True)
+    longitude = models.FloatField(null=True, blank=True)
+    hotel_count = models.IntegerField(default=0, editable=False)
+    restaurant_count = models.IntegerField(default=0, editable=False)
+    transport_count = models.IntegerField(default=0, editable=False)
+    excursion_count = models.IntegerField(default=0, editable=False)
+
+    objects = CityManager()
+
+    class Meta:
+        ordering = ['name']
+        indexes = [GinIndex(fields=['aliases'])]
+
+    def save(self, *args, **kwargs):
+        self.aliases = list(dict.fromkeys(normalize_city_name(alias) for alias in [self.name, *self.aliases] if alias))
+        super().save(*args, **kwargs)
+
+    def __str__(self):
+        return self.name
+
+
 class Hotel(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
@@ -122,14 +192,21 @@ class Hotel(models.Model):
     chat_room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True, blank=True)
     promotion = models.BooleanField(default=False)
     image = models.ImageField(null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     photos = models.ManyToManyField(Photo, blank=True, related_name='hotel_images')
     rate = models.FloatField(default=0)
+    review_count = models.IntegerField(default=0, editable=False)  # агрегаты отзывов, rate = rating_sum / review_count (см. Review.save)
+    rating_sum = models.IntegerField(default=0, editable=False)
     cost = models.IntegerField(default=0)
     cost_kids = models.IntegerField(default=0)
     location = models.CharField(max_length=50, null=True, blank=True)
+    city = models.ForeignKey(City, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')  # по location, см. set_city
     type_room = models.ManyToManyField(TypeRoom, blank=True)
     facilities = models.ManyToManyField(Facilities, blank=True)
     services = models.ManyToManyField(Service, blank=True)
+    type_room_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)  # копии id из m2m для фильтра "есть все выбранные", см. sync_tag_ids
+    facilities_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
+    services_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
     countBeds = models.IntegerField(default=0)
     latitude = models.FloatField(null=True, blank=True, verbose_name='широта')  # широта
     longitude = models.FloatField(null=True, blank=True, verbose_name='долгота')  # долгота
@@ -145,14 +222,28 @@ class Hotel(models.Model):
     )
     workingDays = models.ForeignKey(WorkingHours, null=True, blank=True, on_delete=models.DO_NOTHING)
     status = models.BooleanField(default=False)
+    search_vector = SearchVectorField(null=True, editable=False)  # полнотекстовый поиск, см. search.py
 
     def __str__(self):
         return self.name
-    
+
+    class Meta:
+        indexes = [  # под курсорную пагинацию списков: status=True + сортировка по (rate, id) / (cost, id)
+            models.Index(fields=['status', 'rate', 'id']),
+            models.Index(fields=['status', 'cost', 'id']),
+            models.Index(fields=['latitude', 'longitude']),  # прямоугольный префильтр гео-поиска
+            GinIndex(fields=['search_vector']),
+            GinIndex(fields=['type_room_ids']),
+            GinIndex(fields=['facilities_ids']),
+            GinIndex(fields=['services_ids']),
+            # триграммы для icontains и нечеткого поиска, выражение совпадает с тем, что генерирует icontains
+            GinIndex(OpClass(Upper('location'), name='gin_trgm_ops'), name='hotel_location_trgm'),
+        ]
+
 
 @receiver(pre_delete, sender=Hotel)
 def delete_hotel_photos(sender, instance, **kwargs):
-    """Сигнал для удаления связанных фоток"""
+    """Сигнал для удаления связанных фоток (сами файлы могут быть общими, их удаляет сборщик media_gc)"""
     instance.photos.all().delete()
 
 
@@ -163,13 +254,19 @@ class Restaurant(models.Model):
     owner = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     promotion = models.BooleanField(default=False)
     image = models.ImageField(null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     photos = models.ManyToManyField(Photo, blank=True, related_name='restaurant_images')
     rate = models.FloatField(default=0)
+    review_count = models.IntegerField(default=0, editable=False)
+    rating_sum = models.IntegerField(default=0, editable=False)
     cost = models.IntegerField(default=0)
     cost_kids = models.IntegerField(default=0)
     location = models.CharField(max_length=50, null=True, blank=True)
+    city = models.ForeignKey(City, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')  # по location, см. set_city
     features = models.ManyToManyField(Features, blank=True, related_name='features_restaurant')
     kitchen = models.ManyToManyField(Kitchen, blank=True, related_name='kitchen_restaurant')
+    features_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)  # см. TAG_ID_FIELDS
+    kitchen_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
     latitude = models.FloatField(null=True, blank=True, verbose_name='широта')  # широта
     longitude = models.FloatField(null=True, blank=True, verbose_name='долгота')  # долгота
     phone_regex = RegexValidator(
@@ -184,10 +281,22 @@ class Restaurant(models.Model):
     )
     workingDays = models.ForeignKey(WorkingHours, null=True, blank=True, on_delete=models.DO_NOTHING)
     status = models.BooleanField(default=False) # поле статус, одобрен ли объект администратором
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.name
-    
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'rate', 'id']),
+            models.Index(fields=['status', 'cost', 'id']),
+            models.Index(fields=['latitude', 'longitude']),
+            GinIndex(fields=['search_vector']),
+            GinIndex(fields=['features_ids']),
+            GinIndex(fields=['kitchen_ids']),
+            GinIndex(OpClass(Upper('location'), name='gin_trgm_ops'), name='restaurant_location_trgm'),
+        ]
+
 
 @receiver(pre_delete, sender=Restaurant)
 def delete_restaurant_photos(sender, instance, **kwargs):
@@ -198,9 +307,11 @@ class Transport(models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField()
     image = models.ImageField(null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     photos = models.ManyToManyField(Photo, blank=True, related_name='transport_images')
     rate = models.FloatField(default=0)
     location = models.CharField(max_length=50, null=True, blank=True)
+    city = models.ForeignKey(City, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')  # по location, см. set_city
     promotion = models.BooleanField(default=False)
     RentalServices = models.ManyToManyField(RentalServices, blank=True, related_name='rental_services')
     cost = models.IntegerField(default=0)
@@ -209,10 +320,21 @@ class Transport(models.Model):
     workingDays = models.ForeignKey(WorkingHours, null=True, blank=True, on_delete=models.DO_NOTHING)
     status = models.BooleanField(default=False) # поле статус, одобрен ли объект администратором
     owner = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return self.name
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'rate', 'id']),
+            models.Index(fields=['status', 'cost', 'id']),
+            models.Index(fields=['latitude', 'longitude']),
+            GinIndex(fields=['search_vector']),
+            GinIndex(OpClass(Upper('location'), name='gin_trgm_ops'), name='transport_location_trgm'),
+            GinIndex(OpClass(Upper('name'), name='gin_trgm_ops'), name='transport_name_trgm'),
+        ]
+
 
 @receiver(pre_delete, sender=Transport)
 def delete_transport_photos(sender, instance, **kwargs):
@@ -233,7 +355,8 @@ class TripFolder(models.Model):
 
 class Favorite(models.Model):
     """
-    Модель избранного
+    Модель избранного: запись на папку пользователя. Сами объекты папки хранятся в FavoriteItem,
+    m2m-поля остались от старой схемы и читаются только командой migrate_favorites
     """
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     hotels = models.ManyToManyField(Hotel, null=True, blank=True)
@@ -246,6 +369,30 @@ class Favorite(models.Model):
         return f'{self.user.username}'
 
 
+class FavoriteItem(models.Model):
+    """
+    Объект в папке избранного, одна строка на объект. Тип - имя модели каталога (favorites.ITEM_FIELDS),
+    так что проверка, добавление и удаление - одна операция по уникальному индексу
+    """
+    ITEM_TYPES = (('hotel', 'Отель'), ('restaurant', 'Ресторан'), ('transport', 'Транспорт'), ('excursion', 'Экскурсия'))
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='favorite_items')
+    folder = models.ForeignKey(TripFolder, on_delete=models.CASCADE, related_name='items')
+    item_type = models.CharField(max_length=16, choices=ITEM_TYPES)
+    item_id = models.IntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'folder', 'item_type', 'item_id'], name='favorite_item_unique'),
+        ]
+        indexes = [  # "есть ли объект в избранном" и удаление объекта из всех папок пользователя
+            models.Index(fields=['user', 'item_type', 'item_id']),
+        ]
+
+    def __str__(self):
+        return f'{self.item_type} {self.item_id}'
+
+
 # Создание обработчиков сигналов
 @receiver(post_save, sender=Hotel)
 def create_hotel_chat_room(sender, instance, created, **kwargs):
@@ -255,7 +402,7 @@ def create_hotel_chat_room(sender, instance, created, **kwargs):
     if created:
         room = Room.objects.create(name=f'hotel_{instance.id}', host=instance.owner)
         instance.chat_room = room
-        instance.save()
+        instance.save(update_fields=['chat_room'])
 
 
 @receiver(post_save, sender=Restaurant)
@@ -266,7 +413,7 @@ def create_restaurant_chat_room(sender, instance, created, **kwargs):
     if created:
         room = Room.objects.create(name=f'restaurant_{instance.id}', host=instance.owner)
         instance.chat_room = room
-        instance.save()
+        instance.save(update_fields=['chat_room'])
 
 
 class Inclusive(models.Model):
@@ -294,12 +441,18 @@ class Excursion(models.Model):
     description = models.TextField()
     inclusives = models.ManyToManyField(Inclusive, blank=True)
     conditions = models.ManyToManyField(Conditions, blank=True)
+    inclusives_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)  # см. TAG_ID_FIELDS
+    conditions_ids = ArrayField(models.IntegerField(), default=list, blank=True, editable=False)
     cost = models.IntegerField(default=0)
     cost_kids = models.IntegerField(default=0)
     image = models.ImageField(null=True, blank=True)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     photos = models.ManyToManyField(Photo, blank=True, related_name='excursion_images')
     rate = models.FloatField(default=0)
+    review_count = models.IntegerField(default=0, editable=False)
+    rating_sum = models.IntegerField(default=0, editable=False)
     location = models.CharField(max_length=50, null=True, blank=True)
+    city = models.ForeignKey(City, on_delete=models.SET_NULL, null=True, blank=True, editable=False, related_name='+')  # по location, см. set_city
     promotion = models.BooleanField(default=False)
     chat_room = models.ForeignKey(Room, on_delete=models.CASCADE, null=True, blank=True)
     phone_regex = RegexValidator(
@@ -315,10 +468,22 @@ class Excursion(models.Model):
     status = models.BooleanField(default=False) # поле статус, одобрен ли объект администратором
     latitude = models.FloatField(null=True, blank=True, verbose_name='широта')  # широта
     longitude = models.FloatField(null=True, blank=True, verbose_name='долгота')  # долгота
+    search_vector = SearchVectorField(null=True, editable=False)
 
     def __str__(self):
         return f'Name: {self.name}, owner: {self.owner.username}'
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'rate', 'id']),
+            models.Index(fields=['status', 'cost', 'id']),
+            models.Index(fields=['latitude', 'longitude']),
+            GinIndex(fields=['search_vector']),
+            GinIndex(fields=['inclusives_ids']),
+            GinIndex(fields=['conditions_ids']),
+            GinIndex(OpClass(Upper('location'), name='gin_trgm_ops'), name='excursion_location_trgm'),
+        ]
+
 
 @receiver(post_save, sender=Excursion)
 def create_excursion_chat_room(sender, instance, created, **kwargs):
@@ -328,7 +493,7 @@ def create_excursion_chat_room(sender, instance, created, **kwargs):
     if created:
         room = Room.objects.create(name=f'Excursion_{instance.id}', host=instance.owner)
         instance.chat_room = room
-        instance.save()
+        instance.save(update_fields=['chat_room'])
 
 
 @receiver(pre_delete, sender=Excursion)
@@ -377,27 +542,35 @@ class Review(models.Model):
     comment = models.TextField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [  # лента отзывов объекта и последние отзывы: по (объект, -created_at, -id)
+            models.Index(fields=['hotel', '-created_at', '-id']),
+            models.Index(fields=['restaurant', '-created_at', '-id']),
+            models.Index(fields=['excursion', '-created_at', '-id']),
+        ]
+
     def save(self, *args, **kwargs):
         """
-        Переопределение сохранения для обновления 
-        рейтинга объекта, на который написали отзыв
+        Переопределение сохранения для обновления
+        рейтинга объекта, на который написали отзыв.
+        Агрегаты меняются на разницу одним UPDATE, без чтения остальных отзывов
         """
-        super().save(*args, **kwargs)
-
-        if self.excursion:
-            self.excursion.rate = self.calculate_average_rating(self.excursion.reviewsExcursions.all())
-            self.excursion.save()
-        elif self.restaurant:
-            self.restaurant.rate = self.calculate_average_rating(self.restaurant.reviewsRestaurants.all())
-            self.restaurant.save()
-        elif self.hotel:
-            self.hotel.rate = self.calculate_average_rating(self.hotel.reviewsHotels.all())
-            self.hotel.save()
-
-    def calculate_average_rating(self, reviews):
-        total_rating = sum(review.rating for review in reviews)
-        average_rating = total_rating / len(reviews) if len(reviews) > 0 else 0
-        return average_rating
+        with transaction.atomic():
+            old = None
+            if self.pk:
+                old = (Review.objects.select_for_update().filter(pk=self.pk)
+                       .only('rating', 'hotel', 'restaurant', 'excursion').first())
+            super().save(*args, **kwargs)
+
+            deltas = {}  # (модель, id) -> (изменение числа отзывов, изменение суммы оценок)
+            if old:
+                for model, target in review_targets(old):
+                    deltas[model, target] = (-1, -old.rating)
+            for model, target in review_targets(self):
+                count, total = deltas.get((model, target), (0, 0))
+                deltas[model, target] = (count + 1, total + self.rating)
+            for (model, target), (count, total) in deltas.items():
+                update_rating(model, target, count, total)
 
     def __str__(self):
         if self.excursion:
@@ -410,6 +583,48 @@ class Review(models.Model):
             return f'Review by {self.user.username}'
         
 
+# модель -> поле отзыва со ссылкой на нее
+REVIEW_TARGETS = {Hotel: 'hotel_id', Restaurant: 'restaurant_id', Excursion: 'excursion_id'}
+
+
+def review_targets(review):
+    """[(модель, id)] объектов, к которым относится отзыв"""
+    return [(model, getattr(review, field)) for model, field in REVIEW_TARGETS.items() if getattr(review, field)]
+
+
+def review_histograms(model, ids):
+    """{id объекта: {оценка: число отзывов}} для объектов ids одним запросом"""
+    field = REVIEW_TARGETS[model]
+    rows = (Review.objects.filter(**{f'{field}__in': ids}).order_by()
+            .values_list(field, 'rating').annotate(count=Count('id')))
+    histograms = {}
+    for target, rating, count in rows:
+        histograms.setdefault(target, {})[rating] = count
+    return histograms
+
+
+def rating_average(count, total):
+    return Coalesce(Cast(total, FloatField()) / NullIf(count, Value(0)), Value(0.0))
+
+
+def update_rating(model, pk, count_delta, sum_delta):
+    """
+    Атомарное изменение агрегатов отзывов объекта. В UPDATE справа стоят старые значения
+    колонок, поэтому rate считается от них с учетом той же разницы
+    """
+    if not count_delta and not sum_delta:
+        return
+    count = F('review_count') + count_delta
+    total = F('rating_sum') + sum_delta
+    model.objects.filter(pk=pk).update(review_count=count, rating_sum=total, rate=rating_average(count, total))
+
+
+@receiver(post_delete, sender=Review)
+def remove_review_rating(sender, instance, **kwargs):
+    for model, target in review_targets(instance):
+        update_rating(model, target, -1, -instance.rating)
+
+
 class ApplicationUnblock(models.Model):
     """заявка на разблокировку от пользователя, если его заблокировали"""
     APPLICATION_STATUS = (
@@ -438,3 +653,257 @@ class Info(models.Model):
 
     def __str__(self):
         return f'contact name 1: {self.contact_name_first}, contact phone 1: {self.contact_phone_first}'
+
+
+# модель -> (поле картинки, JSON-поле с ее уменьшенными вариантами), см. images.py
+IMAGE_VARIANT_FIELDS = {
+    Photo: ('photo', 'variants'),
+    Hotel: ('image', 'image_variants'),
+    Restaurant: ('image', 'image_variants'),
+    Transport: ('image', 'image_variants'),
+    Excursion: ('image', 'image_variants'),
+    News: ('image', 'image_variants'),
+    User: ('avatar', 'avatar_variants'),
+}
+
+
+@receiver(post_save, sender=Photo)
+@receiver(post_save, sender=Hotel)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Transport)
+@receiver(post_save, sender=Excursion)
+@receiver(post_save, sender=News)
+@receiver(post_save, sender=User)
+def schedule_image_variants(sender, instance, update_fields=None, **kwargs):
+    """Варианты генерируются в celery после коммита, если картинка новая; при удалении картинки описание очищается"""
+    field_name, variants_field = IMAGE_VARIANT_FIELDS[sender]
+    if update_fields is not None and field_name not in update_fields:
+        return
+    field_file = getattr(instance, field_name)
+    variants = getattr(instance, variants_field) or {}
+    if field_file and variants.get('source') != field_file.name:
+        # повторное сохранение того же объекта (например, из сериализатора) не ставит задачу еще раз
+        if getattr(instance, '_variants_scheduled_for', None) == field_file.name:
+            return
+        instance._variants_scheduled_for = field_file.name
+        meta = sender._meta
+        transaction.on_commit(lambda: generate_image_variants.delay(
+            meta.app_label, meta.model_name, instance.pk, field_name, variants_field))
+    elif not field_file and variants:
+        sender.objects.filter(pk=instance.pk).update(**{variants_field: {}})
+
+
+# Инвалидация кэша списков каталога (cache.py): сбрасываются только списки затронутого типа объектов
+CATALOG_MODELS = (Hotel, Restaurant, Transport, Excursion)
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Transport)
+@receiver(post_save, sender=Excursion)
+@receiver(post_delete, sender=Hotel)
+@receiver(post_delete, sender=Restaurant)
+@receiver(post_delete, sender=Transport)
+@receiver(post_delete, sender=Excursion)
+def invalidate_catalog_cache(sender, instance, **kwargs):
+    catalog_cache.invalidate(sender)
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Transport)
+@receiver(post_save, sender=Excursion)
+def update_spatial_index(sender, instance, **kwargs):
+    geo.on_catalog_change(sender, instance)
+
+
+@receiver(post_delete, sender=Hotel)
+@receiver(post_delete, sender=Restaurant)
+@receiver(post_delete, sender=Transport)
+@receiver(post_delete, sender=Excursion)
+def remove_from_spatial_index(sender, instance, **kwargs):
+    geo.on_catalog_change(sender, instance, deleted=True)
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Transport)
+@receiver(post_save, sender=Excursion)
+def update_search_vector(sender, instance, update_fields=None, **kwargs):
+    """Пересчет search_vector; update() не вызывает сигналов, так что рекурсии нет"""
+    if update_fields is None or {'name', 'description'} & set(update_fields):
+        sender.objects.filter(pk=instance.pk).update(search_vector=search.search_vector())
+
+
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def invalidate_catalog_cache_on_review(sender, instance, **kwargs):
+    for model, field in ((Hotel, 'hotel_id'), (Restaurant, 'restaurant_id'), (Excursion, 'excursion_id')):
+        if getattr(instance, field):
+            catalog_cache.invalidate(model)
+
+
+def photo_catalog_models(photo):
+    """Типы объектов каталога, в которых используется фото"""
+    return [model for model in CATALOG_MODELS if model.photos.through.objects.filter(photo=photo).exists()]
+
+
+@receiver(post_save, sender=Photo)
+def invalidate_catalog_cache_on_photo_save(sender, instance, created, **kwargs):
+    if not created:  # новое фото еще ни к чему не привязано, привязку ловит m2m_changed
+        for model in photo_catalog_models(instance):
+            catalog_cache.invalidate(model)
+
+
+@receiver(pre_delete, sender=Photo)
+def invalidate_catalog_cache_on_photo_delete(sender, instance, **kwargs):
+    for model in photo_catalog_models(instance):  # после удаления связей уже не будет
+        catalog_cache.invalidate(model)
+
+
+def catalog_m2m_models():
+    """through-модель m2m поля каталога -> модель каталога"""
+    return {field.remote_field.through: model
+            for model in CATALOG_MODELS for field in model._meta.many_to_many}
+
+
+@receiver(m2m_changed)
+def invalidate_catalog_cache_on_m2m(sender, action, **kwargs):
+    model = catalog_m2m_models().get(sender)
+    if model is not None and action in ('post_add', 'post_remove', 'post_clear'):
+        catalog_cache.invalidate(model)
+
+
+
+# Город объектов каталога (City) и счетчики опубликованных объектов в городах
+CITY_COUNT_FIELDS = {Hotel: 'hotel_count', Restaurant: 'restaurant_count', Transport: 'transport_count', Excursion: 'excursion_count'}
+
+
+def counted_city(model, city_id, status):
+    """Город, в счетчике которого учитывается объект: только опубликованные (status приходит и строкой)"""
+    return city_id if model._meta.get_field('status').to_python(status) else None
+
+
+def update_city_count(model, city_id, delta):
+    if city_id:
+        field = CITY_COUNT_FIELDS[model]
+        City.objects.filter(pk=city_id).update(**{field: F(field) + delta})
+
+
+@receiver(pre_save, sender=Hotel)
+@receiver(pre_save, sender=Restaurant)
+@receiver(pre_save, sender=Transport)
+@receiver(pre_save, sender=Excursion)
+def set_city(sender, instance, update_fields=None, **kwargs):
+    """city следует за location: название ищется в справочнике один раз при сохранении, а не в каждом фильтре"""
+    if update_fields is None or 'location' in update_fields:
+        instance.city_id = City.objects.resolve(instance.location)
+    # в каком счетчике объект учтен сейчас: запоминается после сохранения, из БД читается один раз
+    if instance._state.adding:
+        instance._counted_city = None
+    elif not hasattr(instance, '_counted_city'):
+        old = sender.objects.filter(pk=instance.pk).values_list('city_id', 'status').first()
+        instance._counted_city = counted_city(sender, *old) if old else None
+
+
+@receiver(post_save, sender=Hotel)
+@receiver(post_save, sender=Restaurant)
+@receiver(post_save, sender=Transport)
+@receiver(post_save, sender=Excursion)
+def update_city_counts(sender, instance, **kwargs):
+    """
+    Счетчики меняются на разницу одним UPDATE с F(). Изменения через queryset.update()
+    сюда не попадают, их счетчики пересчитывает команда map_cities
+    """
+    old = getattr(instance, '_counted_city', None)
+    new = counted_city(sender, instance.city_id, instance.status)
+    if old != new:
+        update_city_count(sender, old, -1)
+        update_city_count(sender, new, 1)
+    instance._counted_city = new
+
+
+@receiver(post_delete, sender=Hotel)
+@receiver(post_delete, sender=Restaurant)
+@receiver(post_delete, sender=Transport)
+@receiver(post_delete, sender=Excursion)
+def remove_from_city_counts(sender, instance, **kwargs):
+    update_city_count(sender, counted_city(sender, instance.city_id, instance.status), -1)
+
+
+# m2m-поле каталога -> колонка с копией id его значений. Фильтр "есть все выбранные" - одно условие
+# @> по GIN-индексу колонки вместо JOIN на каждое выбранное значение
+TAG_ID_FIELDS = {
+    Hotel: {'type_room': 'type_room_ids', 'facilities': 'facilities_ids', 'services': 'services_ids'},
+    Restaurant: {'features': 'features_ids', 'kitchen': 'kitchen_ids'},
+    Excursion: {'inclusives': 'inclusives_ids', 'conditions': 'conditions_ids'},
+}
+
+
+def tag_m2m_fields():
+    """through-модель -> (модель каталога, m2m-поле) для полей из TAG_ID_FIELDS"""
+    return {model._meta.get_field(name).remote_field.through: (model, model._meta.get_field(name))
+            for model, fields in TAG_ID_FIELDS.items() for name in fields}
+
+
+def sync_tag_ids(model, field_name, pks):
+    """Пересчет колонки id одним UPDATE с подзапросом к through-таблице"""
+    field = model._meta.get_field(field_name)
+    source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+    ids = (field.remote_field.through.objects.filter(**{source: OuterRef('pk')})
+           .order_by(f'{target}_id').values(f'{target}_id'))
+    model.objects.filter(pk__in=pks).update(**{TAG_ID_FIELDS[model][field_name]: ArraySubquery(ids)})
+
+
+@receiver(m2m_changed)
+def sync_tag_ids_on_m2m(sender, instance, action, reverse, pk_set, **kwargs):
+    found = tag_m2m_fields().get(sender)
+    if found is None:
+        return
+    model, field = found
+    if not reverse:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            sync_tag_ids(model, field.name, [instance.pk])
+        return
+    # изменение со стороны значения (facility.hotel_set.add(...)): pk_set - id объектов каталога
+    if action == 'pre_clear':
+        instance._tag_clear_pks = list(sender.objects.filter(**{field.m2m_reverse_field_name(): instance.pk})
+                                       .values_list(f'{field.m2m_field_name()}_id', flat=True))
+    elif action == 'post_clear':
+        sync_tag_ids(model, field.name, instance._tag_clear_pks)
+    elif action in ('post_add', 'post_remove'):
+        sync_tag_ids(model, field.name, pk_set)
+
+
+@receiver(post_delete, sender=TypeRoom)
+@receiver(post_delete, sender=Facilities)
+@receiver(post_delete, sender=Service)
+@receiver(post_delete, sender=Features)
+@receiver(post_delete, sender=Kitchen)
+@receiver(post_delete, sender=Inclusive)
+@receiver(post_delete, sender=Conditions)
+def remove_deleted_tag_ids(sender, instance, **kwargs):
+    """Связи с удаленным значением удаляются каскадом без m2m_changed, id убирается из колонок отдельно"""
+    for model, fields in TAG_ID_FIELDS.items():
+        for name, ids_field in fields.items():
+            if model._meta.get_field(name).related_model is sender:
+                model.objects.filter(**{f'{ids_field}__contains': [instance.pk]}).update(
+                    **{ids_field: Func(F(ids_field), Value(instance.pk), function='array_remove',
+                                       output_field=ArrayField(models.IntegerField()))})
+                catalog_cache.invalidate(model)
+
+
+# Избранное: при удалении объекта каталога он убирается из папок (у FavoriteItem нет FK на объект),
+# при удалении папки сбрасывается кэш избранного пользователя (favorite_cache.py)
+@receiver(post_delete, sender=Hotel)
+@receiver(post_delete, sender=Restaurant)
+@receiver(post_delete, sender=Transport)
+@receiver(post_delete, sender=Excursion)
+def remove_deleted_favorite_items(sender, instance, **kwargs):
+    from .favorites import remove_items
+    remove_items(FavoriteItem.objects.filter(item_type=sender._meta.model_name, item_id=instance.pk))
+
+
+@receiver(post_delete, sender=TripFolder)
+def invalidate_favorite_cache_on_folder_delete(sender, instance, **kwargs):
+    favorite_cache.invalidate(instance.user_id)
@@ -1,5 +1,158 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import binascii
+import json
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from . import geo
 
 
 class Paginator(PageNumberPagination):
-    page_size = 10
\ No newline at end of file
+    page_size = 10
+
+
+class KeysetPagination(BasePagination):
+    """
+    Пагинация по непрозрачному курсору (keyset). Следующая страница выбирается условием
+    (поле, id) после (значение, id) последнего объекта, а не OFFSET'ом,
+    поэтому глубокие страницы стоят столько же, сколько первая.
+    Старая выдача всего списка без пагинации доступна явно через ?paginate=false
+    """
+    page_size = 20
+    max_page_size = 100
+    page_size_query_param = 'page_size'
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    paginate_query_param = 'paginate'
+    ordering_fields = ('rate', 'cost', 'distance', 'rank', 'similarity')  # поля модели либо аннотации запроса
+    default_ordering = '-rate'
+    annotation_orderings = ('distance', '-rank', '-similarity')  # если такая аннотация есть в запросе, сортируем по ней по умолчанию
+    invalid_cursor_message = 'Invalid cursor'
+    cache_params = ('cursor', 'page_size', 'ordering', 'paginate')  # для ключа кэша списков
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if request.query_params.get(self.paginate_query_param) == 'false':
+            return None
+
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.ordering = self.get_ordering(request, queryset)
+        field = self.ordering.lstrip('-')
+        descending = self.ordering.startswith('-')
+
+        if field in queryset.query.annotations:
+            queryset = queryset.filter(**{f'{field}__isnull': False})  # у объекта без координат нет расстояния
+        queryset = queryset.order_by(self.ordering, '-id' if descending else 'id')
+
+        cursor = self.decode_cursor(request, queryset.model, field)
+        if cursor is not None:
+            value, pk = cursor
+            lookup = 'lt' if descending else 'gt'
+            # OR сам по себе не годится в границу диапазона индекса (status, поле, id),
+            # избыточное условие поле <= / >= значения дает индексу начать сразу с курсора
+            queryset = queryset.filter(Q(**{f'{field}__{lookup}e': value}),
+                                       Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': pk}))
+
+        results = self.fetch(request, queryset, self.ordering, cursor)
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def fetch(self, request, queryset, ordering, cursor):
+        """Страница и одна строка сверх нее, чтобы знать, есть ли следующая"""
+        limit = self.page_size + 1
+        point = geo.request_point(request.query_params)
+        if ordering != 'distance' or point is None or 'distance' not in queryset.query.annotations:
+            return list(queryset[:limit])
+        # по расстоянию - окнами вокруг точки, а не сортировкой всех объектов (geo.nearest_windows)
+        lat, lng, radius_km = point
+        for window in geo.nearest_windows(queryset, lat, lng, limit, cursor[0] if cursor else 0.0, radius_km):
+            results = list(window[:limit])
+            if len(results) == limit:
+                break
+        return results
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(page_size, 1), self.max_page_size)
+
+    def get_ordering(self, request, queryset):
+        ordering = request.query_params.get(self.ordering_query_param)
+        if ordering and self.is_valid_ordering(ordering.lstrip('-'), queryset):
+            return ordering
+        for ordering in self.annotation_orderings:
+            if ordering.lstrip('-') in queryset.query.annotations:
+                return ordering
+        return self.default_ordering
+
+    def is_valid_ordering(self, field, queryset):
+        if field not in self.ordering_fields:
+            return False
+        if field in queryset.query.annotations:
+            return True
+        try:
+            queryset.model._meta.get_field(field)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+    def encode_cursor(self, obj):
+        field = self.ordering.lstrip('-')
+        value = getattr(obj, field)
+        if hasattr(value, 'isoformat'):
+            value = value.isoformat()
+        data = json.dumps({'o': self.ordering, 'v': value, 'id': obj.id})
+        return base64.urlsafe_b64encode(data.encode()).decode()
+
+    def decode_cursor(self, request, model, field):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            if data['o'] != self.ordering:  # курсор от другой сортировки
+                raise ValueError
+            value, pk = data['v'], int(data['id'])
+            try:
+                value = model._meta.get_field(field).to_python(value)
+            except FieldDoesNotExist:
+                value = float(value)
+        except (binascii.Error, TypeError, KeyError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, pk
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(self.page[-1]))
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+
+class ReviewPagination(KeysetPagination):
+    """Лента отзывов: новые сверху"""
+    ordering_fields = ('created_at',)
+    default_ordering = '-created_at'
+    annotation_orderings = ()
@@ -0,0 +1,137 @@
+"""
+Уменьшение картинок из MEDIA_ROOT по запросу: /media/resized/<ширина>/<путь к оригиналу>.
+
+Готовые копии лежат в MEDIA_ROOT/resized/<ширина>/<путь> - по тому же пути, что и url,
+поэтому nginx отдает их сам, а в приложение попадают только промахи.
+Одновременные промахи по одной копии ждут друг друга на fcntl-блокировке,
+так что картинку уменьшает только первый запрос (lock-файлы лежат в RESIZE_LOCKS_DIR,
+вне публичного MEDIA_ROOT). Общий размер копий ограничен
+RESIZE_CACHE_MAX_BYTES: самые давно использованные (по atime/mtime) удаляет
+периодическая задача celery (trim_resized_images в CELERY_BEAT_SCHEDULE)
+"""
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.utils._os import safe_join
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+RESIZE_DIR = 'resized'
+LOCK_STRIPES = 256      # блокировки по хешу ключа, чтобы число lock-файлов было ограничено
+WIDTHS = (160, 320, 480, 640, 800, 1080, 1280, 1600, 1920)
+TRIM_RATIO = 0.9        # после очистки остается не больше 90% лимита
+SAVE_OPTIONS = {
+    'JPEG': {'quality': 82, 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': 80, 'method': 4},
+    'PNG': {'optimize': True},
+}
+
+
+def cache_root():
+    return os.path.join(settings.MEDIA_ROOT, RESIZE_DIR)
+
+
+def is_fresh(path, source_mtime):
+    try:
+        return os.stat(path).st_mtime >= source_mtime
+    except FileNotFoundError:
+        return False
+
+
+@contextmanager
+def key_lock(key):
+    """Межпроцессная блокировка на ключ копии"""
+    directory = settings.RESIZE_LOCKS_DIR
+    os.makedirs(directory, exist_ok=True)
+    stripe = int(hashlib.md5(key.encode()).hexdigest(), 16) % LOCK_STRIPES
+    with open(os.path.join(directory, f'{stripe}.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def resize_image(source, target, width):
+    """Уменьшает картинку до ширины width (меньшие не увеличиваются) в формате оригинала"""
+    with Image.open(source) as original:
+        image_format = original.format
+        image = ImageOps.exif_transpose(original)
+        if image.width > width:
+            image = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+        # пишем во временный файл и переименовываем, чтобы nginx не отдал недописанную копию
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                image.save(file, image_format, **SAVE_OPTIONS.get(image_format, {}))
+            os.replace(temporary, target)
+        except BaseException:
+            os.remove(temporary)
+            raise
+
+
+def resized_path(width, path):
+    """
+    Путь к копии картинки path шириной width, при промахе копия создается.
+    None, если оригинала нет или это не картинка. SuspiciousFileOperation, если path ведет за пределы MEDIA_ROOT
+    """
+    if path.split('/', 1)[0] == RESIZE_DIR:
+        return None
+    source = safe_join(settings.MEDIA_ROOT, path)
+    target = safe_join(cache_root(), str(width), path)
+    if not os.path.isfile(source):  # каталоги, сокеты и т.п.
+        return None
+    try:
+        source_mtime = os.stat(source).st_mtime
+    except FileNotFoundError:
+        return None
+
+    if is_fresh(target, source_mtime):
+        os.utime(target)  # для LRU
+        return target
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with key_lock(target):
+        # пока ждали блокировку, копию мог сделать другой запрос
+        if not is_fresh(target, source_mtime):
+            try:
+                resize_image(source, target, width)
+            except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+                # не картинка, битый файл (в т.ч. недокачанный .part) или слишком большая
+                return None
+    return target
+
+
+def trim(max_bytes):
+    """Удаляет давно использованные копии, если их общий размер больше max_bytes. Возвращает число удаленных"""
+    root = cache_root()
+    entries, total = [], 0
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.startswith('.'):  # недописанные копии
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            # atime обновляет и nginx при отдаче копии (если ФС смонтирована не с noatime)
+            entries.append((max(stat.st_atime, stat.st_mtime), stat.st_size, path))
+            total += stat.st_size
+    if total <= max_bytes:
+        return 0
+
+    entries.sort()
+    removed = 0
+    for _, size, path in entries:
+        if total <= max_bytes * TRIM_RATIO:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    return removed
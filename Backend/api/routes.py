@@ -0,0 +1,126 @@
+"""
+Маршрут по папке поездки: порядок обхода объектов папки с координатами.
+
+Матрица расстояний между всеми объектами считается векторно (haversine сразу для всех пар),
+начальный маршрут - ближайший сосед от стартового объекта, затем 2-opt разворачивает отрезки,
+пока путь укорачивается. Маршрут открытый: от старта до последнего объекта, без возврата.
+Результат кэшируется по версии избранного пользователя (ее меняют операции favorites.py
+и удаление папки) и гео-версиям моделей каталога (меняются вместе с координатами объектов)
+"""
+import numpy as np
+from django.core.cache import cache
+
+from . import cache as catalog_cache
+from . import favorite_cache, geo
+from .favorites import ITEM_MODELS
+from .models import FavoriteItem
+
+TIMEOUT = 60 * 60 * 24
+MAX_PASSES = 50  # проходов 2-opt; обычно сходится за несколько
+START_TYPE = 'hotel'  # маршрут начинается с жилья, если оно есть в папке
+
+
+def distance_matrix(lats, lngs):
+    """Матрица расстояний в км между всеми парами точек (в градусах)"""
+    lats, lngs = np.radians(lats), np.radians(lngs)
+    cos = np.cos(lats)
+    a = (np.sin((lats[:, None] - lats[None, :]) / 2) ** 2
+         + cos[:, None] * cos[None, :] * np.sin((lngs[:, None] - lngs[None, :]) / 2) ** 2)
+    return 2 * geo.EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def nearest_neighbour(matrix, start=0):
+    """Жадный маршрут: каждый раз в ближайшую еще не посещенную точку"""
+    size = len(matrix)
+    order = np.empty(size, dtype=np.int64)
+    visited = np.zeros(size, dtype=bool)
+    current = start
+    for step in range(size):
+        order[step] = current
+        visited[current] = True
+        if step < size - 1:
+            current = int(np.argmin(np.where(visited, np.inf, matrix[current])))
+    return order
+
+
+def two_opt(matrix, order, max_passes=MAX_PASSES):
+    """
+    Улучшение открытого маршрута разворотом отрезков order[i:j + 1], первая точка остается на месте.
+    Для каждого i выигрыш по всем j считается одним векторным выражением, применяется лучший
+    """
+    order = order.copy()
+    size = len(order)
+    for _ in range(max_passes):
+        improved = False
+        for i in range(1, size - 1):
+            j = np.arange(i + 1, size)
+            before, first, last = order[i - 1], order[i], order[j]
+            after = order[np.minimum(j + 1, size - 1)]
+            has_after = j < size - 1  # у отрезка до конца маршрута нет ребра после него
+            old = matrix[before, first] + np.where(has_after, matrix[last, after], 0.0)
+            new = matrix[before, last] + np.where(has_after, matrix[first, after], 0.0)
+            gain = old - new
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                order[i:j[best] + 1] = order[i:j[best] + 1][::-1].copy()
+                improved = True
+        if not improved:
+            break
+    return order
+
+
+def optimize(lats, lngs, start=0):
+    """Порядок обхода (индексы точек) и длины переходов в км, у первой точки 0"""
+    lats, lngs = np.asarray(lats, dtype=np.float64), np.asarray(lngs, dtype=np.float64)
+    if len(lats) < 2:
+        return np.arange(len(lats)), np.zeros(len(lats))
+    matrix = distance_matrix(lats, lngs)
+    order = two_opt(matrix, nearest_neighbour(matrix, start))
+    return order, np.concatenate(([0.0], matrix[order[:-1], order[1:]]))
+
+
+def build(folder):
+    """Маршрут папки: объекты с координатами по порядку обхода и объекты без координат"""
+    items = list(FavoriteItem.objects.filter(folder=folder).order_by('created_at', 'id')
+                 .values_list('item_type', 'item_id'))
+    objects = {}
+    for item_type, model in ITEM_MODELS.items():
+        ids = [item_id for kind, item_id in items if kind == item_type]
+        if ids:
+            for pk, name, lat, lng in model.objects.filter(id__in=ids).values_list('id', 'name', 'latitude', 'longitude'):
+                objects[item_type, pk] = (name, lat, lng)
+
+    points, unplaced = [], []
+    for key in items:
+        if key not in objects:
+            continue
+        name, lat, lng = objects[key]
+        (points if lat is not None and lng is not None else unplaced).append((key, name, lat, lng))
+    start = next((index for index, ((item_type, _), *_) in enumerate(points) if item_type == START_TYPE), 0)
+    order, legs = optimize([point[2] for point in points], [point[3] for point in points], start)
+    route = []
+    for index, leg in zip(order, legs):
+        (item_type, pk), name, lat, lng = points[index]
+        route.append({'type': item_type, 'id': pk, 'name': name, 'latitude': lat, 'longitude': lng,
+                      'leg_km': round(float(leg), 2)})
+    return {
+        'folder': folder.id,
+        'distance_km': round(float(legs.sum()), 2),
+        'route': route,
+        'without_coordinates': [{'type': item_type, 'id': pk, 'name': name} for (item_type, pk), name, _, _ in unplaced],
+    }
+
+
+def cache_key(folder):
+    versions = [catalog_cache.get_version(model, geo.VERSION_NAMESPACE) for model in ITEM_MODELS.values()]
+    return f'route:{folder.id}:{favorite_cache.get_version(folder.user_id)}:' + ':'.join(map(str, versions))
+
+
+def folder_route(folder):
+    """Маршрут из кэша; пересчитывается после изменения папки или координат объектов"""
+    key = cache_key(folder)
+    route = cache.get(key)
+    if route is None:
+        route = build(folder)
+        cache.set(key, route, TIMEOUT)
+    return route
@@ -0,0 +1,97 @@
+"""
+Текстовый поиск по объектам каталога.
+
+Полнотекстовый: у каждой модели каталога есть колонка search_vector (tsvector с GIN-индексом): название с весом A
+и описание с весом B, каждое в русской и английской конфигурации. Колонка обновляется
+сигналом post_save (см. models.py), для существующих строк - командой rebuild_search_vectors.
+
+По подстроке и с опечатками: на UPPER(location) (и UPPER(name) у транспорта) стоят GIN-индексы
+gin_trgm_ops (pg_trgm), ими пользуются и icontains, и нечеткое сравнение по сходству триграмм
+"""
+import re
+
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db.models import F, FloatField, Q
+from django.db.models.functions import Cast, Greatest, Upper
+
+SEARCH_CONFIGS = ('russian', 'english')
+SEARCH_FIELDS = (('name', 'A'), ('description', 'B'))
+MAX_TERMS = 8
+
+word_re = re.compile(r'\w+')
+
+
+def search_vector():
+    """Выражение для заполнения search_vector"""
+    vectors = [SearchVector(field, config=config, weight=weight)
+               for field, weight in SEARCH_FIELDS for config in SEARCH_CONFIGS]
+    vector = vectors[0]
+    for other in vectors[1:]:
+        vector = vector + other
+    return vector
+
+
+def search_query(text):
+    """
+    Запрос по введенной строке: все слова должны найтись, последнее - как префикс
+    (поиск по мере набора). None, если слов в строке нет
+    """
+    words = word_re.findall(text.lower())[:MAX_TERMS]
+    if not words:
+        return None
+    # слова состоят только из \w, поэтому синтаксис tsquery в них не попадет
+    raw = ' & '.join(words[:-1] + [f'{words[-1]}:*'])
+    query = SearchQuery(raw, config=SEARCH_CONFIGS[0], search_type='raw')
+    for config in SEARCH_CONFIGS[1:]:
+        query = query | SearchQuery(raw, config=config, search_type='raw')
+    return query
+
+
+def filter_by_search(request, queryset):
+    """
+    Фильтр по ?search= с аннотацией rank (релевантность). rank приводится к double precision,
+    чтобы значение в курсоре пагинации совпадало со значением в БД
+    """
+    query = search_query(request.query_params.get('search', ''))
+    if query is None:
+        return queryset
+    rank = Cast(SearchRank(F('search_vector'), query), FloatField())
+    return queryset.filter(search_vector=query).annotate(rank=rank)
+
+
+# русские буквы -> латиница, чтобы "Пхукет" находил "Phuket"
+TRANSLIT = str.maketrans({
+    'а': 'a', 'б': 'b', 'в': 'v', 'г': 'g', 'д': 'd', 'е': 'e', 'ё': 'yo', 'ж': 'zh', 'з': 'z',
+    'и': 'i', 'й': 'y', 'к': 'k', 'л': 'l', 'м': 'm', 'н': 'n', 'о': 'o', 'п': 'p', 'р': 'r',
+    'с': 's', 'т': 't', 'у': 'u', 'ф': 'f', 'х': 'h', 'ц': 'ts', 'ч': 'ch', 'ш': 'sh', 'щ': 'sch',
+    'ъ': '', 'ы': 'y', 'ь': '', 'э': 'e', 'ю': 'yu', 'я': 'ya',
+})
+
+
+def transliterate(text):
+    return text.lower().translate(TRANSLIT)
+
+
+def is_fuzzy(request):
+    return request.query_params.get('fuzzy') in ('true', '1')
+
+
+def filter_by_trigram(queryset, field, value, fuzzy=False):
+    """
+    Поиск value в текстовом поле. Обычный режим - подстрока (icontains).
+    Нечеткий - еще и похожие по триграммам строки (опечатки, транслитерация с русского),
+    с аннотацией similarity (сходство лучшего варианта написания, double precision для курсора пагинации)
+    """
+    if not fuzzy:
+        return queryset.filter(**{f'{field}__icontains': value})
+    upper = f'{field}_upper'
+    variants = list(dict.fromkeys((value.lower(), transliterate(value))))
+    condition = Q(**{f'{field}__icontains': value})
+    for variant in variants:
+        condition |= Q(**{f'{upper}__trigram_similar': variant})
+    queryset = queryset.alias(**{upper: Upper(field)}).filter(condition)
+    if 'similarity' in queryset.query.annotations:  # по нескольким полям сортируем по первому
+        return queryset
+    similarities = [TrigramSimilarity(Upper(field), variant) for variant in variants]
+    similarity = similarities[0] if len(similarities) == 1 else Greatest(*similarities)
+    return queryset.annotate(similarity=Cast(similarity, FloatField()))
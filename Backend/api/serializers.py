@@ -1,15 +1,23 @@
 import base64
+import binascii
 from django.http import JsonResponse
 from rest_framework import serializers
 from rest_framework import status
+from rest_framework.exceptions import NotFound
 from django.core.files.base import ContentFile
+from django.db.models import Prefetch
 
 from users.models import User
 from .models import (ApplicationUnblock, Hotel, Restaurant, Faq, News, Transport,
                      TripFolder, Favorite, Features, Kitchen, Service,
                      TypeRoom, Facilities, Excursion, Conditions, Inclusive,
-                     ApplicationOnExcursion, Review, RentalServices, WorkingHours, Info)
+                     ApplicationOnExcursion, Review, RentalServices, WorkingHours, Info,
+                     UploadSession, City, review_histograms)
 from .validators import UserValidation
+from .images import image_meta, variant_urls
+from .uploads import BASE64_AVATAR_MAX_SIZE, MAX_UPLOAD_SIZE, verify_image
+from .favorites import ITEM_FIELDS, MAX_OPERATIONS
+from . import favorite_cache, favorites
 from chat.models import Room
 
 
@@ -22,7 +30,8 @@ class UserSerializer(serializers.ModelSerializer):
 
 class UserInfoSerializer(serializers.ModelSerializer):
     """ДЛя получения полной информации о пользователе"""
-    avatar = serializers.CharField(write_only=True, required=False, max_length=100000000)
+    # base64 оставлен для старых клиентов и ограничен BASE64_AVATAR_MAX_SIZE, файлом аватар грузится через /userinfo/avatar/
+    avatar = serializers.CharField(write_only=True, required=False, max_length=(BASE64_AVATAR_MAX_SIZE + 2) // 3 * 4)
     username = serializers.CharField(required=False)
     full_name = serializers.CharField(required=False)
     new_password = serializers.CharField(required=False)
@@ -69,15 +78,22 @@ class UserInfoSerializer(serializers.ModelSerializer):
             instance.country_code = new_country_code
 
         if new_avatar:  # При артуре делали через base64, в остальных местах по адекватному фотки грузятся
-            avatar = self.process_avatar(new_avatar)
-            instance.avatar.save('avatar.png', avatar)
+            instance.avatar.save('avatar.png', new_avatar, save=False)
         instance.save()
         return instance
 
+    def validate_avatar(self, value):
+        return self.process_avatar(value) if value else None
+
     def process_avatar(self, avatar_data):
         # Раскодирование данных base64 в бинарные данные изображения
-        decoded_avatar = base64.b64decode(avatar_data)
-        return ContentFile(decoded_avatar, name='avatar.png')
+        try:
+            decoded_avatar = base64.b64decode(avatar_data, validate=True)
+        except binascii.Error:
+            raise serializers.ValidationError('Ожидается картинка в base64')
+        avatar = ContentFile(decoded_avatar, name='avatar.png')
+        verify_image(avatar)
+        return avatar
     
     def validate_username(self, value):
         # Проверка, существует ли уже пользователь с заданным именем пользователя
@@ -176,35 +192,178 @@ class FacilitiesSerializer(serializers.ModelSerializer):
         fields = ['name', 'id']
 
 
-class HotelSerializer(serializers.ModelSerializer):
+class CitySerializer(serializers.ModelSerializer):
+    """
+    Город со счетчиками опубликованных объектов
+    """
+    total = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = City
+        fields = ['id', 'name', 'aliases', 'latitude', 'longitude',
+                  'hotel_count', 'restaurant_count', 'transport_count', 'excursion_count', 'total']
+
+
+LATEST_REVIEWS = 3  # сколько последних отзывов встраивается в объект
+PHOTO_VARIANTS = ('card', 'full')
+EMPTY_IMAGE_META = dict.fromkeys(('width', 'height', 'size', 'blurhash'))
+
+
+class CatalogObjectMixin:
+    """
+    Общие поля объектов каталога. is_favorite проверяется по набору id из контекста
+    (favorite_ids, его собирает вьюха) или по кэшу избранного пользователя (favorite_cache.py)
+    """
+    reviews_field = None  # related_name отзывов у модели
+    image_variant_names = ('card', 'full')  # какие уменьшенные копии обложки отдавать (см. images.py)
+    select_related_fields = ()  # связи, которые читает сериализатор (см. prepare_queryset)
+    prefetch_related_fields = ()
+
+    @classmethod
+    def prepare_queryset(cls, queryset):
+        """
+        Запрос под этот сериализатор: подтягиваются только связи, которые он читает, пачкой на весь список.
+        Остальные select_related/prefetch_related запроса сбрасываются
+        """
+        queryset = queryset.select_related(None).prefetch_related(None)
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        if cls.reviews_field:
+            # только последние отзывы: срез в prefetch - один запрос с ROW_NUMBER() на весь список
+            latest = Review.objects.order_by('-created_at', '-id')[:LATEST_REVIEWS]
+            queryset = queryset.prefetch_related(Prefetch(cls.reviews_field, queryset=latest, to_attr='latest_reviews'))
+        return queryset
+
+    def get_is_favorite(self, obj):
+        favorite_ids = self.context.get('favorite_ids')
+        if favorite_ids is not None:
+            return obj.id in favorite_ids
+        # набор берется из кэша один раз на модель и дальше живет в контексте всего ответа
+        cached = self.context.setdefault('favorite_ids_by_model', {})
+        model = type(obj)
+        if model not in cached:
+            cached[model] = favorite_cache.get_ids(self.context['request'].user, model)
+        return obj.id in cached[model]
+
+    def get_photos(self, obj):
+        # фото с размерами и blurhash для заглушек (None, пока не посчитаны); берутся из prefetch, если он есть
+        return [{'url': photo.photo.url, **(image_meta(photo.variants) or EMPTY_IMAGE_META)} for photo in obj.photos.all()]
+
+    def get_photo_variants(self, obj):
+        # уменьшенные копии фото в том же порядке, что и photos (None, пока копии не готовы)
+        request = self.context.get('request')
+        return [variant_urls(photo.variants, PHOTO_VARIANTS, request) for photo in obj.photos.all()]
+
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image_variants, self.image_variant_names, self.context.get('request'))
+
+    def get_image_meta(self, obj):
+        return image_meta(obj.image_variants)
+
+    def get_distance(self, obj):
+        # расстояние в километрах, есть только при поиске по координатам
+        distance = getattr(obj, 'distance', None)
+        return round(distance, 2) if distance is not None else None
+
+    def get_reviews(self, obj):
+        # только последние отзывы (из prefetch списка, если он есть), вся лента - /reviews/ с пагинацией
+        reviews = getattr(obj, 'latest_reviews', None)
+        if reviews is None:
+            reviews = getattr(obj, self.reviews_field).order_by('-created_at', '-id')[:LATEST_REVIEWS]
+        return ReviewSerializer(reviews, many=True).data
+
+    def get_review_summary(self, obj):
+        # гистограмма оценок: для списка собрана одним запросом на страницу (review_histograms в контексте)
+        histograms = self.context.get('review_histograms')
+        if histograms is None:
+            histograms = review_histograms(type(obj), [obj.id])
+        histogram = histograms.get(obj.id, {})
+        return {
+            'count': obj.review_count,
+            'average': round(obj.rating_sum / obj.review_count, 2) if obj.review_count else None,
+            'histogram': {star: histogram.get(star, 0) for star in range(1, 6)},
+        }
+
+
+class HotelListSerializer(CatalogObjectMixin, serializers.ModelSerializer):
+    """Краткое представление отеля для списков, полное - HotelSerializer"""
+    is_favorite = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+    image_variant_names = ('thumb',)
+
+    class Meta:
+        model = Hotel
+        fields = ['id', 'name', 'image', 'image_variants', 'image_meta', 'rate', 'review_count', 'cost', 'location', 'distance', 'is_favorite']
+
+
+class RestaurantListSerializer(CatalogObjectMixin, serializers.ModelSerializer):
+    """Краткое представление ресторана для списков"""
+    is_favorite = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+    image_variant_names = ('thumb',)
+
+    class Meta:
+        model = Restaurant
+        fields = ['id', 'name', 'image', 'image_variants', 'image_meta', 'rate', 'review_count', 'cost', 'location', 'distance', 'is_favorite']
+
+
+class TransportListSerializer(CatalogObjectMixin, serializers.ModelSerializer):
+    """Краткое представление транспорта для списков (отзывов у транспорта нет)"""
+    is_favorite = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+    image_variant_names = ('thumb',)
+
+    class Meta:
+        model = Transport
+        fields = ['id', 'name', 'image', 'image_variants', 'image_meta', 'rate', 'cost', 'location', 'distance', 'is_favorite']
+
+
+class ExcursionListSerializer(CatalogObjectMixin, serializers.ModelSerializer):
+    """Краткое представление экскурсии для списков"""
+    is_favorite = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+    image_variant_names = ('thumb',)
+
+    class Meta:
+        model = Excursion
+        fields = ['id', 'name', 'image', 'image_variants', 'image_meta', 'rate', 'review_count', 'cost', 'location', 'distance', 'is_favorite']
+
+
+class HotelSerializer(CatalogObjectMixin, serializers.ModelSerializer):
     """сериализатор для отеля"""
     is_favorite = serializers.SerializerMethodField() # добавлен ли отель в избранное пользователем 
     photos = serializers.SerializerMethodField()
-    reviews = serializers.SerializerMethodField() # отзывы 
+    photo_variants = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+    reviews = serializers.SerializerMethodField() # последние отзывы
+    review_summary = serializers.SerializerMethodField() # число, средняя оценка и гистограмма
     workingDays = WorkingHoursSerializer(required=False)
-    # distance = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    reviews_field = 'reviewsHotels'
+    select_related_fields = ('workingDays',)
+    prefetch_related_fields = ('photos', 'type_room', 'facilities', 'services')
 
     class Meta:
         model = Hotel
         fields = ['name', 'description', 'chat_room', 'owner', 'promotion',
                   'image', 'rate', 'cost', 'location', 'is_favorite',
-                  'type_room', 'facilities', 'services', 'id', 'countBeds', 'photos', 'reviews', 'latitude', 'longitude',
-                  'workingDays', 'phone_number', 'status']
+                  'type_room', 'facilities', 'services', 'id', 'countBeds', 'photos', 'photo_variants', 'image_variants', 'image_meta', 'reviews', 'review_summary', 'latitude', 'longitude',
+                  'workingDays', 'phone_number', 'status', 'distance']
         extra_kwargs = {'chat_room': {'read_only': True},
                         'owner': {'read_only': True}, 'rate': {'read_only': True},
                         'description': {'required': False}, 'name': {'required': False}}
 
-    def get_photos(self, obj):
-        return [photo.photo.url for photo in obj.photos.all()]
-
-    def get_is_favorite(self, obj):
-        user = self.context['request'].user
-        return obj.favorite_set.filter(user=user).exists()  # является ли объект избранным у пользователя
-    
-    def get_reviews(self, obj):
-        reviews = Review.objects.filter(hotel=obj)
-        serializer = ReviewSerializer(reviews, many=True)
-        return serializer.data
 
     # говнокод благодаря артуру
     def update(self, instance, validated_data):
@@ -261,38 +420,31 @@ class HotelSerializer(serializers.ModelSerializer):
                 instance.save()
         
         return instance
-    
-    # def get_distance(self, obj):
-    #     # возвращает расстояние в километрах
-    #     return round(obj.distance.km, 2)
 
 
-class RestaurantSerializer(serializers.ModelSerializer):
+class RestaurantSerializer(CatalogObjectMixin, serializers.ModelSerializer):
     is_favorite = serializers.SerializerMethodField()
     photos = serializers.SerializerMethodField()
+    photo_variants = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
     reviews = serializers.SerializerMethodField()
+    review_summary = serializers.SerializerMethodField()
     workingDays = WorkingHoursSerializer(required=False)
+    distance = serializers.SerializerMethodField()
+    reviews_field = 'reviewsRestaurants'
+    select_related_fields = ('workingDays',)
+    prefetch_related_fields = ('photos', 'features', 'kitchen')
 
     class Meta:
         model = Restaurant
         fields = ['name', 'description', 'chat_room', 'owner', 'promotion',
                   'image', 'rate', 'cost', 'location', 'is_favorite',
-                  'features', 'kitchen', 'photos', 'reviews', 'id', 'latitude', 'longitude', 'workingDays', 'phone_number', 'status']
+                  'features', 'kitchen', 'photos', 'photo_variants', 'image_variants', 'image_meta', 'reviews', 'review_summary', 'id', 'latitude', 'longitude', 'workingDays', 'phone_number', 'status', 'distance']
         extra_kwargs = {'chat_room': {'read_only': True},
                         'owner': {'read_only': True}, 'rate': {'read_only': True},
                         'description': {'required': False}, 'name': {'required': False}}
         
-    def get_photos(self, obj):
-        return [photo.photo.url for photo in obj.photos.all()]
-        
-    def get_is_favorite(self, obj):
-        user = self.context['request'].user
-        return obj.favorite_set.filter(user=user).exists()
-    
-    def get_reviews(self, obj):
-        reviews = Review.objects.filter(restaurant=obj)
-        serializer = ReviewSerializer(reviews, many=True)
-        return serializer.data
     
     def update(self, instance, validated_data):
         working_days_data = validated_data.pop('workingDays', None)
@@ -356,30 +508,38 @@ class FaqSerializer(serializers.ModelSerializer):
 
 
 class NewsSerializer(serializers.ModelSerializer):
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
+
     class Meta:
         model = News
         fields = '__all__'
 
+    def get_image_variants(self, obj):
+        return variant_urls(obj.image_variants, ('thumb', 'card'), self.context.get('request'))
+
+    def get_image_meta(self, obj):
+        return image_meta(obj.image_variants)
 
-class TransportSerializer(serializers.ModelSerializer):
+
+class TransportSerializer(CatalogObjectMixin, serializers.ModelSerializer):
     is_favorite = serializers.SerializerMethodField()
     photos = serializers.SerializerMethodField()
+    photo_variants = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
     workingDays = WorkingHoursSerializer(required=False)
+    distance = serializers.SerializerMethodField()
+    select_related_fields = ('workingDays',)
+    prefetch_related_fields = ('photos',)
 
     class Meta:
         model = Transport
         fields = ['name', 'description', 'image', 'rate', 'location', 'owner',
-                  'promotion', 'is_favorite', 'cost', 'photos', 'latitude', 'longitude', 'workingDays', 'status', 'id']
+                  'promotion', 'is_favorite', 'cost', 'photos', 'photo_variants', 'image_variants', 'image_meta', 'latitude', 'longitude', 'workingDays', 'status', 'id', 'distance']
         extra_kwargs = {'rate': {'read_only': True}, 
                         'description': {'required': False}, 'name': {'required': False}}
 
-    def get_is_favorite(self, obj):
-        user = self.context['request'].user
-        return obj.favorite_set.filter(user=user).exists()
-    
-    def get_photos(self, obj):
-        return [photo.photo.url for photo in obj.photos.all()]
-    
     def update(self, instance, validated_data):
         working_days_data = validated_data.pop('workingDays', None)
         instance = super().update(instance, validated_data)
@@ -457,26 +617,22 @@ class ConditionsSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ExcursionSerializer(serializers.ModelSerializer):
+class ExcursionSerializer(CatalogObjectMixin, serializers.ModelSerializer):
     is_favorite = serializers.SerializerMethodField()
     photos = serializers.SerializerMethodField()
+    photo_variants = serializers.SerializerMethodField()
+    image_variants = serializers.SerializerMethodField()
+    image_meta = serializers.SerializerMethodField()  # размеры и blurhash обложки
     reviews = serializers.SerializerMethodField()
+    review_summary = serializers.SerializerMethodField()
+    distance = serializers.SerializerMethodField()
+    reviews_field = 'reviewsExcursions'
+    prefetch_related_fields = ('photos', 'inclusives', 'conditions')
 
     class Meta:
         model = Excursion
-        fields = '__all__'
+        exclude = ['search_vector', 'city', 'inclusives_ids', 'conditions_ids']
 
-    def get_is_favorite(self, obj):
-        user = self.context['request'].user
-        return obj.favorite_set.filter(user=user).exists()
-    
-    def get_photos(self, obj):
-        return [photo.photo.url for photo in obj.photos.all()]
-    
-    def get_reviews(self, obj):
-        reviews = Review.objects.filter(excursion=obj)
-        serializer = ReviewSerializer(reviews, many=True)
-        return serializer.data
 
 
 class ApplicationOnExcursionSerializer(serializers.ModelSerializer):
@@ -498,19 +654,110 @@ class ApplicationUpdateStatus(serializers.ModelSerializer):
 
     
 class FavoriteListSerializer(serializers.ModelSerializer):
-    """избранное"""
-    hotels = HotelSerializer(many=True, required=False)
-    restaurants = RestaurantSerializer(many=True, required=False)
-    transport = TransportSerializer(many=True, required=False)
-    excursions = ExcursionSerializer(many=True, required=False)
+    """избранное: объекты папки из FavoriteItem полным представлением (для списка их загружает load_items)"""
+    hotels = serializers.SerializerMethodField()
+    restaurants = serializers.SerializerMethodField()
+    transport = serializers.SerializerMethodField()
+    excursions = serializers.SerializerMethodField()
+    item_serializers = {'hotel': HotelSerializer, 'restaurant': RestaurantSerializer,
+                        'transport': TransportSerializer, 'excursion': ExcursionSerializer}
 
     class Meta:
         model = Favorite
         fields = ['hotels', 'folder', 'restaurants', 'transport', 'excursions', 'id']
 
+    @classmethod
+    def load_items(cls, favorite_list, context):
+        """
+        Объекты всех папок списка вместе со связями, которые читают полные сериализаторы
+        (prepare_queryset), и гистограммы отзывов в context - фиксированное число запросов на весь список
+        """
+        favorites.attach_items(favorite_list, {item_type: serializer.prepare_queryset(favorites.ITEM_MODELS[item_type].objects.all())
+                                               for item_type, serializer in cls.item_serializers.items()})
+        histograms = {}
+        for item_type, serializer in cls.item_serializers.items():
+            ids = {item.id for favorite in favorite_list for item in favorite.folder_items[item_type]}
+            if serializer.reviews_field and ids:
+                histograms[item_type] = review_histograms(favorites.ITEM_MODELS[item_type], ids)
+        context['review_histograms_by_type'] = histograms
+        # все объекты выдачи - из избранного пользователя
+        context['favorite_ids'] = {item.id for favorite in favorite_list for items in favorite.folder_items.values() for item in items}
+
+    def folder_objects(self, obj, item_type, serializer_class):
+        if not hasattr(obj, 'folder_items'):
+            favorites.attach_items([obj])
+        context = self.context
+        histograms = context.get('review_histograms_by_type')
+        if histograms is not None:
+            context = {**context, 'review_histograms': histograms.get(item_type, {})}
+        return serializer_class(obj.folder_items[item_type], many=True, context=context).data
+
+    def get_hotels(self, obj):
+        return self.folder_objects(obj, 'hotel', HotelSerializer)
+
+    def get_restaurants(self, obj):
+        return self.folder_objects(obj, 'restaurant', RestaurantSerializer)
+
+    def get_transport(self, obj):
+        return self.folder_objects(obj, 'transport', TransportSerializer)
+
+    def get_excursions(self, obj):
+        return self.folder_objects(obj, 'excursion', ExcursionSerializer)
+
+
+class FavoriteCardsSerializer(serializers.ModelSerializer):
+    """
+    Краткое избранное: страница карточек объектов папки (favorites.attach_cards)
+    кратким представлением каталога вместо полного с фото и отзывами
+    """
+    card_serializers = {'hotel': HotelListSerializer, 'restaurant': RestaurantListSerializer,
+                        'transport': TransportListSerializer, 'excursion': ExcursionListSerializer}
+    folder_name = serializers.CharField(source='folder.name', default=None)
+    count = serializers.IntegerField(source='folder.countFavorites', default=0)
+    items = serializers.SerializerMethodField()
+    next_offset = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Favorite
+        fields = ['id', 'folder', 'folder_name', 'count', 'items', 'next_offset']
+
+    def get_items(self, obj):
+        # сериализатор карточки создается один раз на тип и переиспользуется для всех объектов
+        cards = self.context.setdefault('card_serializers', {})
+        items = []
+        for item_type, item in obj.folder_cards:
+            if item_type not in cards:
+                cards[item_type] = self.card_serializers[item_type](context=self.context)
+            items.append({'type': item_type, **cards[item_type].to_representation(item)})
+        return items
+
+    def get_next_offset(self, obj):
+        # смещение следующей страницы этой папки (?folder_id=&items_offset=), None - страница последняя
+        offset = self.context['items_offset'] + self.context['items_limit']
+        return offset if obj.folder and offset < obj.folder.countFavorites else None
+
+
+class FolderItemIdsField(serializers.ListField):
+    """id объектов одного типа в папке записи Favorite; при записи список заменяет содержимое папки"""
+    child = serializers.IntegerField()
+
+    def __init__(self, item_type, **kwargs):
+        self.item_type = item_type
+        super().__init__(source='*', required=False, **kwargs)
+
+    def to_representation(self, favorite):
+        return favorites.folder_item_ids(favorite)[self.item_type]
+
+    def to_internal_value(self, data):
+        return {self.field_name: super().to_internal_value(data)}
+
 
 class FavoriteCRUDSerializer(serializers.ModelSerializer):
     folder_name = serializers.SerializerMethodField()
+    hotels = FolderItemIdsField('hotel')
+    restaurants = FolderItemIdsField('restaurant')
+    transport = FolderItemIdsField('transport')
+    excursions = FolderItemIdsField('excursion')
 
     def get_folder_name(self, obj):
         return obj.folder.name
@@ -519,6 +766,39 @@ class FavoriteCRUDSerializer(serializers.ModelSerializer):
         model = Favorite
         fields = ['hotels', 'folder', 'folder_name', 'restaurants', 'transport', 'excursions', 'id']
 
+    def update(self, instance, validated_data):
+        lists = {item_type: set(validated_data.pop(field_name)) for item_type, field_name in ITEM_FIELDS.items()
+                 if field_name in validated_data}
+        instance = super().update(instance, validated_data)
+        if not lists or instance.folder_id is None:
+            return instance
+        instance.__dict__.pop('_folder_item_ids', None)
+        current = favorites.folder_item_ids(instance)
+        operations = []
+        for item_type, ids in lists.items():
+            old = set(current[item_type])
+            operations += [{'action': 'add', 'type': item_type, 'id': pk, 'folders': [instance.folder_id]} for pk in ids - old]
+            operations += [{'action': 'remove', 'type': item_type, 'id': pk, 'folders': [instance.folder_id]} for pk in old - ids]
+        if operations:
+            try:
+                favorites.apply(instance.user, operations)
+            except favorites.FavoriteError as error:
+                raise (NotFound if error.status == 404 else serializers.ValidationError)(str(error))
+            del instance._folder_item_ids
+        return instance
+
+
+class FavoriteOperationSerializer(serializers.Serializer):
+    """Одна операция пакетного изменения избранного"""
+    action = serializers.ChoiceField(choices=['add', 'remove'], default='add')
+    type = serializers.ChoiceField(choices=list(ITEM_FIELDS))
+    id = serializers.IntegerField()
+    folders = serializers.ListField(child=serializers.IntegerField(), allow_empty=False)
+
+
+class FavoriteBulkSerializer(serializers.Serializer):
+    operations = FavoriteOperationSerializer(many=True, allow_empty=False, max_length=MAX_OPERATIONS)
+
 
 class RemoveFavoriteSerializer(serializers.Serializer):
     hotel_id = serializers.IntegerField(required=False)
@@ -527,6 +807,29 @@ class RemoveFavoriteSerializer(serializers.Serializer):
     excursion_id = serializers.IntegerField(required=False)
 
 
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """Сессия загрузки фото частями"""
+    completed = serializers.SerializerMethodField()
+
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'size', 'checksum', 'offset', 'completed', 'created_at']
+        read_only_fields = ['offset', 'created_at']
+
+    def validate_size(self, value):
+        if not 0 < value <= MAX_UPLOAD_SIZE:
+            raise serializers.ValidationError(f'Размер файла должен быть от 1 до {MAX_UPLOAD_SIZE} байт')
+        return value
+
+    def validate_checksum(self, value):
+        if value and (len(value) != 64 or any(char not in '0123456789abcdefABCDEF' for char in value)):
+            raise serializers.ValidationError('Ожидается sha256 в hex')
+        return value.lower()
+
+    def get_completed(self, obj):
+        return bool(obj.file)
+
+
 class ReviewSerializer(serializers.ModelSerializer):
     class Meta:
         model = Review
@@ -0,0 +1,32 @@
+"""
+Хранилище media с адресацией по содержимому: файл сохраняется под именем из sha256 содержимого
+(ab/abcdef...0123.jpg), поэтому одинаковые загрузки разных объектов и пользователей делят один файл.
+Так как файл может использоваться несколькими строками, код приложения файлы не удаляет -
+неиспользуемые удаляет сборщик (media_gc.py)
+"""
+import hashlib
+import os
+
+from django.core.files.storage import FileSystemStorage
+
+
+class ContentAddressedStorage(FileSystemStorage):
+
+    def content_name(self, name, content):
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        extension = os.path.splitext(name)[1].lower()
+        hexdigest = digest.hexdigest()
+        return f'{hexdigest[:2]}/{hexdigest}{extension}'
+
+    def _save(self, name, content):
+        # имя от Storage.save (с суффиксом от get_available_name) не используется, важно только расширение
+        name = self.content_name(name, content)
+        if self.exists(name):
+            # файл мог уже считаться мусором: свежее время изменения защищает его от сборщика,
+            # пока ссылка на него не сохранена в БД
+            os.utime(self.path(name))
+            return name
+        return super()._save(name, content)
@@ -1,9 +1,15 @@
 from celery import shared_task
+from django.apps import apps
 from django.conf import settings
 from django.core.mail import send_mail
+from django.db import transaction
 from celery_app import app
 import os
 
+from . import cache as catalog_cache
+from .geocoder import nominatim_city, parse_point
+from .images import generate_variants
+
 
 # Асинхронная отправка почты через селари
 
@@ -15,4 +21,62 @@ def send_registration_email(email, password):
         from_email=settings.EMAIL_HOST_USER,
         recipient_list=[email],
         fail_silently=True
-    )
\ No newline at end of file
+    )
+
+
+@shared_task()
+def generate_image_variants(app_label, model_name, pk, field_name, variants_field):
+    """Уменьшенные варианты картинки объекта (см. images.py), запускается сигналом после сохранения"""
+    model = apps.get_model(app_label, model_name)
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    field_file = getattr(instance, field_name)
+    old = getattr(instance, variants_field) or {}
+    if not field_file or (old.get('source') == field_file.name and 'original' in old):
+        return
+
+    variants = generate_variants(field_file)
+    # записываем, только если картинку не успели заменить, пока шла генерация
+    # старые варианты не удаляются: файлы общие (storage.py), неиспользуемые удалит сборщик media_gc
+    updated = model.objects.filter(pk=pk, **{field_name: field_file.name}).update(**{variants_field: variants})
+    if updated:
+        # update() не вызывает сигналов, списки каталога сбрасываем сами
+        from .models import CATALOG_MODELS, photo_catalog_models
+        for catalog_model in (photo_catalog_models(instance) if model_name == 'photo' else [model]):
+            if catalog_model in CATALOG_MODELS:
+                catalog_cache.invalidate(catalog_model)
+
+
+@shared_task()
+def collect_orphan_media():
+    """Удаление неиспользуемых файлов media, запускается celery beat (CELERY_BEAT_SCHEDULE)"""
+    from .media_gc import collect
+    report = collect()
+    return {key: value for key, value in report.items() if key != 'examples'}
+
+
+@shared_task()
+def trim_resized_images():
+    """Удаление давно использованных копий resize.py сверх RESIZE_CACHE_MAX_BYTES, запускается celery beat"""
+    from .resize import trim
+    return trim(settings.RESIZE_CACHE_MAX_BYTES)
+
+
+@shared_task()
+def resolve_location(app_label, model_name, pk):
+    """Город объекта через Nominatim, если его нет в локальном справочнике (geocoder.py)"""
+    model = apps.get_model(app_label, model_name)
+    instance = model.objects.filter(pk=pk).only('latitude', 'longitude', 'location').first()
+    if instance is None or instance.location:
+        return
+    point = parse_point(instance.latitude, instance.longitude)
+    city = nominatim_city(*point) if point else None
+    if not city:
+        return
+    with transaction.atomic():
+        instance = model.objects.select_for_update().filter(pk=pk, location__isnull=True).first()
+        if instance is not None:
+            # через save, чтобы сигналы привязали объект к городу из справочника и обновили счетчики
+            instance.location = city[:50]
+            instance.save(update_fields=['location', 'city'])
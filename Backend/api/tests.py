@@ -0,0 +1,1380 @@
+import base64
+import fcntl
+import hashlib
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+import numpy as np
+from PIL import Image
+from rest_framework.test import APIClient
+
+from users.models import User
+from . import cities, favorites, geo, geocoder, images, media_gc, resize, routes, uploads
+from .models import (Hotel, Restaurant, Transport, Excursion, Photo, Review, Kitchen, Features,
+                     TripFolder, Favorite, FavoriteItem, WorkingHours, UploadSession, City, Facilities)
+from .tasks import trim_resized_images
+
+
+class CatalogListQueriesTest(TestCase):
+    """Число запросов в списках каталога не зависит от количества объектов"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.folder = TripFolder.objects.create(name='trip', user=self.user)
+
+    def create_object(self, model, review_field=None):
+        extra = {} if model is Excursion else {'workingDays': WorkingHours.objects.create(monday='09:00-18:00')}
+        obj = model.objects.create(name='object', description='description', owner=self.user, status=True, **extra)
+        obj.photos.add(Photo.objects.create(photo='photo.jpg'))
+        if review_field:
+            Review.objects.create(user=self.user, rating=5, **{review_field: obj})
+        favorites.apply(self.user, [{'type': model._meta.model_name, 'id': obj.id, 'folders': [self.folder.id]}])
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context), len(response.data['results'])
+
+    def assert_constant_queries(self, url, *args):
+        self.create_object(*args)
+        queries = [self.count_queries(url), self.count_queries(url + '?view=full')]
+        self.assertEqual([count for _, count in queries], [1, 1])
+        for _ in range(5):
+            self.create_object(*args)
+        self.assertEqual(self.count_queries(url), (queries[0][0], 6))
+        self.assertEqual(self.count_queries(url + '?view=full'), (queries[1][0], 6))
+
+    def test_hotels(self):
+        self.assert_constant_queries('/api/hotels/', Hotel, 'hotel')
+
+    def test_restaurants(self):
+        self.assert_constant_queries('/api/restaurants/', Restaurant, 'restaurant')
+
+    def test_transport(self):
+        self.assert_constant_queries('/api/transport/', Transport)
+
+    def test_excursions(self):
+        self.assert_constant_queries('/api/excursions/', Excursion, 'excursion')
+
+    def test_is_favorite(self):
+        self.create_object(Hotel, 'hotel')
+        Hotel.objects.create(name='other', description='description', owner=self.user, status=True)
+        response = self.client.get('/api/hotels/')
+        self.assertEqual(sorted(item['is_favorite'] for item in response.data['results']), [False, True])
+
+    def test_summary_and_full_view(self):
+        self.create_object(Hotel, 'hotel')
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            item = self.client.get('/api/hotels/').data['results'][0]
+        # краткому представлению - только страница объектов без JOIN и prefetch'ей и набор id избранного
+        self.assertEqual(len(queries), 2)
+        self.assertNotIn('JOIN', queries.captured_queries[0]['sql'])
+        self.assertEqual(set(item), {'id', 'name', 'image', 'rate', 'review_count', 'cost',
+                                     'location', 'distance', 'is_favorite', 'image_variants', 'image_meta'})
+        self.assertEqual(item['review_count'], 1)
+        item = self.client.get('/api/hotels/?view=full').data['results'][0]
+        self.assertEqual(len(item['reviews']), 1)
+        self.assertEqual(len(item['photos']), 1)
+
+
+class KeysetPaginationTest(TestCase):
+    """Курсорная пагинация списков каталога"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for i in range(7):
+            Hotel.objects.create(name=f'hotel {i}', description='', owner=self.user, status=True,
+                                 rate=i % 2, cost=100 * (i % 3))
+
+    def collect(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 3)
+            ids += [(item['rate'], item['cost'], item['id']) for item in response.data['results']]
+            url = response.data['next']
+        return ids
+
+    def test_pages_cover_all_objects_in_order(self):
+        rows = self.collect('/api/hotels/?page_size=3')
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row[0], row[2]), reverse=True))
+        self.assertEqual(len({row[2] for row in rows}), 7)
+
+        rows = self.collect('/api/hotels/?page_size=3&ordering=cost')
+        self.assertEqual(rows, sorted(rows, key=lambda row: (row[1], row[2])))
+        self.assertEqual(len({row[2] for row in rows}), 7)
+
+    def test_unpaginated_opt_in(self):
+        response = self.client.get('/api/hotels/?paginate=false')
+        self.assertEqual(len(response.data), 7)
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/hotels/?cursor=broken').status_code, 404)
+
+    def test_cursor_is_index_range_bound(self):
+        # кроме OR в запросе есть отдельное условие rate <= значения курсора: по нему индекс
+        # (status, rate, id) начинает сразу с курсора, а не фильтрует все строки до него
+        url = self.client.get('/api/hotels/?page_size=3').data['next']
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        sql = next(query['sql'] for query in queries.captured_queries if 'LIMIT 4' in query['sql'])
+        self.assertRegex(sql, r'"api_hotel"\."status" AND "api_hotel"\."rate" <= [\d.]+ AND \(')
+
+
+class CatalogListCacheTest(TestCase):
+    """Кэш списков каталога: общая часть из кэша, избранное свое у каждого пользователя"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.other = User.objects.create_user(username='other', password='password')
+        self.client = APIClient()
+        self.hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True)
+        folder = TripFolder.objects.create(name='trip', user=self.user)
+        favorites.apply(self.user, [{'type': 'hotel', 'id': self.hotel.id, 'folders': [folder.id]}])
+
+    def get(self, user, url='/api/hotels/'):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        return response.data['results'], len(context)
+
+    def test_cached_response_with_user_favorites(self):
+        results, misses = self.get(self.user)
+        self.assertTrue(results[0]['is_favorite'])
+        results, hits = self.get(self.other)
+        self.assertFalse(results[0]['is_favorite'])
+        self.assertLess(hits, misses)
+
+    def test_invalidation(self):
+        self.get(self.user)
+        self.hotel.name = 'renamed'
+        self.hotel.save()
+        self.assertEqual(self.get(self.user)[0][0]['name'], 'renamed')
+
+        Review.objects.create(hotel=self.hotel, user=self.other, rating=4)
+        self.assertEqual(self.get(self.user)[0][0]['review_count'], 1)
+
+        self.hotel.photos.add(Photo.objects.create(photo='photo.jpg'))
+        self.assertEqual(len(self.get(self.user, '/api/hotels/?view=full')[0][0]['photos']), 1)
+
+        Hotel.objects.create(name='new', description='', owner=self.user, status=True)
+        self.assertEqual(len(self.get(self.user)[0]), 2)
+
+    def test_key_ignores_param_order_and_unknown_params(self):
+        results, misses = self.get(self.user, '/api/hotels/?max_cost=10&min_cost=0')
+        results, hits = self.get(self.user, '/api/hotels/?min_cost=0&max_cost=10&utm=x')
+        self.assertEqual(len(results), 1)
+        self.assertLess(hits, misses)
+
+
+class GeoSearchTest(TestCase):
+    """Гео-поиск: радиус, сочетание с остальными фильтрами и расстояние в выдаче"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Пхукет и точки в ~5 км и ~100 км от него
+        for name, lat, lng, cost in (('near', 7.93, 98.34, 100), ('cheap', 7.9, 98.3, 10),
+                                     ('far', 8.8, 98.34, 100), ('nowhere', None, None, 100)):
+            Restaurant.objects.create(name=name, description='', owner=self.user, status=True,
+                                      latitude=lat, longitude=lng, cost=cost)
+
+    def test_radius_filters_and_distance(self):
+        response = self.client.get('/api/restaurants/?lat=7.88&lng=98.39&radius_km=20&min_cost=50')
+        results = response.data['results']
+        self.assertEqual([item['name'] for item in results], ['near'])
+        self.assertAlmostEqual(results[0]['distance'], 7.8, delta=0.5)
+
+    def test_sorted_by_distance_without_radius(self):
+        response = self.client.get('/api/restaurants/?lat=7.88&lng=98.39&view=full')
+        results = response.data['results']
+        self.assertEqual([item['name'] for item in results], ['near', 'cheap', 'far'])
+        self.assertEqual(results, sorted(results, key=lambda item: item['distance']))
+
+
+class SpatialIndexTest(TestCase):
+    """Индекс координат в памяти: совпадает с точным перебором и обновляется из сигналов"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        rng = random.Random(1)
+        for i in range(200):
+            Hotel.objects.create(name=f'hotel {i}', description='', owner=self.user, status=True,
+                                 latitude=rng.uniform(7, 9), longitude=rng.uniform(98, 100))
+        self.index = geo.SpatialIndex(Hotel)
+
+    def brute_force(self, lat, lng, radius_km):
+        rows = Hotel.objects.filter(status=True).values_list('id', 'latitude', 'longitude')
+        return sorted((geo.haversine(lat, lng, row_lat, row_lng), pk) for pk, row_lat, row_lng in rows
+                      if geo.haversine(lat, lng, row_lat, row_lng) <= radius_km)
+
+    def test_radius_and_nearest_match_brute_force(self):
+        expected = self.brute_force(8, 99, 30)
+        self.assertTrue(expected)
+        found = self.index.radius(8, 99, 30)
+        self.assertEqual([pk for pk, _ in found], [pk for _, pk in expected])
+        for (_, distance), (exact, _) in zip(found, expected):
+            self.assertAlmostEqual(distance, exact, places=6)
+
+        nearest = self.index.nearest(8, 99, 5)
+        self.assertEqual([pk for pk, _ in nearest], [pk for _, pk in self.brute_force(8, 99, 1000)[:5]])
+
+    def collect(self, url):
+        rows, sql = [], []
+        while url:
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            sql += [query['sql'] for query in context.captured_queries if 'LIMIT 5' in query['sql']]
+            rows += [(item['distance'], item['id']) for item in response.data['results']]
+            url = response.data['next']
+        return rows, sql
+
+    def test_list_pages_by_distance_in_windows(self):
+        Hotel.objects.filter(id__in=list(Hotel.objects.order_by('id').values_list('id', flat=True))[::7]).update(promotion=True)
+        expected = sorted((geo.haversine(8, 99, lat, lng), pk) for pk, lat, lng in
+                          Hotel.objects.filter(promotion=True).values_list('id', 'latitude', 'longitude'))
+        for query in ('', '&radius_km=5000'):
+            # фильтр отбрасывает большую часть объектов индекса - окна расширяются, порядок точный
+            rows, sql = self.collect(f'/api/hotels/?lat=8&lng=99&promotion=1&page_size=4{query}')
+            self.assertEqual([pk for _, pk in rows], [pk for _, pk in expected])
+            for (distance, _), (exact, _) in zip(rows, expected):
+                self.assertAlmostEqual(distance, exact, delta=0.01)
+            self.assertTrue(all('"api_hotel"."latitude" BETWEEN' in query for query in sql[:3]))
+            self.assertFalse(any('"api_hotel"."id" IN' in query for query in sql))
+
+    def test_incremental_update(self):
+        self.index.get_arrays()
+        geo._indexes[Hotel] = self.index
+        with self.captureOnCommitCallbacks(execute=True):
+            hotel = Hotel.objects.create(name='new', description='', owner=self.user, status=True,
+                                         latitude=10.5, longitude=99.5)
+        try:
+            with CaptureQueriesContext(connection) as context:
+                self.assertEqual(self.index.nearest(10.5, 99.5, 1)[0][0], hotel.id)
+            self.assertEqual(len(context), 0)  # без перечитывания из БД
+
+            with self.captureOnCommitCallbacks(execute=True):
+                hotel.delete()
+            self.assertNotEqual(self.index.nearest(10.5, 99.5, 1)[0][0], hotel.id)
+        finally:
+            geo._indexes.pop(Hotel, None)
+
+    def test_nearby_endpoint(self):
+        Restaurant.objects.create(name='restaurant', description='', owner=self.user, status=True,
+                                  latitude=8, longitude=99)
+        response = self.client.get('/api/nearby/?lat=8&lng=99&k=5')
+        self.assertEqual(response.status_code, 200)
+        results = response.data
+        self.assertEqual(len(results), 5)
+        self.assertEqual((results[0]['type'], results[0]['name']), ('restaurant', 'restaurant'))
+        self.assertEqual(results, sorted(results, key=lambda item: item['distance']))
+        self.assertEqual(self.client.get('/api/nearby/').status_code, 400)
+
+
+class FullTextSearchTest(TestCase):
+    """Полнотекстовый поиск: русский и английский, префикс, релевантность и пагинация по ней"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for name, description in (('Отель у моря', 'Тихий отель на первой линии'),
+                                  ('Beach resort', 'Quiet hotel with a pool'),
+                                  ('Горный дом', 'Вид на море из окон'),
+                                  ('City hostel', 'Downtown rooms')):
+            Excursion.objects.create(name=name, description=description, owner=self.user, status=True)
+
+    def search(self, text, **params):
+        response = self.client.get('/api/excursions/', {'search': text, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_languages_and_prefix(self):
+        self.assertEqual([item['name'] for item in self.search('моря')['results']], ['Отель у моря', 'Горный дом'])
+        self.assertEqual([item['name'] for item in self.search('hotels')['results']], ['Beach resort'])
+        self.assertEqual([item['name'] for item in self.search('res')['results']], ['Beach resort'])
+        self.assertEqual(len(self.search('???')['results']), 4)  # без слов фильтр не применяется
+
+    def test_updated_on_save(self):
+        excursion = Excursion.objects.get(name='City hostel')
+        excursion.description = 'Сплав по реке'
+        excursion.save()
+        self.assertEqual([item['name'] for item in self.search('сплав')['results']], ['City hostel'])
+
+    def test_pagination_by_rank(self):
+        first = self.search('море', page_size=1)
+        second = self.client.get(first['next']).data
+        self.assertEqual([item['name'] for item in first['results'] + second['results']], ['Отель у моря', 'Горный дом'])
+        self.assertIsNone(second['next'])
+
+
+class TrigramSearchTest(TestCase):
+    """Поиск по местоположению: подстрока и опечатки через триграммный индекс"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        for location in ('Phuket', 'Pattaya', 'Bangkok', None):
+            Hotel.objects.create(name='hotel', description='', owner=self.user, status=True, location=location)
+
+    def locations(self, **params):
+        response = self.client.get('/api/hotels/', params)
+        self.assertEqual(response.status_code, 200)
+        return [item['location'] for item in response.data['results']]
+
+    def test_substring_and_fuzzy(self):
+        self.assertEqual(self.locations(location='huk'), ['Phuket'])
+        self.assertEqual(self.locations(location='Phucket'), [])
+        self.assertEqual(self.locations(location='Phucket', fuzzy='true'), ['Phuket'])
+        self.assertEqual(self.locations(location='Пхукет', fuzzy='true'), ['Phuket'])
+        self.assertEqual(self.locations(location='Паттайя', fuzzy='true'), ['Pattaya'])
+
+    def test_icontains_uses_trigram_index(self):
+        queryset = Hotel.objects.filter(location__icontains='huk')
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+            plan = queryset.explain()
+        self.assertIn('hotel_location_trgm', plan)
+
+
+class FacetsTest(TestCase):
+    """Счетчики фасетов: двумя запросами, с учетом текущих фильтров, из кэша"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.thai, self.italian = Kitchen.objects.create(name='thai'), Kitchen.objects.create(name='italian')
+        self.terrace = Features.objects.create(name='terrace')
+        for cost, rate, kitchens, features in ((100, 4.5, [self.thai], [self.terrace]),
+                                               (700, 3.5, [self.thai, self.italian], []),
+                                               (3000, 2, [self.italian], [self.terrace])):
+            restaurant = Restaurant.objects.create(name='restaurant', description='', owner=self.user,
+                                                   status=True, cost=cost, rate=rate)
+            restaurant.kitchen.add(*kitchens)
+            restaurant.features.add(*features)
+        Restaurant.objects.create(name='hidden', description='', owner=self.user, cost=100)
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(context)
+
+    def test_counts(self):
+        data, queries = self.get('/api/restaurants/facets/')
+        self.assertEqual(queries, 2)
+        self.assertEqual(data['total'], 3)
+        self.assertEqual([bucket['count'] for bucket in data['price']], [1, 1, 0, 1, 0])
+        self.assertEqual(data['price'][1], {'min_cost': 500, 'max_cost': 999, 'count': 1})
+        self.assertEqual([bucket['count'] for bucket in data['rating']], [1, 2, 3, 3])
+        self.assertEqual(data['kitchen'], [{'id': self.italian.id, 'name': 'italian', 'count': 2},
+                                           {'id': self.thai.id, 'name': 'thai', 'count': 2}])
+        self.assertEqual(data['features'], [{'id': self.terrace.id, 'name': 'terrace', 'count': 2}])
+
+    def test_current_filters_and_cache(self):
+        url = f'/api/restaurants/facets/?kitchen={self.thai.id}&max_cost=1000'
+        data, _ = self.get(url)
+        self.assertEqual(data['total'], 2)
+        self.assertEqual({value['name']: value['count'] for value in data['kitchen']}, {'thai': 2, 'italian': 1})
+        self.assertEqual(self.get(url)[1], 0)
+
+        Restaurant.objects.create(name='new', description='', owner=self.user, status=True, cost=10).kitchen.add(self.thai)
+        self.assertEqual(self.get(url)[0]['total'], 3)
+
+
+class RatingAggregatesTest(TestCase):
+    """Агрегаты отзывов: создание, правка, перенос, удаление и пересчет командой"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True)
+        self.other = Hotel.objects.create(name='other', description='', owner=self.user, status=True)
+
+    def assert_rating(self, hotel, count, total, rate):
+        hotel.refresh_from_db()
+        self.assertEqual((hotel.review_count, hotel.rating_sum), (count, total))
+        self.assertAlmostEqual(hotel.rate, rate)
+
+    def test_create_edit_delete(self):
+        first = Review.objects.create(hotel=self.hotel, user=self.user, rating=5)
+        Review.objects.create(hotel=self.hotel, user=self.user, rating=2)
+        self.assert_rating(self.hotel, 2, 7, 3.5)
+
+        first.rating = 3
+        first.save()
+        self.assert_rating(self.hotel, 2, 5, 2.5)
+
+        first.hotel = self.other
+        first.save()
+        self.assert_rating(self.hotel, 1, 2, 2)
+        self.assert_rating(self.other, 1, 3, 3)
+
+        Review.objects.filter(hotel=self.hotel).delete()
+        self.assert_rating(self.hotel, 0, 0, 0)
+
+    def test_rebuild_command(self):
+        Review.objects.create(hotel=self.hotel, user=self.user, rating=4)
+        Hotel.objects.filter(pk=self.hotel.pk).update(review_count=10, rating_sum=1, rate=0.1)
+        call_command('rebuild_rating_aggregates', stdout=io.StringIO())
+        self.assert_rating(self.hotel, 1, 4, 4)
+        self.assert_rating(self.other, 0, 0, 0)
+
+
+class ReviewSummaryTest(TestCase):
+    """Сводка отзывов в объекте и лента отзывов с курсорной пагинацией"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True)
+        self.reviews = [Review.objects.create(hotel=self.hotel, user=self.user, rating=rating, comment=str(i))
+                        for i, rating in enumerate((5, 4, 4, 1, 5))]
+        Review.objects.create(hotel=Hotel.objects.create(name='other', description='', owner=self.user, status=True),
+                              user=self.user, rating=2)
+
+    def test_summary_in_list_and_retrieve(self):
+        item = self.client.get('/api/hotels/?view=full&ordering=cost').data['results'][0]
+        self.assertEqual([review['comment'] for review in item['reviews']], ['4', '3', '2'])
+        self.assertEqual(item['review_summary'], {'count': 5, 'average': 3.8,
+                                                  'histogram': {1: 1, 2: 0, 3: 0, 4: 2, 5: 2}})
+        response = self.client.get(f'/api/hotels/{self.hotel.id}/')
+        self.assertEqual(response.data['review_summary'], item['review_summary'])
+        self.assertEqual(len(response.data['reviews']), 3)
+
+    def test_feed_pagination(self):
+        comments, url = [], f'/api/reviews/?hotel={self.hotel.id}&page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            comments += [review['comment'] for review in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(comments, ['4', '3', '2', '1', '0'])
+
+
+class ImageVariantsTest(TestCase):
+    """Уменьшенные копии картинок: генерация после сохранения и выдача в сериализаторах"""
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def image_file(self, size=(2000, 1000), name='cover.png'):
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, (200, 10, 10, 255)).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def test_variants_generated_and_served(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True,
+                                         image=self.image_file())
+        hotel.refresh_from_db()
+        self.assertEqual(hotel.image_variants['source'], hotel.image.name)
+        self.assertEqual((hotel.image_variants['thumb']['width'], hotel.image_variants['thumb']['height']), (320, 160))
+        self.assertEqual(hotel.image_variants['full']['width'], 1600)
+        with Image.open(os.path.join(self.media, hotel.image_variants['card']['webp'])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (800, 400)))
+
+        item = self.client.get('/api/hotels/').data['results'][0]
+        self.assertEqual(set(item['image_variants']), {'thumb'})
+        self.assertTrue(item['image_variants']['thumb']['jpeg'].endswith('.jpeg'))
+
+        old_thumb = hotel.image_variants['thumb']['webp']
+        with self.captureOnCommitCallbacks(execute=True):
+            hotel.image = self.image_file((100, 50), 'small.png')
+            hotel.save()
+        hotel.refresh_from_db()
+        self.assertEqual(hotel.image_variants['full']['width'], 100)  # маленькие картинки не увеличиваются
+        self.assertNotEqual(hotel.image_variants['thumb']['webp'], old_thumb)  # старые копии удалит сборщик media_gc
+
+    def test_not_ready_variants(self):
+        Hotel.objects.create(name='hotel', description='', owner=self.user, status=True, image=self.image_file())
+        item = self.client.get('/api/hotels/').data['results'][0]
+        self.assertIsNone(item['image_variants'])
+        self.assertTrue(item['image'])
+
+
+class ResizedImageTest(TestCase):
+    """Уменьшение картинок по запросу: whitelist ширин, дисковый кэш, склейка одновременных промахов, LRU"""
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        os.makedirs(os.path.join(self.media, 'photos'))
+        Image.new('RGB', (1000, 500), (10, 200, 10)).save(os.path.join(self.media, 'photos', 'beach.jpg'), 'JPEG')
+
+    def test_resize_and_cache(self):
+        response = self.client.get('/media/resized/320/photos/beach.jpg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (320, 160)))
+        self.assertTrue(os.path.exists(os.path.join(self.media, 'resized', '320', 'photos', 'beach.jpg')))
+
+        with mock.patch('api.resize.resize_image') as resize_image:
+            self.assertEqual(self.client.get('/media/resized/320/photos/beach.jpg').status_code, 200)
+        resize_image.assert_not_called()
+
+    def test_rejected_paths(self):
+        for url in ('/media/resized/321/photos/beach.jpg', '/media/resized/320/photos/missing.jpg',
+                    '/media/resized/320/../etc/passwd', '/media/resized/320/resized/320/photos/beach.jpg'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+
+    def test_not_an_image(self):
+        with open(os.path.join(self.media, 'photos', 'notes.txt'), 'w') as file:
+            file.write('not an image')
+        with open(os.path.join(self.media, 'photos', 'broken.jpg'), 'wb') as file:
+            file.write(open(os.path.join(self.media, 'photos', 'beach.jpg'), 'rb').read()[:100])
+        for url in ('/media/resized/320/photos', '/media/resized/320/photos/notes.txt',
+                    '/media/resized/320/photos/broken.jpg'):
+            self.assertEqual(self.client.get(url).status_code, 404, url)
+        self.assertFalse(os.path.exists(os.path.join(self.media, 'resized', '320', 'photos', 'notes.txt')))
+
+    def test_concurrent_misses_resize_once(self):
+        calls = []
+        original = resize.resize_image
+
+        def slow_resize(*args):
+            calls.append(args)
+            time.sleep(0.2)
+            original(*args)
+
+        with mock.patch('api.resize.resize_image', slow_resize):
+            with ThreadPoolExecutor(8) as executor:
+                paths = list(executor.map(lambda _: resize.resized_path(640, 'photos/beach.jpg'), range(8)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(set(paths)), 1)
+        # lock-файлы не попадают в публично раздаваемое дерево
+        self.assertEqual([name for _, _, files in os.walk(self.media) for name in files if name.endswith('.lock')], [])
+
+    def test_trim_removes_least_recently_used(self):
+        for width in (160, 320, 480):
+            resize.resized_path(width, 'photos/beach.jpg')
+        paths = {width: os.path.join(self.media, 'resized', str(width), 'photos', 'beach.jpg') for width in (160, 320, 480)}
+        now = time.time()
+        for age, width in enumerate((320, 480, 160)):  # 160 использовали последней
+            os.utime(paths[width], (now - 100 + age, now - 100 + age))
+        keep = int(os.path.getsize(paths[160]) / resize.TRIM_RATIO) + 1
+        with override_settings(RESIZE_CACHE_MAX_BYTES=keep):
+            self.assertEqual(trim_resized_images(), 2)
+        self.assertEqual([width for width, path in paths.items() if os.path.exists(path)], [160])
+        self.assertEqual(resize.trim(keep), 0)
+
+    def test_miss_does_not_trim(self):
+        with mock.patch('api.resize.trim') as trim:
+            self.assertEqual(self.client.get('/media/resized/320/photos/beach.jpg').status_code, 200)
+        trim.assert_not_called()
+
+
+class ImageMetadataTest(TestCase):
+    """Размеры, вес и blurhash картинок: считаются вместе с вариантами и отдаются в сериализаторах"""
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def image_file(self, size, name):
+        buffer = io.BytesIO()
+        Image.new('RGB', size, (20, 120, 200)).save(buffer, 'JPEG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/jpeg')
+
+    def test_blurhash(self):
+        # 4x3 компоненты: флаг размеров, максимум AC, DC (средний цвет) и 11 AC по два символа
+        value = images.blurhash(Image.new('RGB', (60, 40), (200, 10, 10)))
+        self.assertEqual(len(value), 1 + 1 + 4 + 2 * 11)
+        self.assertEqual(value[0], images.base83(3 + 2 * 9, 1))
+        self.assertEqual(value[2:6], images.base83((200 << 16) + (10 << 8) + 10, 4))
+
+    def test_variants_scheduled_once_per_image(self):
+        # создание отеля сохраняет его второй раз (комната чата) - задача все равно одна
+        with mock.patch('api.models.generate_image_variants.delay') as delay:
+            with self.captureOnCommitCallbacks(execute=True):
+                hotel = Hotel.objects.create(name='hotel', description='', owner=self.user,
+                                             image=self.image_file((64, 64), 'cover.jpg'))
+                hotel.name = 'renamed'
+                hotel.save()
+            self.assertEqual(delay.call_count, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                hotel.image = self.image_file((32, 32), 'other.jpg')  # имя файла - хэш содержимого
+                hotel.save()
+            self.assertEqual(delay.call_count, 2)
+
+    def test_blurhash_grayscale(self):
+        gray = Image.new('L', (60, 40), 90)
+        self.assertEqual(images.blurhash(gray), images.blurhash(Image.new('RGB', (60, 40), (90, 90, 90))))
+        buffer = io.BytesIO()
+        gray.save(buffer, 'JPEG')
+        with self.captureOnCommitCallbacks(execute=True):
+            photo = Photo.objects.create(photo=SimpleUploadedFile('gray.jpg', buffer.getvalue(), content_type='image/jpeg'))
+        photo.refresh_from_db()
+        self.assertEqual(len(photo.variants['original']['blurhash']), 28)
+
+    def test_photos_and_cover_meta(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True,
+                                         image=self.image_file((640, 480), 'cover.jpg'))
+            photo = Photo.objects.create(photo=self.image_file((300, 600), 'photo.jpg'))
+        hotel.photos.add(photo)
+
+        item = self.client.get('/api/hotels/').data['results'][0]
+        self.assertEqual((item['image_meta']['width'], item['image_meta']['height']), (640, 480))
+        item = self.client.get('/api/hotels/?view=full').data['results'][0]
+        self.assertEqual(item['image_meta']['size'], hotel.image.size)
+        photo_data = item['photos'][0]
+        self.assertEqual(set(photo_data), {'url', 'width', 'height', 'size', 'blurhash'})
+        self.assertEqual((photo_data['width'], photo_data['height']), (300, 600))
+        self.assertTrue(photo_data['url'].endswith('.jpg'))
+        self.assertEqual(len(photo_data['blurhash']), 28)
+
+    def test_rebuild_command(self):
+        photo = Photo.objects.create(photo=self.image_file((100, 100), 'photo.jpg'))  # без on_commit варианты не созданы
+        call_command('rebuild_image_variants', stdout=io.StringIO())
+        photo.refresh_from_db()
+        self.assertEqual(photo.variants['original']['width'], 100)
+
+
+class ChunkedUploadTest(TestCase):
+    """Загрузка фото частями: offset и checksum частей, докачка, прикрепление готовых загрузок к объекту"""
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.partner = User.objects.create_user(username='partner', password='password', role=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.partner)
+        buffer = io.BytesIO()
+        Image.new('RGB', (400, 300), (30, 60, 90)).save(buffer, 'PNG')
+        self.content = buffer.getvalue()
+
+    def start(self, content, **extra):
+        response = self.client.post('/api/uploads/', {'filename': 'photo.png', 'size': len(content), **extra}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        return f"/api/uploads/{response.data['id']}/", response.data['id']
+
+    def put(self, url, chunk, offset, checksum=''):
+        headers = {'HTTP_UPLOAD_OFFSET': str(offset)}
+        if checksum:
+            headers['HTTP_UPLOAD_CHECKSUM'] = checksum
+        return self.client.put(url, chunk, content_type='application/octet-stream', **headers)
+
+    def test_resumable_upload_and_attach(self):
+        url, upload_id = self.start(self.content, checksum=hashlib.sha256(self.content).hexdigest())
+        half = len(self.content) // 2
+        first, second = self.content[:half], self.content[half:]
+
+        self.assertEqual(self.put(url, first, 0, hashlib.sha256(first).hexdigest()).data['offset'], half)
+        response = self.put(url, second, 0)  # повтор с устаревшим offset
+        self.assertEqual((response.status_code, response.data['offset']), (409, half))
+        response = self.put(url, second, half, hashlib.sha256(b'other').hexdigest())
+        self.assertEqual((response.status_code, response.data['offset']), (400, half))
+        self.assertEqual(self.client.get(url).data['offset'], half)  # клиент узнает, с чего продолжить
+
+        response = self.put(url, second, half, hashlib.sha256(second).hexdigest())
+        self.assertTrue(response.data['completed'])
+        self.assertFalse(os.listdir(os.path.join(self.media, uploads.UPLOAD_DIR)))
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/excursions/create/', {'name': 'tour', 'description': 'd', 'uploads': [upload_id]},
+                                        format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        photo_inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "api_photo"')]
+        self.assertEqual(len(photo_inserts), 1)
+        excursion = Excursion.objects.get(name='tour')
+        photo = excursion.photos.get()
+        with open(photo.photo.path, 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_bad_file_and_foreign_upload(self):
+        url, upload_id = self.start(b'not an image')
+        response = self.put(url, b'not an image', 0)
+        self.assertEqual((response.status_code, response.data['offset']), (400, 0))
+
+        other = User.objects.create_user(username='other', password='password', role=2)
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        response = self.client.post('/api/excursions/create/', {'name': 'tour', 'description': 'd', 'uploads': [upload_id]},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Excursion.objects.exists())
+
+    def test_parallel_part_and_offset_compare_and_set(self):
+        url, upload_id = self.start(self.content)
+        half = len(self.content) // 2
+        session = UploadSession.objects.get(pk=upload_id)
+        os.makedirs(os.path.dirname(uploads.part_path(session)))
+        with open(uploads.part_path(session), 'ab') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)  # часть этой загрузки пишет другой запрос
+            response = self.put(url, self.content[:half], 0)
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        self.assertEqual((response.status_code, response.data['offset']), (409, 0))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.put(url, self.content[:half], 0).data['offset'], half)
+        sql = [query['sql'] for query in queries.captured_queries]
+        self.assertFalse([query for query in sql if 'FOR UPDATE' in query])
+        self.assertTrue([query for query in sql if query.startswith('UPDATE "api_uploadsession"') and '"offset" = 0' in query])
+
+        # пока писалась часть, offset в БД изменился (например, загрузку начали заново): часть не засчитывается
+        class Stream(io.BytesIO):
+            def read(self, size=-1):
+                UploadSession.objects.filter(pk=upload_id).update(offset=0)
+                return super().read(size)
+
+        session.refresh_from_db()
+        with self.assertRaises(uploads.UploadError) as error:
+            uploads.write_chunk(session, half, Stream(self.content[half:]), len(self.content) - half)
+        self.assertEqual(error.exception.status, 409)
+        session.refresh_from_db()
+        self.assertEqual((session.offset, session.file.name), (0, ''))
+
+    def test_limits(self):
+        response = self.client.post('/api/uploads/', {'filename': 'big.png', 'size': uploads.MAX_UPLOAD_SIZE + 1}, format='json')
+        self.assertEqual(response.status_code, 400)
+        url, _ = self.start(self.content)
+        self.assertEqual(self.put(url, self.content + b'extra', 0).status_code, 413)
+
+    def test_multipart_photos(self):
+        files = [SimpleUploadedFile(f'photo{i}.png', self.content, content_type='image/png') for i in range(2)]
+        response = self.client.post('/api/excursions/create/', {'name': 'tour', 'description': 'd', 'photos': files},
+                                    format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Excursion.objects.get(name='tour').photos.count(), 2)
+
+
+class AvatarUploadTest(TestCase):
+    """Аватар файлом с ограничением размера при приеме и base64 только для небольших картинок"""
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        buffer = io.BytesIO()
+        Image.new('RGB', (1200, 900), (90, 60, 30)).save(buffer, 'JPEG')
+        self.content = buffer.getvalue()
+
+    def test_multipart_and_raw_body(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put('/api/userinfo/avatar/',
+                                       {'avatar': SimpleUploadedFile('me.jpg', self.content, 'image/jpeg')},
+                                       format='multipart')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.avatar.name.endswith('.jpeg'))
+        self.assertEqual(self.user.avatar_variants['thumb']['width'], 320)  # копии сделала фоновая задача
+
+        response = self.client.put('/api/userinfo/avatar/', self.content, content_type='image/jpeg')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(self.client.get('/api/userinfo/').data['avatar'], response.data['avatar'])
+
+    def test_limits_and_validation(self):
+        with mock.patch('api.uploads.AVATAR_MAX_SIZE', 1000):
+            response = self.client.put('/api/userinfo/avatar/', self.content, content_type='image/jpeg')
+        self.assertEqual(response.status_code, 413)
+        response = self.client.put('/api/userinfo/avatar/', b'not an image', content_type='image/png')
+        self.assertEqual(response.status_code, 400)
+        self.user.refresh_from_db()
+        self.assertFalse(self.user.avatar)
+
+    def test_base64(self):
+        response = self.client.put('/api/userinfo/', {'avatar': base64.b64encode(self.content).decode()}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.user.refresh_from_db()
+        self.assertTrue(self.user.avatar)
+
+        response = self.client.put('/api/userinfo/', {'avatar': base64.b64encode(b'text').decode()}, format='json')
+        self.assertEqual(response.status_code, 400)
+        big = 'A' * (uploads.BASE64_AVATAR_MAX_SIZE * 4 // 3 + 4)
+        self.assertEqual(self.client.put('/api/userinfo/', {'avatar': big}, format='json').status_code, 400)
+        big = 'A' * (uploads.BASE64_AVATAR_MAX_SIZE * 2)
+        self.assertEqual(self.client.put('/api/userinfo/', {'avatar': big}, format='json').status_code, 413)
+
+
+class MediaStorageTest(TestCase):
+    """Одинаковые загрузки - один файл; сборщик удаляет только файлы без ссылок"""
+
+    def setUp(self):
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        settings_override = override_settings(MEDIA_ROOT=self.media)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.user = User.objects.create_user(username='user', password='password')
+
+    def image_file(self, color, name='photo.png'):
+        buffer = io.BytesIO()
+        Image.new('RGB', (40, 30), color).save(buffer, 'PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def test_identical_uploads_share_file(self):
+        first = Photo.objects.create(photo=self.image_file((1, 2, 3), 'a.png'))
+        second = Photo.objects.create(photo=self.image_file((1, 2, 3), 'B.PNG'))
+        other = Photo.objects.create(photo=self.image_file((3, 2, 1), 'a.png'))
+        self.assertEqual(first.photo.name, second.photo.name)
+        self.assertNotEqual(first.photo.name, other.photo.name)
+        self.assertTrue(first.photo.name.endswith('.png'))
+        digest = hashlib.sha256(first.photo.read()).hexdigest()
+        self.assertEqual(first.photo.name, f'{digest[:2]}/{digest}.png')
+
+    def test_collect_orphans(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            kept = Photo.objects.create(photo=self.image_file((10, 10, 10)))
+            removed = Photo.objects.create(photo=self.image_file((20, 20, 20)))
+        kept.refresh_from_db()
+        removed.refresh_from_db()
+        removed_name = removed.photo.name
+        removed.delete()
+        resized = os.path.join(self.media, resize.RESIZE_DIR, '320', 'x.png')
+        os.makedirs(os.path.dirname(resized))
+        open(resized, 'wb').close()
+
+        self.assertEqual(media_gc.collect(min_age=3600)['orphans'], 0)  # свежие файлы не трогаются
+        # оригинал и его копии webp/jpeg (у маленькой картинки все размеры совпадают и хранятся одним файлом)
+        orphan_names = {removed_name, *images.variant_files(removed.variants)}
+        self.assertEqual(len(orphan_names), 3)
+        report = media_gc.collect(dry_run=True, min_age=0)
+        self.assertEqual((report['orphans'], report['deleted']), (3, 0))
+        self.assertEqual(set(report['examples']), orphan_names)
+
+        output = io.StringIO()
+        call_command('collect_orphan_media', '--min-age=0', '--batch-size=2', stdout=output)
+        self.assertIn('удалено: 3', output.getvalue())
+        self.assertFalse(os.path.exists(os.path.join(self.media, removed_name)))
+        self.assertTrue(os.path.exists(kept.photo.path))
+        for name in images.variant_files(kept.variants):
+            self.assertTrue(os.path.exists(os.path.join(self.media, name)))
+        self.assertTrue(os.path.exists(resized))
+
+
+class GeocoderTest(TestCase):
+    """Город по координатам из локального справочника; Nominatim - только фоном и только если включен"""
+
+    def setUp(self):
+        cache.clear()
+        self.partner = User.objects.create_user(username='partner', password='password', role=2)
+        self.client = APIClient()
+        self.client.force_authenticate(self.partner)
+
+    def test_local_lookup(self):
+        self.assertEqual(geocoder.get_city('7.89', '98.30'), 'Patong')
+        self.assertEqual(geocoder.get_city(13.75, 100.50), 'Bangkok')
+        self.assertEqual(geocoder.get_city(18.79, 98.98), 'Chiang Mai')
+        self.assertIsNone(geocoder.get_city(55.75, 37.62))  # далеко от городов справочника
+        for latitude, longitude in ((None, None), ('', '1'), ('abc', 98), (91, 98), ('nan', 98)):
+            self.assertIsNone(geocoder.get_city(latitude, longitude))
+
+    @mock.patch('api.geocoder.Nominatim')
+    def test_create_without_network(self, nominatim):
+        response = self.client.post('/api/hotels/create/', {'name': 'hotel', 'description': 'd',
+                                                            'latitude': 7.88, 'longitude': 98.39}, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(Hotel.objects.get().location, 'Phuket')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/hotels/create/', {'name': 'far', 'description': 'd', 'latitude': 55.75,
+                                                                'longitude': 37.62}, format='json')
+        self.assertIsNone(Hotel.objects.get(name='far').location)  # не строка "None"
+        nominatim.assert_not_called()
+
+    @override_settings(GEOCODER_NOMINATIM_FALLBACK=True)
+    @mock.patch('api.geocoder.Nominatim')
+    def test_nominatim_fallback_cached(self, nominatim):
+        nominatim.return_value.reverse.return_value = mock.Mock(raw={'address': {'town': 'Moscow'}})
+        for name in ('first', 'second'):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/restaurants/create/', {'name': name, 'description': 'd', 'latitude': 55.751,
+                                                              'longitude': 37.618}, format='json')
+            self.assertEqual(Restaurant.objects.get(name=name).location, 'Moscow')
+        self.assertEqual(nominatim.return_value.reverse.call_count, 1)  # второй раз - из кэша
+
+    def test_geocode_command(self):
+        Hotel.objects.create(name='old', description='', owner=self.partner, location='None', latitude=8.09, longitude=98.91)
+        Hotel.objects.create(name='far', description='', owner=self.partner, location='None', latitude=55.75, longitude=37.62)
+        call_command('geocode_locations', stdout=io.StringIO())
+        self.assertEqual(dict(Hotel.objects.values_list('name', 'location')), {'old': 'Krabi', 'far': None})
+
+
+class CityTest(TestCase):
+    """Справочник городов: привязка по location, фильтр по городу через city_id и счетчики /cities/"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        cities.load_cities()
+
+    def counts(self, name):
+        return City.objects.filter(name=name).values_list('hotel_count', 'restaurant_count').get()
+
+    def test_resolve_aliases(self):
+        phuket = City.objects.get(name='Phuket').id
+        for name in ('Phuket', ' phuket ', 'ПХУКЕТ', 'Пхукет'):
+            self.assertEqual(City.objects.resolve(name), phuket)
+        for name in ('huk', 'None', '', None):
+            self.assertIsNone(City.objects.resolve(name))
+
+    def test_filter_by_city(self):
+        for location in ('Phuket', 'пхукет', 'Pattaya', 'Phuket Town', None):
+            Hotel.objects.create(name='hotel', description='', owner=self.user, status=True, location=location)
+        self.assertEqual(Hotel.objects.filter(location='пхукет').get().city.name, 'Phuket')
+
+        def locations(**params):
+            response = self.client.get('/api/hotels/', {'summary': 'true', **params})
+            self.assertEqual(response.status_code, 200)
+            return sorted(item['location'] for item in response.data['results'])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(locations(location='Пхукет'), ['Phuket', 'пхукет'])
+        self.assertTrue(any('"city_id" =' in query['sql'] for query in queries.captured_queries))
+        self.assertEqual(locations(city=City.objects.get(name='Pattaya').id), ['Pattaya'])
+        self.assertEqual(locations(location='huk'), ['Phuket', 'Phuket Town'])  # не город - подстрока
+        self.assertEqual(locations(city='abc'), [])
+
+    def test_counts(self):
+        hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, location='Phuket')
+        self.assertEqual(self.counts('Phuket'), (0, 0))  # не опубликован
+        hotel.status = True
+        hotel.save()
+        Restaurant.objects.create(name='restaurant', description='', owner=self.user, status=True, location='Phuket')
+        self.assertEqual(self.counts('Phuket'), (1, 1))
+
+        hotel.location = 'Krabi'
+        hotel.save()
+        self.assertEqual(self.counts('Phuket'), (0, 1))
+        self.assertEqual(self.counts('Krabi'), (1, 0))
+        hotel.status = '0'  # change_status передает значение из запроса как есть
+        hotel.save()
+        self.assertEqual(self.counts('Krabi'), (0, 0))
+        Restaurant.objects.get().delete()
+        self.assertEqual(self.counts('Phuket'), (0, 0))
+
+        Hotel.objects.create(name='hotel', description='', owner=self.user, status=True, location='Krabi')
+        response = self.client.get('/api/cities/')
+        self.assertEqual([(item['name'], item['hotel_count'], item['total']) for item in response.data], [('Krabi', 1, 1)])
+
+    def test_map_command(self):
+        Hotel.objects.bulk_create([Hotel(name='a', description='', owner=self.user, status=True, location=location)
+                                   for location in ('Пхукет', 'None', 'Atlantis', 'Atlantis')])
+        Transport.objects.bulk_create([Transport(name='t', description='', status=True, location='Krabi')])
+        out = io.StringIO()
+        call_command('map_cities', stdout=out)
+        self.assertIn("'Atlantis': 2", out.getvalue())
+        self.assertCountEqual(Hotel.objects.values_list('location', 'city__name'),
+                         [('Atlantis', None), ('Atlantis', None), ('Пхукет', 'Phuket'), (None, None)])
+        self.assertEqual(City.objects.get(name='Krabi').transport_count, 1)
+
+        call_command('map_cities', '--create-missing', stdout=io.StringIO())
+        self.assertEqual(City.objects.get(name='Atlantis').hotel_count, 2)
+        self.assertEqual(City.objects.get(name='Phuket').hotel_count, 1)
+
+
+class TagIdsTest(TestCase):
+    """Массивы id m2m-значений синхронизируются из m2m_changed, фильтр "есть все" - одно условие @>"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.pool, self.wifi, self.spa = (Facilities.objects.create(name=name) for name in ('pool', 'wifi', 'spa'))
+        self.first = Hotel.objects.create(name='first', description='', owner=self.user, status=True)
+        self.second = Hotel.objects.create(name='second', description='', owner=self.user, status=True)
+
+    def ids(self, hotel):
+        hotel.refresh_from_db(fields=['facilities_ids'])
+        return hotel.facilities_ids
+
+    def test_sync(self):
+        self.first.facilities.add(self.spa, self.pool)
+        self.assertEqual(self.ids(self.first), sorted([self.pool.id, self.spa.id]))
+        self.first.facilities.remove(self.spa)
+        self.assertEqual(self.ids(self.first), [self.pool.id])
+
+        self.wifi.hotel_set.add(self.first, self.second)  # со стороны значения
+        self.assertEqual(self.ids(self.first), [self.pool.id, self.wifi.id])
+        self.assertEqual(self.ids(self.second), [self.wifi.id])
+        self.wifi.hotel_set.clear()
+        self.assertEqual(self.ids(self.second), [])
+
+        self.first.facilities.set([self.wifi, self.spa])
+        self.spa.delete()
+        self.assertEqual(self.ids(self.first), [self.wifi.id])
+        self.first.facilities.clear()
+        self.assertEqual(self.ids(self.first), [])
+
+    def test_filter_all_of(self):
+        self.first.facilities.set([self.pool, self.wifi, self.spa])
+        self.second.facilities.set([self.pool])
+
+        def names(*facilities):
+            response = self.client.get('/api/hotels/', {'summary': 'true', 'facilities': [f.id for f in facilities]})
+            self.assertEqual(response.status_code, 200)
+            return sorted(item['name'] for item in response.data['results'])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(names(self.pool, self.wifi), ['first'])
+        sql = queries.captured_queries[0]['sql']
+        self.assertIn('"facilities_ids" @>', sql)
+        self.assertNotIn('api_hotel_facilities', sql)  # без JOIN на каждое значение
+        self.assertEqual(names(self.pool), ['first', 'second'])
+        self.assertEqual(self.client.get('/api/hotels/', {'facilities': 'abc'}).data['results'], [])
+
+
+class FavoriteBulkTest(TestCase):
+    """Пакетное изменение избранного: одна транзакция, фиксированное число запросов, счетчики через F()"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.beach, self.city = (TripFolder.objects.create(user=self.user, name=name) for name in ('beach', 'city'))
+        self.hotels = [Hotel.objects.create(name=f'hotel {i}', description='', owner=self.user) for i in range(5)]
+        self.excursion = Excursion.objects.create(name='excursion', description='', owner=self.user)
+
+    def post(self, *operations):
+        return self.client.post('/api/favorites/bulk/', {'operations': list(operations)}, format='json')
+
+    def test_add_and_remove(self):
+        folders = [self.beach.id, self.city.id]
+        operations = [{'type': 'hotel', 'id': hotel.id, 'folders': folders} for hotel in self.hotels]
+        operations.append({'type': 'excursion', 'id': self.excursion.id, 'folders': folders})
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post(*operations)
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertLessEqual(len(queries), 15)  # не зависит от числа объектов и папок
+        self.assertEqual(response.data['folders'], [{'id': self.beach.id, 'countFavorites': 6},
+                                                    {'id': self.city.id, 'countFavorites': 6}])
+        favorite = Favorite.objects.get(folder=self.beach)
+        self.assertEqual(favorites.folder_item_ids(favorite), {
+            'hotel': [hotel.id for hotel in self.hotels], 'restaurant': [], 'transport': [], 'excursion': [self.excursion.id]})
+
+        # повторное добавление не меняет счетчик, последняя операция с парой определяет итог
+        response = self.post({'type': 'hotel', 'id': self.hotels[0].id, 'folders': folders},
+                             {'action': 'remove', 'type': 'hotel', 'id': self.hotels[1].id, 'folders': [self.beach.id]},
+                             {'action': 'remove', 'type': 'excursion', 'id': self.excursion.id, 'folders': [self.city.id]},
+                             {'type': 'excursion', 'id': self.excursion.id, 'folders': [self.city.id]})
+        self.assertEqual(response.data['folders'], [{'id': self.beach.id, 'countFavorites': 5},
+                                                    {'id': self.city.id, 'countFavorites': 6}])
+        self.assertFalse(self.beach.items.filter(item_type='hotel', item_id=self.hotels[1].id).exists())
+
+    def test_errors_roll_back(self):
+        other = TripFolder.objects.create(user=User.objects.create_user(username='other', password='password'), name='x')
+        response = self.post({'type': 'hotel', 'id': self.hotels[0].id, 'folders': [self.beach.id, other.id]})
+        self.assertEqual(response.status_code, 404)
+        response = self.post({'type': 'hotel', 'id': self.hotels[0].id, 'folders': [self.beach.id]},
+                             {'type': 'excursion', 'id': 10 ** 6, 'folders': [self.beach.id]})
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(FavoriteItem.objects.exists())
+        self.assertEqual(self.post({'type': 'museum', 'id': 1, 'folders': [self.beach.id]}).status_code, 400)
+        self.beach.refresh_from_db()
+        self.assertEqual(self.beach.countFavorites, 0)
+
+    def test_concurrent_remove_counted_once(self):
+        self.post({'type': 'hotel', 'id': self.hotels[0].id, 'folders': [self.beach.id]})
+        bulk_create = FavoriteItem.objects.bulk_create
+
+        def remove_meanwhile(objs):
+            # /favorites/delete/ удаляет ту же строку после того, как apply ее прочитал
+            favorites.remove_items(FavoriteItem.objects.filter(item_id=self.hotels[0].id))
+            return bulk_create(objs)
+
+        with mock.patch.object(FavoriteItem.objects, 'bulk_create', side_effect=remove_meanwhile):
+            response = self.post({'action': 'remove', 'type': 'hotel', 'id': self.hotels[0].id, 'folders': [self.beach.id]})
+        self.assertEqual(response.data['folders'], [{'id': self.beach.id, 'countFavorites': 0}])
+
+    def test_list_folders_counts_excursion_once(self):
+        response = self.client.post('/api/favorites/create/', {'excursions': self.excursion.id,
+                                                               'list_folders': [self.beach.id, self.city.id]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(TripFolder.objects.values_list('countFavorites', flat=True)), [1, 1])
+        self.assertEqual(FavoriteItem.objects.filter(item_type='excursion', item_id=self.excursion.id).count(), 2)
+
+
+class FavoriteCacheTest(TestCase):
+    """is_favorite по кэшу id избранного: после первого запроса - без запросов к таблицам избранного"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.hotel = Hotel.objects.create(name='hotel', description='', owner=self.user, status=True)
+        self.folder = TripFolder.objects.create(name='trip', user=self.user)
+
+    def add(self):
+        favorites.apply(self.user, [{'type': 'hotel', 'id': self.hotel.id, 'folders': [self.folder.id]}])
+
+    def is_favorite(self, url='/api/hotels/'):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        data = response.data['results'][0] if 'results' in response.data else response.data
+        return data['is_favorite'], sum('api_favorite' in query['sql'] for query in queries.captured_queries)
+
+    def test_membership_cached(self):
+        self.add()
+        self.assertEqual(self.is_favorite(), (True, 1))
+        self.assertEqual(self.is_favorite(), (True, 0))
+        self.assertEqual(self.is_favorite(f'/api/hotels/{self.hotel.id}/'), (True, 0))
+
+    def test_updates(self):
+        self.assertEqual(self.is_favorite()[0], False)
+        self.add()
+        self.assertEqual(self.is_favorite()[0], True)
+        self.client.post('/api/favorites/delete/', {'hotel_id': self.hotel.id}, format='json')
+        self.assertEqual(self.is_favorite()[0], False)
+        self.client.post('/api/favorites/bulk/', {'operations': [
+            {'type': 'hotel', 'id': self.hotel.id, 'folders': [self.folder.id]}]}, format='json')
+        self.assertEqual(self.is_favorite()[0], True)
+        self.client.patch(f'/api/favorites/{Favorite.objects.get().id}/', {'hotels': []}, format='json')
+        self.assertEqual(self.is_favorite()[0], False)
+        self.add()
+        self.folder.delete()
+        self.assertEqual(self.is_favorite()[0], False)
+
+
+class FavoriteItemTest(TestCase):
+    """Избранное в одной таблице FavoriteItem: уникальность, удаление одним запросом, перенос старых данных"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.beach, self.city = (TripFolder.objects.create(user=self.user, name=name) for name in ('beach', 'city'))
+        self.hotel = Hotel.objects.create(name='hotel', description='', owner=self.user)
+        self.excursion = Excursion.objects.create(name='excursion', description='', owner=self.user)
+
+    def counts(self):
+        return list(TripFolder.objects.order_by('id').values_list('countFavorites', flat=True))
+
+    def test_unique(self):
+        FavoriteItem.objects.create(user=self.user, folder=self.beach, item_type='hotel', item_id=self.hotel.id)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            FavoriteItem.objects.create(user=self.user, folder=self.beach, item_type='hotel', item_id=self.hotel.id)
+
+    def test_delete_from_all_folders(self):
+        favorites.apply(self.user, [{'type': 'hotel', 'id': self.hotel.id, 'folders': [self.beach.id, self.city.id]},
+                                    {'type': 'excursion', 'id': self.excursion.id, 'folders': [self.beach.id]}])
+        self.assertEqual(self.counts(), [2, 1])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/favorites/delete/', {'hotel_id': self.hotel.id}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(sum(query['sql'].startswith('DELETE') for query in queries.captured_queries), 1)
+        self.assertEqual(self.counts(), [1, 0])
+        response = self.client.post('/api/favorites/delete/', {'hotel_id': self.hotel.id}, format='json')
+        self.assertEqual(response.status_code, 404)
+
+        self.excursion.delete()  # удаление объекта убирает его из папок
+        self.assertEqual(self.counts(), [0, 0])
+        self.assertFalse(FavoriteItem.objects.exists())
+
+    def test_list_and_update(self):
+        favorites.apply(self.user, [{'type': 'hotel', 'id': self.hotel.id, 'folders': [self.beach.id, self.city.id]}])
+        response = self.client.get('/api/favorites/')
+        self.assertEqual([[hotel['id'] for hotel in favorite['hotels']] for favorite in response.data],
+                         [[self.hotel.id], [self.hotel.id]])
+        favorite = Favorite.objects.get(folder=self.beach)
+        response = self.client.patch(f'/api/favorites/{favorite.id}/',
+                                     {'hotels': [], 'excursions': [self.excursion.id]}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual((response.data['hotels'], response.data['excursions']), ([], [self.excursion.id]))
+        self.assertEqual(self.counts(), [1, 1])
+
+    def test_migrate_favorites(self):
+        legacy = Favorite.objects.create(user=self.user, folder=self.beach)
+        legacy.hotels.add(self.hotel)
+        legacy.excursions.add(self.excursion)
+        Favorite.objects.create(user=self.user).hotels.add(self.hotel)  # без папки - не переносится
+        for _ in range(2):
+            out = io.StringIO()
+            call_command('migrate_favorites', stdout=out)
+            self.assertEqual(FavoriteItem.objects.count(), 2)
+            self.assertEqual(self.counts(), [2, 0])
+        self.assertIn('без папки (не перенесены): 1', out.getvalue())
+        self.assertIn('исправлено счетчиков папок: 0', out.getvalue())
+
+
+class FavoriteCardsTest(TestCase):
+    """Краткое избранное: карточки по папкам, число запросов не зависит от числа объектов и папок"""
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def fill(self, folders, per_type):
+        for index in range(folders):
+            folder = TripFolder.objects.create(user=self.user, name=f'folder {index}')
+            operations = []
+            for model in (Hotel, Restaurant, Transport, Excursion):
+                for _ in range(per_type):
+                    obj = model.objects.create(name='object', description='description', owner=self.user, status=True)
+                    operations.append({'type': model._meta.model_name, 'id': obj.id, 'folders': [folder.id]})
+            favorites.apply(self.user, operations)
+
+    def get(self, query=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/favorites/?view=compact' + query)
+        self.assertEqual(response.status_code, 200)
+        return response.data, len(queries)
+
+    def test_constant_queries(self):
+        self.fill(1, 1)
+        data, queries = self.get()
+        self.assertEqual([item['type'] for item in data[0]['items']], ['hotel', 'restaurant', 'transport', 'excursion'])
+        self.assertTrue(all(item['is_favorite'] for item in data[0]['items']))
+        self.assertNotIn('photos', data[0]['items'][0])
+        self.fill(3, 2)
+        data, more_queries = self.get()
+        self.assertEqual((len(data), more_queries), (4, queries))
+
+    def test_full_listing_constant_queries(self):
+        # обычная выдача с полными объектами: фото, отзывы, теги и расписание - пачкой на весь список
+        self.fill(1, 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/favorites/')
+        self.fill(3, 2)
+        for model, field in ((Hotel, 'hotel'), (Restaurant, 'restaurant'), (Excursion, 'excursion')):
+            for obj in model.objects.all():
+                obj.photos.add(Photo.objects.create(photo='photo.jpg'))
+                Review.objects.create(user=self.user, rating=4, **{field: obj})
+        with self.assertNumQueries(len(queries)):
+            data = self.client.get('/api/favorites/').data
+        self.assertEqual([len(folder['hotels']) for folder in data], [1, 2, 2, 2])
+        self.assertEqual(len(data[1]['hotels'][0]['reviews']), 1)
+        self.assertEqual(data[1]['restaurants'][0]['review_summary']['histogram'][4], 1)
+        self.assertTrue(data[1]['excursions'][0]['is_favorite'])
+
+    def test_pages_per_folder(self):
+        self.fill(2, 2)
+        data, _ = self.get('&items_limit=5')
+        self.assertEqual([(len(folder['items']), folder['count'], folder['next_offset']) for folder in data],
+                         [(5, 8, 5), (5, 8, 5)])
+        folder_id = data[0]['folder']
+        first = {(item['type'], item['id']) for item in data[0]['items']}
+        data, _ = self.get(f'&items_limit=5&items_offset=5&folder_id={folder_id}')
+        self.assertEqual([(len(folder['items']), folder['next_offset']) for folder in data], [(3, None)])
+        self.assertFalse(first & {(item['type'], item['id']) for item in data[0]['items']})
+        self.assertEqual(self.client.get('/api/favorites/?view=compact&items_limit=x').status_code, 400)
+
+
+class TripFolderRouteTest(TestCase):
+    """Маршрут по папке: порядок обхода, кэш до изменения папки"""
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='user', password='password')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.folder = TripFolder.objects.create(user=self.user, name='trip')
+
+    def add(self, model, lat, lng):
+        obj = model.objects.create(name='object', description='', owner=self.user, latitude=lat, longitude=lng)
+        favorites.apply(self.user, [{'type': model._meta.model_name, 'id': obj.id, 'folders': [self.folder.id]}])
+        return obj
+
+    def get(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/trip-folders/{self.folder.id}/route/')
+        self.assertEqual(response.status_code, 200)
+        return response.data, sum('api_favoriteitem' in query['sql'] for query in queries.captured_queries)
+
+    def test_optimize(self):
+        # точки на прямой в перемешанном порядке обходятся подряд от старта
+        lngs = [0.3, 0.0, 0.5, 0.1, 0.4, 0.2]
+        order, legs = routes.optimize([0.0] * len(lngs), lngs, start=1)
+        self.assertEqual([lngs[index] for index in order], sorted(lngs))
+        self.assertAlmostEqual(legs.sum(), geo.haversine(0, 0, [0], [0.5])[0], places=6)
+
+        points = np.random.default_rng(1).uniform(0, 1, (300, 2))
+        matrix = routes.distance_matrix(points[:, 0], points[:, 1])
+        greedy = routes.nearest_neighbour(matrix)
+        started = time.perf_counter()
+        order, legs = routes.optimize(points[:, 0], points[:, 1])
+        self.assertLess(time.perf_counter() - started, 5)
+        self.assertEqual(sorted(order), list(range(300)))
+        self.assertLess(legs.sum(), matrix[greedy[:-1], greedy[1:]].sum())
+
+    def test_route(self):
+        far = self.add(Restaurant, 0.0, 0.3)
+        near = self.add(Excursion, 0.0, 0.1)
+        hotel = self.add(Hotel, 0.0, 0.0)
+        unplaced = self.add(Transport, None, None)
+        data, queries = self.get()
+        self.assertEqual([(item['type'], item['id']) for item in data['route']],
+                         [('hotel', hotel.id), ('excursion', near.id), ('restaurant', far.id)])
+        self.assertEqual(data['route'][0]['leg_km'], 0)
+        self.assertEqual(data['without_coordinates'], [{'type': 'transport', 'id': unplaced.id, 'name': 'object'}])
+        self.assertEqual(self.get(), (data, 0))  # из кэша
+
+        favorites.apply(self.user, [{'action': 'remove', 'type': 'excursion', 'id': near.id, 'folders': [self.folder.id]}])
+        data, queries = self.get()
+        self.assertEqual([item['id'] for item in data['route']], [hotel.id, far.id])
+        far.longitude = 0.2
+        with self.captureOnCommitCallbacks(execute=True):  # гео-версия меняется после коммита
+            far.save()
+        self.assertLess(self.get()[0]['distance_km'], data['distance_km'])
+
+        other = User.objects.create_user(username='other', password='password')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get(f'/api/trip-folders/{self.folder.id}/route/').status_code, 404)
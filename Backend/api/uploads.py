@@ -0,0 +1,209 @@
+"""
+Загрузка фото частями с докачкой.
+
+Клиент создает сессию (имя файла, размер и, по желанию, sha256 всего файла) и отправляет части
+PUT-запросами с заголовком Upload-Offset (и Upload-Checksum - sha256 части). После обрыва связи
+текущий offset можно узнать GET-запросом и продолжить с него. Тело запроса пишется в файл
+на диске кусками по READ_SIZE, целиком в памяти не держится. Когда получена последняя часть,
+файл проверяется и переносится в хранилище, а при создании объекта все готовые загрузки
+становятся Photo одним bulk_create и прикрепляются одним photos.add
+"""
+import fcntl
+import hashlib
+import os
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadhandler import FileUploadHandler
+from django.utils import timezone
+from PIL import Image
+from rest_framework import exceptions, serializers
+
+from .models import Photo, UploadSession, schedule_image_variants
+
+UPLOAD_DIR = 'uploads'  # недокачанные файлы, внутри MEDIA_ROOT, чтобы их видели все контейнеры бэкенда
+MAX_UPLOAD_SIZE = 20 * 1024 ** 2
+MAX_CHUNK_SIZE = 4 * 1024 ** 2
+READ_SIZE = 64 * 1024
+AVATAR_MAX_SIZE = 5 * 1024 ** 2
+BASE64_AVATAR_MAX_SIZE = 1024 ** 2  # старые клиенты шлют аватар base64 в JSON; больше - только файлом
+SESSION_TTL = timedelta(days=1)  # незавершенные и неиспользованные загрузки удаляет clear_upload_sessions
+
+
+class FileTooLarge(exceptions.APIException):
+    status_code = 413
+    default_detail = 'Файл слишком большой'
+    default_code = 'file_too_large'
+
+
+class LimitedUploadHandler(FileUploadHandler):
+    """
+    Ограничение размера загрузки для обработчиков Django (ставится перед TemporaryFileUploadHandler).
+    Запрос отклоняется сразу по Content-Length, а без него - как только получено больше max_size байт,
+    не дожидаясь конца тела
+    """
+
+    def __init__(self, request=None, max_size=MAX_UPLOAD_SIZE):
+        super().__init__(request)
+        self.max_size = max_size
+
+    def handle_raw_input(self, input_data, META, content_length, boundary, encoding=None):
+        if content_length and content_length > self.max_size + READ_SIZE:  # запас на заголовки multipart
+            raise FileTooLarge
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > self.max_size:
+            raise FileTooLarge
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+class UploadError(Exception):
+    """Ошибка загрузки части, status - код ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def part_path(session):
+    return os.path.join(settings.MEDIA_ROOT, UPLOAD_DIR, f'{session.pk}.part')
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(READ_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def reset(session, path, message):
+    """Загрузка не прошла проверку: начинается заново"""
+    os.remove(path)
+    session.offset = 0
+    session.save(update_fields=['offset'])
+    raise UploadError(message)
+
+
+def verify_image(file):
+    """ValidationError, если файл - не картинка. Возвращает формат картинки (JPEG, PNG...)"""
+    try:
+        with Image.open(file) as image:
+            image_format = image.format
+            image.verify()
+    except (OSError, SyntaxError, ValueError):
+        raise serializers.ValidationError('Файл не является картинкой')
+    finally:
+        file.seek(0)
+    return image_format
+
+
+def check_chunk(session, offset, length):
+    if session.file:
+        raise UploadError('загрузка уже завершена', status=409)
+    if offset != session.offset:
+        raise UploadError('offset не совпадает с уже полученными данными', status=409)
+    if length is None:
+        raise UploadError('нужен заголовок Content-Length', status=411)
+    if length > MAX_CHUNK_SIZE or offset + length > session.size:
+        raise UploadError('часть больше допустимого размера', status=413)
+
+
+def write_chunk(session, offset, stream, length, checksum=''):
+    """
+    Дописывает часть из stream (length байт) с позиции offset. Последняя часть завершает загрузку.
+    Части одной загрузки пишутся по очереди под fcntl-блокировкой part-файла (параллельная часть
+    получает 409), транзакция на время записи не держится: offset сохраняется одним
+    UPDATE ... WHERE offset = <прежний>, а complete вызывается уже после него
+    """
+    check_chunk(session, offset, length)
+    path = part_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'ab') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadError('часть этой загрузки уже принимается', status=409)
+        # пока открывали файл, предыдущая часть могла закончиться
+        session.refresh_from_db(fields=['offset', 'file'])
+        check_chunk(session, offset, length)
+
+        digest = hashlib.sha256()
+        written = 0
+        with open(path, 'r+b') as file:
+            file.truncate(offset)  # остаток предыдущей оборвавшейся части
+            file.seek(offset)
+            while written < length:
+                block = stream.read(min(READ_SIZE, length - written))
+                if not block:
+                    break
+                file.write(block)
+                digest.update(block)
+                written += len(block)
+            if written != length or (checksum and digest.hexdigest() != checksum.lower()):
+                file.truncate(offset)
+                raise UploadError('часть получена не полностью' if written != length else 'checksum части не совпадает')
+
+        if not UploadSession.objects.filter(pk=session.pk, offset=offset, file='').update(offset=offset + written):
+            raise UploadError('загрузка изменена или отменена', status=409)
+        session.offset = offset + written
+        # блокировка держится и на время проверки файла, чтобы его не трогала следующая часть
+        if session.offset == session.size:
+            complete(session, path)
+
+
+def complete(session, path):
+    """Проверяет собранный файл и переносит его в хранилище"""
+    if session.checksum and file_sha256(path) != session.checksum.lower():
+        reset(session, path, 'checksum файла не совпадает')
+    try:
+        with Image.open(path) as image:
+            image.verify()
+    except (OSError, SyntaxError, ValueError):
+        reset(session, path, 'файл не является картинкой')
+    with open(path, 'rb') as file:
+        session.file.save(session.filename, File(file), save=False)
+    session.save(update_fields=['file'])
+    os.remove(path)
+
+
+def completed_sessions(user, ids):
+    """Завершенные загрузки пользователя по списку id; ValidationError, если какие-то не найдены или не докачаны"""
+    try:
+        ids = {uuid.UUID(str(pk)) for pk in ids}
+    except ValueError:
+        raise serializers.ValidationError({'uploads': 'неверный id загрузки'})
+    sessions = list(UploadSession.objects.filter(user=user, pk__in=ids).exclude(file=''))
+    if len(sessions) != len(ids):
+        raise serializers.ValidationError({'uploads': 'загрузки не найдены или не завершены'})
+    return sessions
+
+
+def attach_photos(obj, files=(), sessions=()):
+    """Фото из файлов запроса и завершенных загрузок: один bulk_create и один photos.add"""
+    photos = [Photo(photo=file) for file in files] + [Photo(photo=session.file.name) for session in sessions]
+    if not photos:
+        return []
+    photos = Photo.objects.bulk_create(photos)
+    obj.photos.add(*photos)
+    UploadSession.objects.filter(pk__in=[session.pk for session in sessions]).delete()
+    # bulk_create не отправляет post_save, генерацию вариантов (images.py) ставим сами
+    for photo in photos:
+        schedule_image_variants(Photo, photo)
+    return photos
+
+
+def delete_session(session):
+    """Отмена загрузки. Готовый файл остается в хранилище (он может быть общим) до сборщика media_gc"""
+    if os.path.exists(part_path(session)):
+        os.remove(part_path(session))
+    session.delete()
+
+
+def expired_sessions():
+    return UploadSession.objects.filter(created_at__lt=timezone.now() - SESSION_TTL)
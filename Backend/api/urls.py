@@ -14,7 +14,7 @@ from .views import (
     TransportListView, TransportRetrieveView, TransportUpdateView,
     FaqCreateView, FaqDeleteView, FaqListView, FaqRetrieveView, FaqUpdateView,
     RefreshTokenn, TripFolderListCreateAPIView,
-    TripFolderRetrieveUpdateDestroyAPIView, FavoriteListAPIView, FavoriteCreateAPIView,
+    TripFolderRetrieveUpdateDestroyAPIView, TripFolderRouteView, FavoriteListAPIView, FavoriteCreateAPIView, FavoriteBulkAPIView,
     FavoriteRetrieveUpdateDestroyAPIView, UserInfo, change_status, delete_user,
     FeaturesRetriveApiView, FeaturesListApiView, KitchenListApiView,
     KitchenRetriveApiView, ServiceListApiView, ServiceRetriveApiView,
@@ -26,7 +26,9 @@ from .views import (
     RewiewCreateView, ReviewListView, StatisticsView, BlockedUser, ApplicationUnblockListView,
     ApplicationUnblockCreateView, ApplicationUnblockUpdateView, RentalServicesRetriveApiView, 
     RentalServicesListApiView, InclusiveListApiView, InclusiveRetriveApiView, 
-    ConditionsListApiView, ConditionsRetriveApiView, InfoViewSet, UserUserInfoView, PartnerUserInfoView, AdminUserInfoView)
+    ConditionsListApiView, ConditionsRetriveApiView, InfoViewSet, NearbyView, CityListView,
+    HotelFacetsView, RestaurantFacetsView, TransportFacetsView, ExcursionFacetsView,
+    UploadSessionCreateView, UploadSessionView, AvatarUploadView, UserUserInfoView, PartnerUserInfoView, AdminUserInfoView)
 
 
 schema_view = get_schema_view(
@@ -54,6 +56,7 @@ urlpatterns = [
     path('register/', RegistrationView.as_view(), name='registration'),
     path('users/delete/', delete_user),
     path('userinfo/', UserInfo.as_view(), name='get_user_info'),
+    path('userinfo/avatar/', AvatarUploadView.as_view(), name='avatar_upload'),
 
     path('users/info/', UserUserInfoView.as_view(), name='user_info'),
     path('partners/info/', PartnerUserInfoView.as_view(), name='partner_info'),
@@ -64,12 +67,14 @@ urlpatterns = [
     path('updatepassword/', UpdatePasswordView.as_view(), name='update_password'),
 
     path('hotels/', HotelListView.as_view(), name='hotel-list'),
+    path('hotels/facets/', HotelFacetsView.as_view(), name='hotels-facets'),
     path('hotels/create/', HotelCreateView.as_view(), name='hotel-create'),
     path('hotels/<int:pk>/', HotelRetrieveView.as_view(), name='hotel-retrieve'),
     path('hotels/<int:pk>/update/', HotelUpdateView.as_view(), name='hotel-update'),
     path('hotels/<int:pk>/delete/', HotelDeleteView.as_view(), name='hotel-delete'),
 
     path('restaurants/', RestaurantListView.as_view(), name='restaurant-list'),
+    path('restaurants/facets/', RestaurantFacetsView.as_view(), name='restaurants-facets'),
     path('restaurants/create/', RestaurantCreateView.as_view(), name='restaurant-create'),
     path('restaurants/<int:pk>/', RestaurantRetrieveView.as_view(), name='restaurant-retrieve'),
     path('restaurants/<int:pk>/update/', RestaurantUpdateView.as_view(), name='restaurant-update'),
@@ -88,6 +93,7 @@ urlpatterns = [
     path('news/<int:pk>/delete/', NewsDeleteView.as_view(), name='news-delete'),
 
     path('transport/', TransportListView.as_view(), name='transport-list'),
+    path('transport/facets/', TransportFacetsView.as_view(), name='transport-facets'),
     path('transport/create/', TransportCreateView.as_view(), name='transport-create'),
     path('transport/<int:pk>/', TransportRetrieveView.as_view(), name='transport-retrieve'),
     path('transport/<int:pk>/update/', TransportUpdateView.as_view(), name='transport-update'),
@@ -95,8 +101,10 @@ urlpatterns = [
 
     path('trip-folders/', TripFolderListCreateAPIView.as_view(), name='trip-folder-list-create'),
     path('trip-folders/<int:pk>/', TripFolderRetrieveUpdateDestroyAPIView.as_view(), name='trip-folder-retrieve-update-destroy'),
+    path('trip-folders/<int:pk>/route/', TripFolderRouteView.as_view(), name='trip-folder-route'),
     path('favorites/', FavoriteListAPIView.as_view(), name='favorite-list'),
     path('favorites/create/', FavoriteCreateAPIView.as_view(), name='favorite-create'),
+    path('favorites/bulk/', FavoriteBulkAPIView.as_view(), name='favorite-bulk'),
     path('favorites/<int:pk>/', FavoriteRetrieveUpdateDestroyAPIView.as_view(), name='favorite-retrieve-update-destroy'),
     path('favorites/delete/', DeleteFavoriteAPIView.as_view(), name='delete favorite'),
 
@@ -125,12 +133,19 @@ urlpatterns = [
     path('conditions/<int:pk>/', ConditionsRetriveApiView.as_view(), name='retrive condition of excursion'),
 
     path('excursions/', ExcursionListView.as_view(), name='list of excursions'),
+    path('excursions/facets/', ExcursionFacetsView.as_view(), name='excursions-facets'),
     path('excursions/create/', ExcursionCreateView.as_view(), name='excursions-create'),
     path('excursions/<int:pk>/', ExcursionRetrieveView.as_view(), name='excursions-retrieve'),
 
     path('excursions/<int:pk>/update/', ExcursionUpdateView.as_view(), name='excursions-update'),
     path('excursions/<int:pk>/delete/', ExcursionDeleteView.as_view(), name='excursions-delete'),
 
+    path('nearby/', NearbyView.as_view(), name='nearby'),
+    path('cities/', CityListView.as_view(), name='cities'),
+
+    path('uploads/', UploadSessionCreateView.as_view(), name='upload-create'),
+    path('uploads/<uuid:pk>/', UploadSessionView.as_view(), name='upload'),
+
     path('applications/', UserApplicationsView.as_view(), name='list of user applications'),
     path('applications/create/', UserCreateApplicationView.as_view(), name='create user application'),
     path('applications/<int:pk>/status/', ApplicationUpdateStatus.as_view(), name='update status'),
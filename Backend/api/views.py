@@ -1,25 +1,28 @@
 from django.contrib.auth import authenticate
 from django.core.mail import send_mail
 from django.contrib.auth.hashers import make_password
-from django.http import Http404, JsonResponse
+from django.http import FileResponse, Http404, JsonResponse
 from django.shortcuts import get_object_or_404
 from django.template.loader import render_to_string
 from .tasks import send_registration_email
 from django_filters.rest_framework import DjangoFilterBackend
-from django.core.exceptions import ValidationError
-from django.db.models import F
+from django.core.exceptions import SuspiciousFileOperation, ValidationError
+from django.core.cache import cache
+from django.core.files.uploadhandler import TemporaryFileUploadHandler
+from django.db.models import F, Q
 
 from rest_framework_simplejwt.views import TokenViewBase
 from rest_framework.response import Response
 from rest_framework import status, permissions, generics, filters, serializers
 from rest_framework.views import APIView
+from rest_framework.parsers import FileUploadParser, MultiPartParser
 from rest_framework.viewsets import ModelViewSet
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import api_view, permission_classes, authentication_classes
-from rest_framework.pagination import PageNumberPagination
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
+import mimetypes
 import os
 
 
@@ -33,20 +36,36 @@ from .serializers import (
     KitchenSerializer, ConditionsSerializer, InclusiveSerializer,
     ExcursionSerializer, ApplicationOnExcursionSerializer, ApplicationUpdateStatus,
     RemoveFavoriteSerializer, ReviewSerializer, PartnerProfileSerializer, 
-    AdminPartnerRegisterSerializer, InfoSerializer
+    AdminPartnerRegisterSerializer, InfoSerializer, HotelListSerializer, RestaurantListSerializer,
+    TransportListSerializer, ExcursionListSerializer, UploadSessionSerializer, CitySerializer, FavoriteBulkSerializer, FavoriteCardsSerializer
     )
-from .scripts import generate_code, get_city
+from .scripts import generate_code
+from . import cities, favorite_cache, favorites, geocoder, routes
 from users.models import User
-from .models import (Hotel, Photo, RentalServices, Restaurant, Faq, News,
-                     Transport, TripFolder, Favorite, Features,
+from .models import (Hotel, Photo, RentalServices, UploadSession, Restaurant, Faq, News,
+                     Transport, TripFolder, Favorite, FavoriteItem, Features,
                      Kitchen, Service, Facilities, TypeRoom,
                      Conditions, Inclusive, Excursion, ApplicationOnExcursion,
-                     Review, ApplicationUnblock, Info)
+                     Review, ApplicationUnblock, Info, TAG_ID_FIELDS, review_histograms)
 from .permissions import IsPartnerOrAdmin, IsAdmin, IsPartnerOrAdminCreate, IsPartnerOrAdminForApplicationsOnExcursions, IsUser
 from .filters import (
     HotelFilter, FavoriteFilter, RestaurantFilter, 
     ReviewFilter, RestaurantFilter, ExcursionFilter, ApplicationOnExcursionFilter, TransportFilterBackend)
-from .pagination import Paginator
+from .pagination import KeysetPagination, ReviewPagination
+from . import cache as catalog_cache
+from . import geo
+from .facets import count_facets
+from .images import variant_urls
+from . import resize
+from . import uploads
+
+
+def request_list(data, key):
+    """Список значений из multipart (несколько полей с одним именем) или JSON-массива"""
+    if hasattr(data, 'getlist'):
+        return data.getlist(key)
+    value = data.get(key) or []
+    return value if isinstance(value, list) else [value]
 
 
 class RefreshTokenn(APIView):
@@ -328,14 +347,97 @@ class UpdatePasswordView(APIView):
                         status=status.HTTP_200_OK)
 
 
-# Пагинация раньше была, с предыдущим разработчиком делали, новый просил убрать
+# общие query-параметры списков каталога для swagger
+catalog_list_parameters = [
+    openapi.Parameter('cursor', openapi.IN_QUERY, description="Курсор следующей страницы (из поля next)", type=openapi.TYPE_STRING),
+    openapi.Parameter('page_size', openapi.IN_QUERY, description="Размер страницы, до 100", type=openapi.TYPE_INTEGER),
+    openapi.Parameter('ordering', openapi.IN_QUERY, description="Сортировка: rate, -rate, cost, -cost, distance, -rank, -similarity", type=openapi.TYPE_STRING),
+    openapi.Parameter('paginate', openapi.IN_QUERY, description="false - вернуть весь список без пагинации", type=openapi.TYPE_BOOLEAN),
+    openapi.Parameter('view', openapi.IN_QUERY, description="full - полное представление объектов вместо краткого", type=openapi.TYPE_STRING),
+]
+
+# гео-поиск, общий для всех списков каталога (см. filters.filter_by_distance)
+geo_list_parameters = [
+    openapi.Parameter('lat', openapi.IN_QUERY, description="Широта точки поиска", type=openapi.TYPE_NUMBER),
+    openapi.Parameter('lng', openapi.IN_QUERY, description="Долгота точки поиска", type=openapi.TYPE_NUMBER),
+    openapi.Parameter('radius_km', openapi.IN_QUERY, description="Радиус поиска в км, выдача сортируется по расстоянию", type=openapi.TYPE_NUMBER),
+]
+
+# текстовый поиск: полнотекстовый по названию и описанию, нечеткий по местоположению (см. search.py)
+search_list_parameters = [
+    openapi.Parameter('search', openapi.IN_QUERY, description="Поиск по названию и описанию, последнее слово ищется по префиксу; выдача сортируется по релевантности", type=openapi.TYPE_STRING),
+    openapi.Parameter('fuzzy', openapi.IN_QUERY, description="true - location (и name у транспорта) ищутся с учетом опечаток и транслитерации, выдача сортируется по сходству", type=openapi.TYPE_BOOLEAN),
+]
+
+
+# Списки каталога пагинируются курсором, весь список целиком - через ?paginate=false (для старых версий приложения)
 # Дефолтные круд операции без логики особой комментить не буду
-class HotelListView(generics.ListAPIView):
-    queryset = Hotel.objects.prefetch_related('owner', 'chat_room', 'type_room', 'facilities', 'services').filter(status=True) # фильтрую по статусу чтоб в выдаче были только уже одобренные админом отели (то же самое для прочих объектов)
+class CatalogListMixin:
+    """
+    Выдача списка объектов каталога пачкой: фото и отзывы подтягиваются prefetch'ем,
+    избранное пользователя - одним запросом на всю страницу, сам ответ кэшируется (см. cache.py),
+    поэтому число запросов не зависит от количества объектов.
+    По умолчанию отдается краткое представление (summary_serializer_class),
+    полное - по ?view=full
+    """
+    summary_serializer_class = None
+    reviews_field = None  # related_name отзывов у модели, если отзывы есть
+    cache_params = ('view',)  # параметры самой вьюхи, влияющие на ответ (фильтры и пагинация объявляют свои)
+
+    def is_full_view(self):
+        return self.request.query_params.get('view') == 'full'
+
+    def get_serializer_class(self):
+        if self.is_full_view():
+            return self.serializer_class
+        return self.summary_serializer_class
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        queryset = queryset.defer('search_vector', *TAG_ID_FIELDS.get(queryset.model, {}).values())  # только для фильтров
+        # связи - только те, что читает выбранное представление: краткому не нужны ни фото, ни отзывы, ни теги
+        return self.get_serializer_class().prepare_queryset(queryset)
+
+    def get_favorite_ids(self, ids):
+        """id объектов страницы, которые есть в избранном у пользователя"""
+        return favorite_cache.get_ids(self.request.user, self.queryset.model).intersection(ids)
+
+    def list(self, request, *args, **kwargs):
+        # общая для всех пользователей часть ответа берется из кэша, is_favorite проставляется поверх
+        key = catalog_cache.list_key(self)
+        data = cache.get(key)
+        if data is None:
+            data = self.get_list_data()
+            cache.set(key, data, catalog_cache.LIST_TIMEOUT)
+        items = data['results'] if isinstance(data, dict) else data
+        favorite_ids = self.get_favorite_ids([item['id'] for item in items])
+        for item in items:
+            item['is_favorite'] = item['id'] in favorite_ids
+        return Response(data)
+
+    def get_list_data(self):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objects = page if page is not None else queryset
+        context = self.get_serializer_context()
+        context['favorite_ids'] = set()  # избранное не кэшируется, его проставляет list()
+        if self.is_full_view() and self.reviews_field:
+            objects = list(objects)
+            context['review_histograms'] = review_histograms(self.queryset.model, [obj.id for obj in objects])
+        serializer = self.get_serializer_class()(objects, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data).data
+        return serializer.data
+
+
+class HotelListView(CatalogListMixin, generics.ListAPIView):
+    queryset = Hotel.objects.filter(status=True) # фильтрую по статусу чтоб в выдаче были только уже одобренные админом отели (то же самое для прочих объектов)
     serializer_class = HotelSerializer
+    summary_serializer_class = HotelListSerializer
+    reviews_field = 'reviewsHotels'
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
-    # pagination_class = Paginator
+    pagination_class = KeysetPagination
     filter_backends = [HotelFilter, filters.OrderingFilter]
 
     @swagger_auto_schema(
@@ -366,6 +468,12 @@ class HotelListView(generics.ListAPIView):
                 type=openapi.TYPE_STRING,
                 description='Фильтр по местоположению отеля'
             ),
+            openapi.Parameter(
+                name='city',
+                in_=openapi.IN_QUERY,
+                type=openapi.TYPE_INTEGER,
+                description='id города из /cities/'
+            ),
             openapi.Parameter(
                 name='type_rooms',
                 in_=openapi.IN_QUERY,
@@ -387,7 +495,7 @@ class HotelListView(generics.ListAPIView):
                 items=openapi.Items(type=openapi.TYPE_INTEGER),
                 description='Список ID услуг для фильтрации'
             ),
-        ],
+        ] + geo_list_parameters + search_list_parameters + catalog_list_parameters,
     )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
@@ -401,18 +509,15 @@ class HotelCreateView(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         user = self.request.user
-        if 'photos' in self.request.data:
-            photos_data = self.request.data.getlist('photos')
-        else:
-            photos_data = None
+        photos_data = request_list(self.request.data, 'photos')
+        sessions = uploads.completed_sessions(user, request_list(self.request.data, 'uploads'))
         latitude = self.request.data.get('latitude') # получаем широту из запроса
         longitude = self.request.data.get('longitude') # получаем долготу из запроса
-        city = str(get_city(latitude=latitude, longitude=longitude))
+        # локальный справочник, без сетевых запросов; если город не найден, остается переданный клиентом
+        city = geocoder.get_city(latitude, longitude) or serializer.validated_data.get('location')
         hotel = serializer.save(owner=user, location=city)
-        if 'photos' in self.request.data:
-            for photo_data in photos_data:
-                photo = Photo.objects.create(photo=photo_data)
-                hotel.photos.add(photo)
+        geocoder.resolve_later(hotel)
+        uploads.attach_photos(hotel, photos_data, sessions)
 
         serializer.save(owner=user)
 
@@ -438,25 +543,28 @@ class HotelDeleteView(generics.DestroyAPIView):
     permission_classes = [IsPartnerOrAdmin]
 
 
-class RestaurantListView(generics.ListAPIView):
-    queryset = Restaurant.objects.prefetch_related('chat_room', 'owner', 'features', 'kitchen').filter(status=True)
+class RestaurantListView(CatalogListMixin, generics.ListAPIView):
+    queryset = Restaurant.objects.filter(status=True)
     serializer_class = RestaurantSerializer
+    summary_serializer_class = RestaurantListSerializer
+    reviews_field = 'reviewsRestaurants'
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     filter_backends = [filters.OrderingFilter, RestaurantFilter]
-    # pagination_class = Paginator
+    pagination_class = KeysetPagination
 
     @swagger_auto_schema(
         operation_description="Получение списка ресторанов. JWT Аутентификация. Доступно всем аутентифицированным.",
         operation_summary="Получение списка ресторанов",
         manual_parameters=[
             openapi.Parameter('location', openapi.IN_QUERY, description="Фильтр по местоположению", type=openapi.TYPE_STRING),
+            openapi.Parameter('city', openapi.IN_QUERY, description="id города из /cities/", type=openapi.TYPE_INTEGER),
             openapi.Parameter('promotion', openapi.IN_QUERY, description="Фильтр по акции", type=openapi.TYPE_STRING),
             openapi.Parameter('features', openapi.IN_QUERY, description="Фильтр по особенностям", type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_INTEGER)),
             openapi.Parameter('kitchen', openapi.IN_QUERY, description="Фильтр по кухне", type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_INTEGER)),
             openapi.Parameter('min_cost', openapi.IN_QUERY, description="Фильтр по минимальной стоимости", type=openapi.TYPE_NUMBER),
             openapi.Parameter('max_cost', openapi.IN_QUERY, description="Фильтр по максимальной стоимости", type=openapi.TYPE_NUMBER),
-        ]
+        ] + geo_list_parameters + search_list_parameters + catalog_list_parameters
     )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
@@ -470,18 +578,15 @@ class RestaurantCreateView(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         user = self.request.user
-        if 'photos' in self.request.data:
-            photos_data = self.request.data.getlist('photos')
-        else:
-            photos_data = None
+        photos_data = request_list(self.request.data, 'photos')
+        sessions = uploads.completed_sessions(user, request_list(self.request.data, 'uploads'))
         latitude = self.request.data.get('latitude') # получаем широту из запроса
         longitude = self.request.data.get('longitude') # получаем долготу из запроса
-        city = str(get_city(latitude=latitude, longitude=longitude))
+        # локальный справочник, без сетевых запросов; если город не найден, остается переданный клиентом
+        city = geocoder.get_city(latitude, longitude) or serializer.validated_data.get('location')
         restaurant = serializer.save(owner=user, location=city)
-        if photos_data:
-            for photo_data in photos_data:
-                photo = Photo.objects.create(photo=photo_data)
-                restaurant.photos.add(photo)
+        geocoder.resolve_later(restaurant)
+        uploads.attach_photos(restaurant, photos_data, sessions)
 
         serializer.save(owner=user)
 
@@ -577,12 +682,13 @@ class NewsDeleteView(generics.DestroyAPIView):
     permission_classes = [IsAdmin]
 
 
-class TransportListView(generics.ListAPIView):
+class TransportListView(CatalogListMixin, generics.ListAPIView):
     queryset = Transport.objects.filter(status=True)
     serializer_class = TransportSerializer
+    summary_serializer_class = TransportListSerializer
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
-    # pagination_class = Paginator
+    pagination_class = KeysetPagination
     filter_backends = [filters.OrderingFilter, TransportFilterBackend]
 
 
@@ -594,18 +700,15 @@ class TransportCreateView(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         user = self.request.user
-        if 'photos' in self.request.data:
-            photos_data = self.request.data.getlist('photos')
-        else:
-            photos_data = None
+        photos_data = request_list(self.request.data, 'photos')
+        sessions = uploads.completed_sessions(user, request_list(self.request.data, 'uploads'))
         latitude = self.request.data.get('latitude') # получаем широту из запроса
         longitude = self.request.data.get('longitude') # получаем долготу из запроса
-        city = str(get_city(latitude=latitude, longitude=longitude))
+        # локальный справочник, без сетевых запросов; если город не найден, остается переданный клиентом
+        city = geocoder.get_city(latitude, longitude) or serializer.validated_data.get('location')
         transport = serializer.save(location=city)
-        if photos_data is not None:
-            for photo_data in photos_data:
-                photo = Photo.objects.create(photo=photo_data)
-                transport.photos.add(photo)
+        geocoder.resolve_later(transport)
+        uploads.attach_photos(transport, photos_data, sessions)
         serializer.save(owner=user)
 
 
@@ -650,26 +753,79 @@ class TripFolderRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIVi
     serializer_class = TripFolderSerializer
 
 
+class TripFolderRouteView(APIView):
+    """Порядок обхода объектов папки поездки: ближайший сосед и 2-opt по матрице расстояний (routes.py)"""
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(
+        operation_summary="Маршрут по папке поездки",
+        operation_description="Объекты папки с координатами в порядке обхода (начиная с отеля, если он есть) "
+                              "и расстояния переходов в км; объекты без координат - в without_coordinates")
+    def get(self, request, pk):
+        folder = TripFolder.objects.filter(pk=pk, user=request.user).first()
+        if folder is None:
+            return Response({'error': 'папка не найдена'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(routes.folder_route(folder))
+
+
 class FavoriteListAPIView(generics.ListAPIView):
-    queryset = Favorite.objects.prefetch_related('user', 'hotels', 'folder', 'restaurants', 'transport')
+    queryset = Favorite.objects.select_related('folder')
     serializer_class = FavoriteListSerializer
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     filterset_class = FavoriteFilter
 
     def get_queryset(self):
-        favorites = self.request.user.favorite_set.all()
+        favorites = self.request.user.favorite_set.select_related('folder')
         return favorites
+
+    def is_compact_view(self):
+        return self.request.query_params.get('view') == 'compact'
+
+    def list(self, request, *args, **kwargs):
+        """
+        Объекты всех папок страницы загружаются пачкой: запрос к FavoriteItem, по одному на тип и на связи полного представления.
+        ?view=compact - краткие карточки, по странице (items_offset, items_limit) в каждой папке
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        items = list(page if page is not None else queryset)
+        if self.is_compact_view():
+            try:
+                offset = max(int(request.query_params.get('items_offset', 0)), 0)
+                limit = min(max(int(request.query_params.get('items_limit', favorites.CARDS_PAGE_SIZE)), 1),
+                            favorites.MAX_CARDS_PAGE_SIZE)
+            except ValueError:
+                return Response({"message": "items_offset and items_limit must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+            favorites.attach_cards(items, offset, limit)
+            context = self.get_serializer_context()
+            # все объекты выдачи - из избранного пользователя
+            context.update(items_offset=offset, items_limit=limit,
+                           favorite_ids={card.id for favorite in items for _, card in favorite.folder_cards})
+            serializer = FavoriteCardsSerializer(items, many=True, context=context)
+        else:
+            context = self.get_serializer_context()
+            FavoriteListSerializer.load_items(items, context)
+            serializer = FavoriteListSerializer(items, many=True, context=context)
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
     
     @swagger_auto_schema(
         operation_description="Get list of favorites",
+        manual_parameters=[
+            openapi.Parameter('view', openapi.IN_QUERY, description="compact - краткие карточки объектов вместо полных", type=openapi.TYPE_STRING),
+            openapi.Parameter('items_offset', openapi.IN_QUERY, description="compact: смещение страницы объектов в папке (next_offset)", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('items_limit', openapi.IN_QUERY, description="compact: объектов папки на странице, до 100", type=openapi.TYPE_INTEGER),
+        ],
         responses={200: FavoriteListSerializer(many=True)})
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
 
 class FavoriteCreateAPIView(generics.CreateAPIView):
-    queryset = Favorite.objects.prefetch_related('user', 'hotels', 'folder', 'restaurants', 'transport')
+    queryset = Favorite.objects.select_related('folder')
     serializer_class = FavoriteCRUDSerializer
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
@@ -695,94 +851,49 @@ class FavoriteCreateAPIView(generics.CreateAPIView):
         last_folder_id = request.data.get('last_folder')
         list_folders = request.data.get('list_folders') 
 
+        items = (('hotel', hotel_id), ('restaurant', restaurant_id), ('transport', transport_id), ('excursion', excursion_id))
+        items = [(item_type, item_id) for item_type, item_id in items if item_id is not None]
+
         if list_folders is not None:
-            for i in list_folders:
-                if hotel_id is not None:
-                    favorite = Favorite.objects.get(folder_id=i)
-                    favorite.hotels.add(hotel_id)
-                    favorite.save()
-                if restaurant_id is not None:
-                    favorite = Favorite.objects.get(folder_id=i)
-                    favorite.restaurants.add(restaurant_id)
-                    favorite.save()
-                if transport_id is not None:
-                    favorite = Favorite.objects.get(folder_id=i)
-                    favorite.transport.add(transport_id)
-                    favorite.save()
-                if excursion_id is not None:
-                    favorite = Favorite.objects.get(folder_id=i)
-                    favorite.excursion.add(excursion_id)
-                    f = TripFolder.objects.get(id=i)
-                    f.countFavorites += 1
-                    f.save()
-                    favorite.save()
-                f = TripFolder.objects.get(id=i)
-                f.countFavorites += 1
-                f.save()
+            # добавление в несколько папок - то же, что пакетная операция (favorites.py)
+            operations = [{'type': item_type, 'id': item_id, 'folders': list_folders} for item_type, item_id in items]
+            if operations:
+                serializer = FavoriteBulkSerializer(data={'operations': operations})
+                serializer.is_valid(raise_exception=True)
+                try:
+                    favorites.apply(request.user, serializer.validated_data['operations'])
+                except favorites.FavoriteError as error:
+                    return JsonResponse({'error': str(error)}, status=error.status)
             return JsonResponse({'message': 'Ok'}, status=200)
 
+        if not items:
+            return Response({"message": "required params"}, status=status.HTTP_400_BAD_REQUEST)
         if folder_id is None:
             try:
                 folder = TripFolder.objects.filter(user=request.user).last()
                 folder_id = folder.id
             except AttributeError:
                 return JsonResponse({'error': 'the user has no created folders'}, status=404)
-        # Проверяем, существует ли уже объект Favorite для данного пользователя и папки
-        favorite = Favorite.objects.filter(user=request.user, folder_id=folder_id).first()
+        # перенос из last_folder в folder - удаление и добавление в одной транзакции
+        operations = []
         if last_folder_id is not None:
-            last_favorite = Favorite.objects.get(folder_id=last_folder_id)
-            if hotel_id is not None:
-                last_favorite.hotels.remove(hotel_id)
-                f = TripFolder.objects.get(id=last_folder_id)
-                f.countFavorites -= 1
-                f.save()
-            if restaurant_id is not None:
-                last_favorite.restaurants.remove(restaurant_id)
-                f = TripFolder.objects.get(id=last_folder_id)
-                f.countFavorites -= 1
-                f.save()
-            if transport_id is not None:
-                last_favorite.transport.remove(transport_id)
-                f = TripFolder.objects.get(id=last_folder_id)
-                f.countFavorites -= 1
-                f.save()
-            if excursion_id is not None:
-                last_favorite.excursions.remove(excursion_id)
-                f = TripFolder.objects.get(id=last_folder_id)
-                f.countFavorites -= 1
-                f.save()
-        if favorite:
-            if hotel_id is not None:
-                favorite.hotels.add(hotel_id)
-            if restaurant_id is not None:
-                favorite.restaurants.add(restaurant_id)   
-            if transport_id is not None:
-                favorite.transport.add(transport_id)
-            if excursion_id is not None:
-                favorite.excursions.add(excursion_id)
-            folder = TripFolder.objects.get(id=folder_id)
-            folder.countFavorites += 1
-            folder.save()
-        else:
-            # Если не существует, то создаем новый объект Favorite и добавляем отель в его список отелей
-            favorite = Favorite.objects.create(user=request.user, folder_id=folder_id)
-            if hotel_id is not None:
-                favorite.hotels.add(hotel_id)
-            if restaurant_id is not None:
-                favorite.restaurants.add(restaurant_id)   
-            if transport_id is not None:
-                favorite.transport.add(transport_id)
-            if excursion_id is not None:
-                favorite.excursions.add(excursion_id)
-            folder = TripFolder.objects.get(id=folder_id)
-            folder.countFavorites += 1
-            folder.save()
+            operations += [{'action': 'remove', 'type': item_type, 'id': item_id, 'folders': [last_folder_id]}
+                           for item_type, item_id in items]
+        operations += [{'action': 'add', 'type': item_type, 'id': item_id, 'folders': [folder_id]}
+                       for item_type, item_id in items]
+        serializer = FavoriteBulkSerializer(data={'operations': operations})
+        serializer.is_valid(raise_exception=True)
+        try:
+            favorites.apply(request.user, serializer.validated_data['operations'])
+        except favorites.FavoriteError as error:
+            return JsonResponse({'error': str(error)}, status=error.status)
+        favorite = Favorite.objects.select_related('folder').filter(user=request.user, folder_id=folder_id).first()
         serializer = self.get_serializer(favorite)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
 
 class FavoriteRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView):
-    queryset = Favorite.objects.prefetch_related('user', 'hotels', 'folder', 'restaurants', 'transport')
+    queryset = Favorite.objects.select_related('user', 'folder')
     serializer_class = FavoriteCRUDSerializer
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
@@ -812,32 +923,15 @@ class FavoriteRetrieveUpdateDestroyAPIView(generics.RetrieveUpdateDestroyAPIView
 
         if (not hotel_id) and (not restaurant_id) and (not transport_id) and (not excursions_id):
             return Response({"message": "required params"}, status=status.HTTP_400_BAD_REQUEST)
+        items = (('hotel', hotel_id), ('restaurant', restaurant_id), ('transport', transport_id), ('excursion', excursions_id))
+        operations = [{'action': 'remove', 'type': item_type, 'id': item_id, 'folders': [favorite.folder_id]}
+                      for item_type, item_id in items if item_id is not None]
+        serializer = FavoriteBulkSerializer(data={'operations': operations})
+        serializer.is_valid(raise_exception=True)
         try:
-            if hotel_id is not None:
-                hotel = Hotel.objects.get(id=hotel_id)
-                favorite.hotels.remove(hotel)
-            if restaurant_id is not None:
-                restaurant = Restaurant.objects.get(id=restaurant_id)
-                favorite.restaurants.remove(restaurant)
-            if transport_id is not None:
-                transport = Transport.objects.get(id=transport_id)
-                favorite.transport.remove(transport)
-            if excursions_id is not None:
-                excursion = Excursion.objects.get(id=excursions_id)
-                favorite.excursions.remove(excursion)
-        except Hotel.DoesNotExist:
-            return Response({"message": "Hotel not found"}, status=status.HTTP_404_NOT_FOUND)
-        except Transport.DoesNotExist:
-            return Response({"message": "Transport not found"}, status=status.HTTP_404_NOT_FOUND)
-        except Restaurant.DoesNotExist:
-            return Response({"message": "Restaurant not found"}, status=status.HTTP_404_NOT_FOUND)
-        except Excursion.DoesNotExist:
-            return Response({"message": "Excursion not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        favorite.save()
-        folder = favorite.folder
-        folder.countFavorites -= 1
-        folder.save()
+            favorites.apply(favorite.user, serializer.validated_data['operations'])
+        except favorites.FavoriteError as error:
+            return Response({"message": str(error)}, status=error.status)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
@@ -865,40 +959,41 @@ class DeleteFavoriteAPIView(APIView):
 
         if (not hotel_id) and (not restaurant_id) and (not transport_id) and (not excursion_id):
             return Response({"message": "required params"}, status=status.HTTP_400_BAD_REQUEST)
-        if hotel_id is not None:
-            hotel = Hotel.objects.get(id=hotel_id)
-            favorite = Favorite.objects.get(user=request.user, hotels=hotel)
-            favorite.hotels.remove(hotel)
-            folder = favorite.folder
-            folder.countFavorites -= 1
-            folder.save()
-        if restaurant_id is not None:
-            restaurant = Restaurant.objects.get(id=restaurant_id)
-            favorite = Favorite.objects.get(user=request.user, restaurants=restaurant)
-            favorite.restaurants.remove(restaurant)
-            folder = favorite.folder
-            folder.countFavorites -= 1
-            folder.save()
-        if transport_id is not None:
-            transport = Transport.objects.get(id=transport_id)
-            favorite = Favorite.objects.get(user=request.user, transport=transport)
-            favorite.transport.remove(transport)
-            folder = favorite.folder
-            folder.countFavorites -= 1
-            folder.save()
-        if excursion_id is not None:
-            excursion = Excursion.objects.get(id=excursion_id)
-            favorite = Favorite.objects.get(user=request.user, excursions=excursion)
-            favorite.excursions.remove(excursion)
-            folder = favorite.folder
-            folder.countFavorites -= 1
-            folder.save()
-        
-        favorite.save()
+        # объект убирается из всех папок пользователя одним DELETE
+        items = Q()
+        for item_type, item_id in (('hotel', hotel_id), ('restaurant', restaurant_id),
+                                   ('transport', transport_id), ('excursion', excursion_id)):
+            if item_id is not None:
+                items |= Q(item_type=item_type, item_id=item_id)
+        if not favorites.remove_items(FavoriteItem.objects.filter(items, user=request.user)):
+            return Response({"message": "not in favorites"}, status=status.HTTP_404_NOT_FOUND)
 
         return Response({"message": "seccess delete"}, status=status.HTTP_204_NO_CONTENT)
 
 
+class FavoriteBulkAPIView(APIView):
+    """
+    Пакетное изменение избранного: все операции применяются в одной транзакции (favorites.py),
+    в ответе - новое число объектов в затронутых папках
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+
+    @swagger_auto_schema(
+        request_body=FavoriteBulkSerializer,
+        operation_summary="Пакетное изменение избранного",
+        operation_description="operations: [{action: add|remove, type: hotel|restaurant|transport|excursion, id, folders: [id папок]}]",
+    )
+    def post(self, request):
+        serializer = FavoriteBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            counts = favorites.apply(request.user, serializer.validated_data['operations'])
+        except favorites.FavoriteError as error:
+            return Response({'error': str(error)}, status=error.status)
+        return Response({'folders': [{'id': pk, 'countFavorites': count} for pk, count in counts.items()]})
+
+
 class UserInfo(APIView):
     permission_classes = [permissions.IsAuthenticated]
     authentication_classes = [JWTAuthentication]
@@ -911,6 +1006,7 @@ class UserInfo(APIView):
         user = request.user
         data = {
             'avatar': user.avatar.url if user.avatar else None,
+            'avatar_variants': variant_urls(user.avatar_variants, ('thumb', 'card')),
             'phone_number': user.phone_number,
             'username': user.username,
             'full_name': user.get_full_name(),
@@ -927,12 +1023,16 @@ class UserInfo(APIView):
         responses={200: UserInfoSerializer()})
     def put(self, request):
         user = request.user
+        # тело с base64-аватаром читается в память целиком, поэтому ограничено до разбора
+        if int(request.META.get('CONTENT_LENGTH') or 0) > uploads.BASE64_AVATAR_MAX_SIZE * 4 // 3 + uploads.READ_SIZE:
+            raise uploads.FileTooLarge
         serializer = UserInfoSerializer(user, data=request.data)
         if serializer.is_valid():
             serializer.save()
             # Получение обновленной информации пользователя
             data = {
                 'avatar': user.avatar.url if user.avatar else None,
+                'avatar_variants': variant_urls(user.avatar_variants, ('thumb', 'card')),
                 'phone_number': user.phone_number,
                 'username': user.username,
                 'full_name': user.get_full_name(),
@@ -944,6 +1044,44 @@ class UserInfo(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
 
+class AvatarUploadParser(FileUploadParser):
+    """Аватар телом запроса (Content-Type image/*), имя файла не обязательно"""
+    media_type = 'image/*'
+
+    def get_filename(self, stream, media_type, parser_context):
+        return super().get_filename(stream, media_type, parser_context) or 'avatar'
+
+
+class AvatarUploadView(APIView):
+    """
+    Загрузка аватара файлом: multipart-поле avatar или тело запроса с Content-Type image/*.
+    Файл пишется во временный файл на диске, размер ограничен AVATAR_MAX_SIZE уже во время приема,
+    уменьшенные копии делает celery (images.py)
+    """
+    permission_classes = [permissions.IsAuthenticated]
+    authentication_classes = [JWTAuthentication]
+    parser_classes = [MultiPartParser, AvatarUploadParser]
+
+    @swagger_auto_schema(operation_summary="Загрузка аватара файлом")
+    def put(self, request):
+        # обработчики нужно подменить до первого обращения к request.data
+        request.upload_handlers = [uploads.LimitedUploadHandler(request._request, uploads.AVATAR_MAX_SIZE),
+                                   TemporaryFileUploadHandler(request._request)]
+        avatar = request.data.get('avatar') or request.data.get('file')
+        if not avatar or not hasattr(avatar, 'read'):
+            return Response({'avatar': 'Нужен файл картинки'}, status=status.HTTP_400_BAD_REQUEST)
+        user = request.user
+        try:
+            image_format = uploads.verify_image(avatar)
+            user.avatar.save(f'avatar.{image_format.lower()}', avatar)  # временный файл переносится, а не копируется
+        finally:
+            avatar.close()
+        return Response({
+            'avatar': user.avatar.url,
+            'avatar_variants': variant_urls(user.avatar_variants, ('thumb', 'card')),
+        })
+
+
 class FeaturesListApiView(generics.ListAPIView):
     """особенности ресторана по типу еда на вынос, бронирование и т.д."""
     queryset = Features.objects.all()
@@ -1064,29 +1202,234 @@ class ConditionsRetriveApiView(generics.RetrieveAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class ExcursionListView(generics.ListAPIView):
-    queryset = Excursion.objects.prefetch_related('inclusives', 'conditions','owner').filter(status=True)
+class ExcursionListView(CatalogListMixin, generics.ListAPIView):
+    queryset = Excursion.objects.filter(status=True)
     serializer_class = ExcursionSerializer
+    summary_serializer_class = ExcursionListSerializer
+    reviews_field = 'reviewsExcursions'
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
-    filter_backends = [ExcursionFilter, filters.OrderingFilter, filters.SearchFilter]
-    # pagination_class = Paginator
+    filter_backends = [ExcursionFilter, filters.OrderingFilter]
+    pagination_class = KeysetPagination
 
     @swagger_auto_schema(manual_parameters=[
         openapi.Parameter('inclusives', in_=openapi.IN_QUERY, description="List of inclusives IDs", type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_INTEGER), required=False, collectionFormat='multi'),
         openapi.Parameter('conditions', in_=openapi.IN_QUERY, description="List of conditions IDs", type=openapi.TYPE_ARRAY, items=openapi.Items(type=openapi.TYPE_INTEGER), required=False, collectionFormat='multi'),
         openapi.Parameter('location', in_=openapi.IN_QUERY, description="Location filter", type=openapi.TYPE_STRING, required=False),
+        openapi.Parameter('city', in_=openapi.IN_QUERY, description="City id from /cities/", type=openapi.TYPE_INTEGER, required=False),
         openapi.Parameter('promotion', in_=openapi.IN_QUERY, description="Promotion filter", type=openapi.TYPE_STRING, required=False),
         openapi.Parameter('min_cost', in_=openapi.IN_QUERY, description="Minimum cost filter", type=openapi.TYPE_INTEGER, required=False),
         openapi.Parameter('max_cost', in_=openapi.IN_QUERY, description="Maximum cost filter", type=openapi.TYPE_INTEGER, required=False),
-        openapi.Parameter('lat', in_=openapi.IN_QUERY, description="Latitude for location-based filter", type=openapi.TYPE_NUMBER, required=False),
-        openapi.Parameter('lng', in_=openapi.IN_QUERY, description="Longitude for location-based filter", type=openapi.TYPE_NUMBER, required=False),
         openapi.Parameter('min_rate', in_=openapi.IN_QUERY, description="Minimum rate filter", type=openapi.TYPE_NUMBER, required=False),
-    ])
+    ] + geo_list_parameters + search_list_parameters + catalog_list_parameters)
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
+
+
+class NearbyView(APIView):
+    """
+    Ближайшие к точке объекты всех типов каталога. Порядок и расстояния считает индекс в памяти (geo.py),
+    из БД объекты каждого типа достаются одним запросом по списку id
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    max_k = 100
+    # тип -> (модель, краткий сериализатор)
+    catalog_types = {
+        'hotel': (Hotel, HotelListSerializer),
+        'restaurant': (Restaurant, RestaurantListSerializer),
+        'transport': (Transport, TransportListSerializer),
+        'excursion': (Excursion, ExcursionListSerializer),
+    }
+
+    @swagger_auto_schema(
+        operation_summary="Ближайшие объекты каталога",
+        manual_parameters=geo_list_parameters + [
+            openapi.Parameter('k', openapi.IN_QUERY, description="Сколько объектов вернуть, до 100", type=openapi.TYPE_INTEGER),
+            openapi.Parameter('types', openapi.IN_QUERY, description="Типы через запятую: hotel, restaurant, transport, excursion", type=openapi.TYPE_STRING),
+        ])
+    def get(self, request):
+        try:
+            lat = float(request.query_params['lat'])
+            lng = float(request.query_params['lng'])
+            radius_km = float(request.query_params.get('radius_km') or 0) or None
+            k = min(max(int(request.query_params.get('k', 20)), 1), self.max_k)
+        except (KeyError, ValueError):
+            return Response({'error': 'lat и lng обязательны, k и radius_km - числа'}, status=400)
+        types = request.query_params.get('types')
+        types = [name for name in types.split(',') if name in self.catalog_types] if types else list(self.catalog_types)
+
+        found = []
+        for name in types:
+            model = self.catalog_types[name][0]
+            found += [(distance, name, pk) for pk, distance in geo.get_index(model).nearest(lat, lng, k, radius_km)]
+        found = sorted(found)[:k]
+
+        objects = {}
+        for name in types:
+            ids = [pk for _, type_name, pk in found if type_name == name]
+            if not ids:
+                continue
+            model, serializer_class = self.catalog_types[name]
+            queryset = model.objects.filter(status=True, id__in=ids)
+            favorite_ids = favorite_cache.get_ids(request.user, model)
+            context = {'request': request, 'favorite_ids': favorite_ids}
+            for item in serializer_class(queryset, many=True, context=context).data:
+                objects[name, item['id']] = item
+
+        results = []
+        for distance, name, pk in found:
+            item = objects.get((name, pk))
+            if item is not None:  # объект могли снять с публикации после построения индекса
+                results.append({'type': name, **item, 'distance': round(distance, 2)})
+        return Response(results)
+
+
+class CatalogFacetsView(generics.GenericAPIView):
+    """
+    Счетчики для экрана фильтров: сколько объектов при текущих фильтрах попадает в каждое значение
+    m2m-полей, ценовой диапазон и порог рейтинга (см. facets.py). Ответ кэшируется по набору фильтров
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+    facet_fields = ()
+    price_edges = (0, 500, 1000, 2000, 5000)  # нижние границы ценовых диапазонов
+    rating_thresholds = (4, 3, 2, 1)
+    cache_params = ()
+
+    @swagger_auto_schema(
+        operation_summary="Счетчики фасетов для фильтров",
+        operation_description="Принимает те же фильтры, что и список объектов",
+        manual_parameters=geo_list_parameters + search_list_parameters)
+    def get(self, request, *args, **kwargs):
+        key = catalog_cache.list_key(self, kind='facets')
+        data = cache.get(key)
+        if data is None:
+            queryset = self.filter_queryset(self.get_queryset())
+            data = count_facets(queryset, self.facet_fields, self.price_edges, self.rating_thresholds)
+            cache.set(key, data, catalog_cache.LIST_TIMEOUT)
+        return Response(data)
+
+
+class HotelFacetsView(CatalogFacetsView):
+    queryset = Hotel.objects.filter(status=True)
+    filter_backends = [HotelFilter]
+    facet_fields = ('type_room', 'facilities', 'services')
+
+
+class RestaurantFacetsView(CatalogFacetsView):
+    queryset = Restaurant.objects.filter(status=True)
+    filter_backends = [RestaurantFilter]
+    facet_fields = ('features', 'kitchen')
+
+
+class TransportFacetsView(CatalogFacetsView):
+    queryset = Transport.objects.filter(status=True)
+    filter_backends = [TransportFilterBackend]
+    facet_fields = ('RentalServices',)
+
+
+class ExcursionFacetsView(CatalogFacetsView):
+    queryset = Excursion.objects.filter(status=True)
+    filter_backends = [ExcursionFilter]
+    facet_fields = ('inclusives', 'conditions')
+
+
+class CityListView(generics.ListAPIView):
+    """
+    Города, в которых есть опубликованные объекты, со счетчиками по типам.
+    Счетчики хранятся в City и меняются при сохранении объектов, поэтому список - один запрос
+    """
+    serializer_class = CitySerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [permissions.IsAuthenticated]
+    pagination_class = None
+
+    def get_queryset(self):
+        return cities.with_objects()
+
+    @swagger_auto_schema(
+        operation_summary="Список городов",
+        operation_description="id города можно передать в фильтр city списков объектов",
+    )
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
 
+class ResizedImageView(APIView):
+    """
+    Картинка из media, уменьшенная до одной из разрешенных ширин (resize.WIDTHS).
+    Копии кэшируются на диске, готовые nginx отдает сам, сюда приходят только промахи
+    """
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+    max_age = 60 * 60 * 24 * 30
+
+    @swagger_auto_schema(operation_summary="Уменьшенная картинка")
+    def get(self, request, width, path):
+        if width not in resize.WIDTHS:
+            raise Http404
+        try:
+            target = resize.resized_path(width, path)
+        except SuspiciousFileOperation:
+            raise Http404
+        if target is None:
+            raise Http404
+        response = FileResponse(open(target, 'rb'), content_type=mimetypes.guess_type(target)[0])
+        response['Cache-Control'] = f'public, max-age={self.max_age}'
+        return response
+
+
+class UploadSessionCreateView(generics.CreateAPIView):
+    """Начало загрузки фото частями (uploads.py). Готовые загрузки передаются в uploads при создании объекта"""
+    serializer_class = UploadSessionSerializer
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsPartnerOrAdminCreate]
+
+    def perform_create(self, serializer):
+        serializer.save(user=self.request.user)
+
+
+class UploadSessionView(APIView):
+    """
+    GET - сколько байт уже получено (для докачки), PUT - следующая часть файла
+    (тело запроса - байты части, заголовки Upload-Offset и необязательный Upload-Checksum - sha256 части),
+    DELETE - отмена загрузки
+    """
+    authentication_classes = [JWTAuthentication]
+    permission_classes = [IsPartnerOrAdminCreate]
+
+    def get(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        return Response(UploadSessionSerializer(session).data)
+
+    @swagger_auto_schema(
+        operation_summary="Загрузка части файла",
+        manual_parameters=[
+            openapi.Parameter('Upload-Offset', openapi.IN_HEADER, description="С какого байта начинается часть", type=openapi.TYPE_INTEGER, required=True),
+            openapi.Parameter('Upload-Checksum', openapi.IN_HEADER, description="sha256 части в hex", type=openapi.TYPE_STRING),
+        ])
+    def put(self, request, pk):
+        try:
+            offset = int(request.headers['Upload-Offset'])
+            length = int(request.headers['Content-Length']) if request.headers.get('Content-Length') else None
+        except (KeyError, ValueError):
+            return Response({'error': 'нужен числовой заголовок Upload-Offset'}, status=400)
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        try:
+            # тело читается из потока запроса кусками, без request.data / request.body
+            uploads.write_chunk(session, offset, request.stream, length, request.headers.get('Upload-Checksum', ''))
+        except uploads.UploadError as error:
+            return Response({'error': str(error), 'offset': session.offset}, status=error.status)
+        return Response(UploadSessionSerializer(session).data)
+
+    def delete(self, request, pk):
+        session = get_object_or_404(UploadSession, pk=pk, user=request.user)
+        uploads.delete_session(session)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
 class ExcursionCreateView(generics.CreateAPIView):
     queryset = Excursion.objects.prefetch_related('inclusives', 'conditions', 'owner')
     serializer_class = ExcursionSerializer
@@ -1095,15 +1438,10 @@ class ExcursionCreateView(generics.CreateAPIView):
 
     def perform_create(self, serializer):
         user = self.request.user
-        if 'photos' in self.request.data:
-            photos_data = self.request.data.getlist('photos')
-        else:
-            photos_data = None
-        excursion = serializer.save()
-        if photos_data is not None:
-            for photo_data in photos_data:
-                photo = Photo.objects.create(photo=photo_data)
-                excursion.photos.add(photo)
+        photos_data = request_list(self.request.data, 'photos')
+        sessions = uploads.completed_sessions(user, request_list(self.request.data, 'uploads'))
+        excursion = serializer.save(owner=user)  # владелец нужен уже при создании чата экскурсии
+        uploads.attach_photos(excursion, photos_data, sessions)
 
         serializer.save(owner=user)
 
@@ -1245,8 +1583,7 @@ class ReviewListView(generics.ListAPIView):
     authentication_classes = [JWTAuthentication]
     permission_classes = [permissions.IsAuthenticated]
     filterset_class = ReviewFilter
-    pagination_class = PageNumberPagination
-    page_size = 1
+    pagination_class = ReviewPagination
 
 
 class StatisticsView(APIView):
@@ -23,6 +23,7 @@ class User(AbstractUser):
         null=True
     )
     avatar = models.ImageField(null=True, blank=True)
+    avatar_variants = models.JSONField(default=dict, blank=True, editable=False)  # уменьшенные копии, см. api/images.py
     code = models.CharField(null=True, blank=True)
     country_code = models.CharField(null=True, blank=True, max_length=10)
     phone_code = models.CharField(null=True, blank=True, max_length=10)